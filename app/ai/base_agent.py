@@ -1,11 +1,90 @@
 import os
+import re
 import time
+import random
+import asyncio
 import json
-from typing import List
+from typing import List, Optional
 from datetime import datetime
+import orjson
+import math
+import hashlib
+from fastapi import HTTPException
+from cachetools import TTLCache
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 from ..utils.logger import log
-from ..utils.ollama_client import ollama_chat
+from ..utils.circuit_breaker import CircuitBreaker
+from . import keypool
+from ..utils.ollama_client import (
+    ollama_chat, ollama_chat_stream, OLLAMA_MODEL, OLLAMA_CLASSIFIER_MODEL, OLLAMA_MAX_CONCURRENCY
+)
+
+GEMINI_BASE_DELAY = 1
+GEMINI_MAX_BACKOFF = 60
+GEMINI_REQUEST_TIMEOUT = 15
+GEMINI_MAX_OUTPUT_TOKENS = 200
+# Base del backoff por key cuando el servidor no indica cuánto esperar
+GEMINI_RATE_LIMIT_BACKOFF_BASE = 60
+GEMINI_QUOTA_BACKOFF_BASE = 300
+
+# ✅ Config por defecto de las llamadas a Gemini creada una sola vez (y su parte de la clave de caché)
+_DEFAULT_GENERATION_CONFIG = genai.types.GenerationConfig(max_output_tokens=GEMINI_MAX_OUTPUT_TOKENS)
+_DEFAULT_GENERATION_CONFIG_KEY = repr(_DEFAULT_GENERATION_CONFIG)
+_DEFAULT_REQUEST_OPTIONS = {"timeout": GEMINI_REQUEST_TIMEOUT}
+
+# ✅ Breaker global de Gemini: errores que no son de cuota en todas las keys = caída del servicio
+GEMINI_BREAKER = CircuitBreaker("Gemini")
+
+# ✅ Tope de llamadas a Ollama en vuelo (todas las instancias de agentes): los hilos del pool por defecto
+# quedan libres para las sesiones de BD y el exceso espera en el event loop en lugar de encolarse en Ollama
+_OLLAMA_SEMAPHORE = asyncio.Semaphore(OLLAMA_MAX_CONCURRENCY)
+
+_RETRY_DELAY_RE = re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)|retry-after:?\s*(\d+)')
+
+def _parse_retry_after(error_str: str) -> Optional[int]:
+    """Extrae los segundos de espera sugeridos por el servidor (retry_delay / Retry-After)"""
+    match = _RETRY_DELAY_RE.search(error_str)
+    if not match:
+        return None
+    return int(match.group(1) or match.group(2))
+
+_JSON_RE = re.compile(r'```json\s*(\{.*?\})\s*```|(\{.*\})', re.DOTALL)
+
+def _find_json_object(text: str, start: int = 0) -> Optional[str]:
+    """Recorre el texto una sola vez y devuelve el primer objeto JSON balanceado y válido"""
+    depth = 0
+    begin = -1
+    in_string = False
+    escaped = False
+    
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            # Las comillas solo cuentan dentro de un objeto
+            in_string = depth > 0
+        elif char == '{':
+            if depth == 0:
+                begin = i
+            depth += 1
+        elif char == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                candidate = text[begin:i + 1]
+                try:
+                    orjson.loads(candidate)
+                    return candidate
+                except orjson.JSONDecodeError:
+                    continue
+    
+    return None
 
 class BaseAgent:
     """
@@ -15,7 +94,8 @@ class BaseAgent:
     def __init__(self, agent_name: str):
         self.agent_name = agent_name
         self.api_keys = self._load_api_keys()
-        self.key_retry_delays = {}
+        # ✅ Caché de respuestas LLM: prompts repetidos ("cancelar", "cambiar a 100") no vuelven a la red
+        self._response_cache = TTLCache(maxsize=2048, ttl=600)
         
         # ✅ CASCADA DE MODELOS: De más potente a más rápido/con más cuota
         self.model_cascade = [
@@ -29,28 +109,32 @@ class BaseAgent:
         # Inicializar con la primera key y el primer modelo
         self.current_key_index = 0
         self.current_model_index = 0
+        # ✅ Un GenerativeModel por (key, modelo), creados al iniciar y cada uno con su propio cliente:
+        # rotar es solo cambiar índices (sin await de por medio, atómico en el event loop), nunca reconfigurar
+        self._models = {
+            (key_index, model_index): self._make_model(api_key, model_name)
+            for key_index, api_key in enumerate(self.api_keys)
+            for model_index, model_name in enumerate(self.model_cascade)
+        }
         self._configure_gemini()
 
         log(f"🤖 {self.agent_name} inicializado con {len(self.api_keys)} API keys y {len(self.model_cascade)} modelos.")
 
     def _load_api_keys(self) -> List[str]:
-        """Carga todas las API keys disponibles desde el .env"""
-        keys = []
-        for i in range(1, 10):
-            key = os.getenv(f"GOOGLE_API_KEY_{i}")
-            if key:
-                keys.append(key)
-        return keys
+        """Devuelve las API keys cargadas al importar keypool (sin releer el entorno)"""
+        return list(keypool.API_KEYS)
+
+    @staticmethod
+    def _make_model(api_key: str, model_name: str):
+        """GenerativeModel con un cliente async propio ligado a la key (sin genai.configure global)"""
+        model = genai.GenerativeModel(model_name)
+        model._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+        return model
 
     def _configure_gemini(self):
-        """Configura Gemini con la API key y el modelo actual."""
+        """Selecciona el modelo precreado de la key y el modelo actuales."""
         if self.current_key_index < len(self.api_keys):
-            current_key = self.api_keys[self.current_key_index]
-            genai.configure(api_key=current_key)
-            
-            model_name = self.model_cascade[self.current_model_index]
-            self.model = genai.GenerativeModel(model_name)
-            log(f"🔧 {self.agent_name} configurado: Key #{self.current_key_index + 1}, Modelo: {model_name}")
+            self.model = self._models[(self.current_key_index, self.current_model_index)]
 
     def _switch_to_next_model(self):
         """Cambia al siguiente modelo en la cascada."""
@@ -68,79 +152,217 @@ class BaseAgent:
         self.current_model_index = 0
         self._configure_gemini()
 
+    def _switch_to_key(self, index: int):
+        """Cambia a una API key puntual y resetea al primer modelo."""
+        self.current_key_index = index
+        self.current_model_index = 0
+        self._configure_gemini()
+
     async def _make_gemini_request_with_fallback(self, prompt: str, **kwargs):
         """
-        Hace petición a Ollama con fallback automático entre modelos y API keys.
+        Hace petición a Gemini con fallback entre modelos y API keys.
+        Reintenta con backoff exponencial truncado + jitter y respeta el retry_delay del servidor.
         """
-        initial_key_index = self.current_key_index
+        # ✅ Límites explícitos en todas las llamadas: nada de workers colgados en un stream trabado
+        generation_config = kwargs.setdefault("generation_config", _DEFAULT_GENERATION_CONFIG)
+        kwargs.setdefault("request_options", _DEFAULT_REQUEST_OPTIONS)
         
-        while True:
-            key_id = f"key_{self.current_key_index}"
+        config_key = (
+            _DEFAULT_GENERATION_CONFIG_KEY if generation_config is _DEFAULT_GENERATION_CONFIG else repr(generation_config)
+        )
+        cache_key = self._cache_key(prompt, config_key)
+        cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        # ✅ Circuit breaker: con todas las keys en cooldown se falla al instante, sin iterar reintentos
+        self._raise_if_all_cooling()
+        # Con Gemini caído (breaker abierto) se lanza CircuitOpenError y el agente usa su fallback
+        GEMINI_BREAKER.check()
+        
+        max_attempts = len(self.api_keys) * 3
+        last_error = None
+        
+        for attempt in range(max_attempts):
+            current_key = self.api_keys[self.current_key_index]
             model_name = self.model_cascade[self.current_model_index]
             
             # Verificar si la key está en cooldown
-            if key_id in self.key_retry_delays and time.time() < self.key_retry_delays[key_id]:
-                log(f"⏰ {self.agent_name}: Key #{self.current_key_index + 1} en cooldown. Cambiando de key.")
-                self._switch_to_next_key()
-                if self.current_key_index == initial_key_index: # Si dimos toda la vuelta
-                    raise Exception("Todas las API keys están en cooldown.")
+            if keypool.in_cooldown(current_key):
+                # ✅ La próxima key sana sale de la cola de keypool, sin recorrer las que siguen frías
+                index = keypool.next_ready_key()
+                if index is None:
+                    self._raise_if_all_cooling()
+                    continue
+                log("⏰ Key en cooldown, cambiando", level="DEBUG", agent=self.agent_name, key=self.current_key_index + 1, next_key=index + 1)
+                self._switch_to_key(index)
                 continue
 
+            # ✅ Rate limit del lado cliente: si esta key no tiene cupo, usar otra que sí lo tenga
+            if not keypool.limiter_for(current_key).has_capacity():
+                for offset in range(1, len(self.api_keys)):
+                    index = (self.current_key_index + offset) % len(self.api_keys)
+                    key = self.api_keys[index]
+                    if not keypool.in_cooldown(key) and keypool.limiter_for(key).has_capacity():
+                        self._switch_to_key(index)
+                        break
+                current_key = self.api_keys[self.current_key_index]
+                model_name = self.model_cascade[self.current_model_index]
+            
+            # Si ninguna tiene cupo, espera el próximo token en lugar de provocar un 429
+            await keypool.limiter_for(current_key).acquire()
+
             try:
-                log(f"🔍 {self.agent_name}: Intentando con Key #{self.current_key_index + 1} y Modelo '{model_name}'")
-                response = await self.model.generate_content_async(prompt, **kwargs)
+                # ✅ Una línea por intento: DEBUG con campos estructurados (no se serializan si el nivel está apagado)
+                log("🔍 Intentando request", level="DEBUG", agent=self.agent_name, key=self.current_key_index + 1, model=model_name)
+                response = await asyncio.wait_for(
+                    self.model.generate_content_async(prompt, **kwargs),
+                    timeout=GEMINI_REQUEST_TIMEOUT + 5
+                )
+                keypool.reset_backoff(current_key)
+                GEMINI_BREAKER.record_success()
+                self._response_cache[cache_key] = response
                 return response
 
+            except asyncio.TimeoutError as e:
+                # Timeout: reintentable, probamos con otra key
+                last_error = e
+                GEMINI_BREAKER.record_failure()
+                GEMINI_BREAKER.check()
+                log(f"⌛ {self.agent_name}: Timeout con Key #{self.current_key_index + 1} y Modelo '{model_name}'. Cambiando de key.")
+                self._switch_to_next_key()
+                continue
+
             except Exception as e:
+                last_error = e
                 error_str = str(e).lower()
                 log(f"❌ {self.agent_name}: Error con Key #{self.current_key_index + 1} y Modelo '{model_name}': {error_str[:150]}")
+                
+                retry_after = _parse_retry_after(error_str)
 
-                if "quota" in error_str or "429" in error_str:
-                    # El error de cuota puede ser por modelo o por key.
-                    # Asumimos que es por modelo y probamos el siguiente.
-                    log(f"📉 Cuota agotada para '{model_name}'. Cambiando al siguiente modelo.")
-                    self._switch_to_next_model()
-                elif "api key not valid" in error_str:
+                if "api key not valid" in error_str:
                     log(f"🔑 Key #{self.current_key_index + 1} inválida. Poniendo en cooldown y cambiando.")
-                    self.key_retry_delays[key_id] = time.time() + 86400 # Cooldown de 24h
+                    keypool.set_cooldown(current_key, 86400) # Cooldown de 24h
+                    self._switch_to_next_key()
+                    continue
+                elif retry_after is not None:
+                    # El servidor indicó cuánto esperar: cooldown exacto para esta key
+                    log(f"📉 Cuota agotada en Key #{self.current_key_index + 1}. Cooldown de {retry_after}s según el servidor.")
+                    keypool.set_cooldown(current_key, retry_after)
+                    self._switch_to_next_key()
+                elif "quota" in error_str:
+                    # Sin pista del servidor: asumimos cuota por modelo y probamos el siguiente;
+                    # si ya no quedan modelos en esta key, la key entra en backoff
+                    if self.current_model_index + 1 >= len(self.model_cascade):
+                        delay = keypool.backoff_cooldown(current_key, GEMINI_QUOTA_BACKOFF_BASE)
+                        log(f"📉 Cuota agotada en todos los modelos de Key #{self.current_key_index + 1}. Backoff de {delay:.0f}s.")
+                    else:
+                        log(f"📉 Cuota agotada para '{model_name}'. Cambiando al siguiente modelo.")
+                    self._switch_to_next_model()
+                elif "429" in error_str:
+                    # Rate limit sin retry_delay: backoff exponencial con jitter para esta key
+                    delay = keypool.backoff_cooldown(current_key, GEMINI_RATE_LIMIT_BACKOFF_BASE)
+                    log(f"🚦 Rate limit en Key #{self.current_key_index + 1}. Backoff de {delay:.0f}s.")
                     self._switch_to_next_key()
                 else:
                     # Otro tipo de error, probamos el siguiente modelo
                     log(f"🔄 Error general. Cambiando al siguiente modelo.")
+                    GEMINI_BREAKER.record_failure()
                     self._switch_to_next_model()
+                    GEMINI_BREAKER.check()
+                
+                # ✅ Backoff exponencial truncado con jitter (evita olas de reintentos sincronizadas)
+                delay = min(GEMINI_BASE_DELAY * 2 ** attempt + random.uniform(0, 1), GEMINI_MAX_BACKOFF)
+                await asyncio.sleep(delay)
+        
+        raise Exception(f"{self.agent_name}: Se agotaron los {max_attempts} intentos con keys y modelos. Último error: {last_error}")
 
-                # Si después de cambiar, volvemos al punto de partida, significa que probamos todo.
-                if self.current_key_index == initial_key_index and self.current_model_index == 0:
-                    raise Exception(f"{self.agent_name}: Todas las combinaciones de keys y modelos han fallado.")
+    def _raise_if_all_cooling(self):
+        """Lanza 503 con Retry-After si ninguna key puede usarse ahora"""
+        wait = keypool.all_cooling_wait(self.api_keys)
+        if wait:
+            retry_after = math.ceil(wait)
+            raise HTTPException(
+                status_code=503,
+                detail=f"Todas las API keys están en cooldown, reintentar en {retry_after}s",
+                headers={"Retry-After": str(retry_after)}
+            )
 
-    def call_ollama(self, messages, model="qwen3:8b"):
-        return ollama_chat(messages, model=model)
+    @staticmethod
+    def _cache_key(*parts) -> bytes:
+        """Clave compacta (BLAKE2b de 16 bytes) para la caché de respuestas"""
+        return hashlib.blake2b("\x1f".join(map(str, parts)).encode(), digest_size=16).digest()
     
-    def _extract_json_from_response(self, response_text: str) -> str:
-        """Extrae JSON de la respuesta de Ollama que puede contener texto adicional"""
+    async def _cached_ollama_json(self, cache_key: bytes, messages, format="json") -> str:
+        """call_ollama_json con caché TTL; solo guarda respuestas que son JSON válido ('format' admite un JSON schema)"""
+        cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            return cached
         
-        # ✅ CASO 1: Respuesta directa es JSON
-        if response_text.strip().startswith('{') and response_text.strip().endswith('}'):
-            return response_text.strip()
-        
-        # ✅ CASO 2: JSON dentro de markdown
-        if "```json" in response_text:
-            start = response_text.find("```json") + 7
-            end = response_text.find("```", start)
-            if end != -1:
-                return response_text[start:end].strip()
-        
-        # ✅ CASO 3: JSON después de texto explicativo (como <think>)
-        # Buscar el primer { y el último }
-        first_brace = response_text.find('{')
-        last_brace = response_text.rfind('}')
-        
-        if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-            json_candidate = response_text[first_brace:last_brace + 1]
+        async with _OLLAMA_SEMAPHORE:
+            response = await asyncio.to_thread(self.call_ollama_json, messages, format=format)
+        if self._extract_json_from_response(response):
+            self._response_cache[cache_key] = response
+        return response
+    
+    def call_ollama(self, messages, model=OLLAMA_MODEL, format=None):
+        return ollama_chat(messages, model=model, format=format)
+    
+    async def call_ollama_async(self, messages, model=OLLAMA_MODEL, format=None):
+        """call_ollama en un hilo del pool: el cliente de Ollama es bloqueante y no debe frenar el event loop"""
+        async with _OLLAMA_SEMAPHORE:
+            return await asyncio.to_thread(self.call_ollama, messages, model=model, format=format)
+    
+    def call_ollama_stream(self, messages, model=OLLAMA_CLASSIFIER_MODEL, format=None):
+        return ollama_chat_stream(messages, model=model, format=format)
+    
+    def call_ollama_json(self, messages, model=OLLAMA_CLASSIFIER_MODEL, format="json") -> str:
+        """Consume el stream de Ollama (decodificación restringida a JSON) y corta apenas llega un objeto completo"""
+        chunks = []
+        stream = self.call_ollama_stream(messages, model=model, format=format)
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                if '}' not in chunk:
+                    continue
+                
+                text = "".join(chunks)
+                # No parsear llaves dentro del bloque de razonamiento de qwen3
+                if "<think>" in text and "</think>" not in text:
+                    continue
+                
+                json_content = self._extract_json_from_response(text.rpartition("</think>")[2])
+                if json_content:
+                    return json_content
             
-            # Verificar que sea JSON válido básico
-            if json_candidate.count('{') == json_candidate.count('}'):
-                return json_candidate
+            return "".join(chunks)
+        finally:
+            stream.close()
+    
+    @staticmethod
+    def _strip_fences(text: Optional[str]) -> str:
+        """Quita los fences de markdown (```json ... ```) y espacios sobrantes de una respuesta"""
+        if not text:
+            return ""
+        text = text.strip()
+        for prefix in ("```json", "```"):
+            text = text.removeprefix(prefix)
+        return text.removesuffix("```").strip()
+    
+    def _extract_json_from_response(self, response_text: str) -> Optional[str]:
+        """Extrae JSON de la respuesta de Ollama que puede contener texto adicional"""
+        if not response_text:
+            return None
+        
+        # ✅ Un solo regex: bloque ```json o desde la primera { hasta la última }
+        match = _JSON_RE.search(response_text)
+        if not match:
+            return None
         
-        # ✅ CASO 4: No se encontró JSON válido
-        return None
\ No newline at end of file
+        json_candidate = match.group(1) or match.group(2)
+        try:
+            orjson.loads(json_candidate)
+            return json_candidate
+        except orjson.JSONDecodeError:
+            # ✅ Texto extra con llaves (como <think>): buscar el primer objeto balanceado válido
+            return _find_json_object(response_text, match.start())
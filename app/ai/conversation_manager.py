@@ -4,13 +4,13 @@ from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models
-import json
+import orjson
 import os
 from dotenv import load_dotenv
 import time
 from .stock_agent import stock_agent
 from .order_agent import order_agent
-from .modify_agent import modify_agent
+from .modify_agent import get_modify_agent
 from .sales_agent import sales_agent
 from ..utils.logger import log
 from ..utils.ollama_client import ollama_chat
@@ -160,7 +160,7 @@ class ConversationManager(BaseAgent):
             # Crear prompt con contexto completo
             prompt = self.create_intent_analysis_prompt_with_reasoning(message, conversation)
             
-            response_text = self.call_ollama([
+            response_text = await self.call_ollama_async([
                 {"role": "system", "content": "Eres un dispatcher inteligente para un sistema de ventas B2B textil."},
                 {"role": "user", "content": prompt}])
             
@@ -169,18 +169,15 @@ class ConversationManager(BaseAgent):
 
             try:
                 # Limpiar respuesta JSON si viene con markdown
-                if response_text.startswith("```json"):
-                    response_text = response_text[7:-3]
-                elif response_text.startswith("```"):
-                    response_text = response_text[3:-3]
+                response_text = self._strip_fences(response_text)
                 
-                parsed_response = json.loads(response_text)
+                parsed_response = orjson.loads(response_text)
                 log(f"📦 Respuesta de Ollama: {parsed_response}")
                 intent = parsed_response.get("intent", "general_chat")
                 reasoning = parsed_response.get("reasoning", "No reasoning provided")
                 confidence = parsed_response.get("confidence", 0.8)
                 
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 # Si no es JSON válido, extraer solo la intención como antes
                 intent = response_text.lower().strip()
                 reasoning = f"Respuesta de Gemini no fue JSON válido: {response_text}"
@@ -353,7 +350,7 @@ Ejemplo de respuesta:
                 return await order_agent.handle_order_creation(message, conversation)
                 
             elif intent == 'modify_order':
-                return await modify_agent.handle_order_modification(message, conversation)
+                return await get_modify_agent().handle_order_modification(message, conversation)
                 
             elif intent == 'sales_advice':
                 return await sales_agent.handle_sales_advice(message, conversation)
@@ -1,5 +1,6 @@
 from typing import Dict
 from datetime import datetime
+import orjson
 from .base_agent import BaseAgent
 from ..utils.logger import log
 
@@ -68,15 +69,14 @@ EJEMPLOS:
 - "como estas" → {{"message_type": "small_talk", "user_mood": "friendly"}}"""
 
         try:
-            response_text = self.call_ollama([
+            response_text = await self.call_ollama_async([
                 {"role": "system", "content": "Eres un asistente de análisis conversacional."},
                 {"role": "user", "content": prompt}
             ])
             
             json_content = self._extract_json_from_response(response_text)
             if json_content:
-                import json
-                analysis = json.loads(json_content)
+                analysis = orjson.loads(json_content)
                 log(f"💬🎯 Análisis general: {analysis}")
                 return analysis
                 
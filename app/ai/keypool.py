@@ -0,0 +1,195 @@
+import os
+import time
+import random
+import asyncio
+import heapq
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from ..utils.logger import log
+
+try:
+    import redis
+except ImportError:  # Redis es opcional: sin él el estado de las keys queda local al proceso
+    redis = None
+
+load_dotenv()
+
+# ✅ Las keys se leen una sola vez al importar, no en cada instancia de agente
+API_KEYS = tuple(
+    key for key in (os.getenv(f"GOOGLE_API_KEY_{i}") for i in range(1, 10)) if key
+)
+
+# Requests por minuto permitidos por key (free tier de gemini-1.5-flash: 15)
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+
+# ✅ Cooldowns compartidos por TODOS los agentes del proceso: un 429 deja la key fuera para todos
+# Acotado a 2x las keys configuradas: ids de keys ajenas al pool no pueden hacerlo crecer sin límite
+KEY_COOLDOWNS_MAX = max(2 * len(API_KEYS), 1)
+KEY_COOLDOWNS: "OrderedDict[str, float]" = OrderedDict()
+LOCK = threading.Lock()
+
+def key_id(api_key: str) -> str:
+    """Identificador estable de una API key (hash, nunca la key en claro)"""
+    return hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest()
+
+# ✅ Salud de keys: heap (libre_desde, índice) con las que están en cooldown y cola round-robin de las listas
+_KEY_INDEX = {key: index for index, key in enumerate(API_KEYS)}
+_COOLDOWN_HEAP: List[Tuple[float, int]] = []
+_READY: Deque[int] = deque(range(len(API_KEYS)))
+_READY_SET = set(_READY)
+
+# ✅ Con REDIS_URL los cooldowns se comparten entre workers: un 429 en uno deja la key fuera para todos
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_SYNC_INTERVAL = 1.0
+_REDIS_PREFIX = "gemini:cooldown:"
+_redis = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5) if redis and REDIS_URL else None
+_last_sync = 0.0
+
+def _store_cooldown(identifier: str, until: float):
+    """Guarda el cooldown manteniendo KEY_COOLDOWNS acotado, descartando la entrada más vieja (requiere LOCK)"""
+    KEY_COOLDOWNS[identifier] = until
+    KEY_COOLDOWNS.move_to_end(identifier)
+    while len(KEY_COOLDOWNS) > KEY_COOLDOWNS_MAX:
+        KEY_COOLDOWNS.popitem(last=False)
+
+def _mark_cooling(index: int, until: float):
+    """Registra el cooldown localmente (requiere LOCK)"""
+    _store_cooldown(key_id(API_KEYS[index]), until)
+    # La key sale de la cola de listas de forma perezosa (se descarta al llegar al frente)
+    _READY_SET.discard(index)
+    heapq.heappush(_COOLDOWN_HEAP, (until, index))
+
+def _sync_shared_cooldowns():
+    """Trae los cooldowns que pusieron otros workers (como mucho una vez por REDIS_SYNC_INTERVAL)"""
+    global _last_sync
+    now = time.time()
+    if _redis is None or not API_KEYS or now - _last_sync < REDIS_SYNC_INTERVAL:
+        return
+    _last_sync = now
+    try:
+        values = _redis.mget([_REDIS_PREFIX + key_id(key) for key in API_KEYS])
+    except redis.RedisError as e:
+        log(f"⚠️ Redis no disponible para cooldowns compartidos: {e}", level="WARNING")
+        return
+    with LOCK:
+        for index, value in enumerate(values):
+            if value is None:
+                continue
+            until = float(value)
+            if until > KEY_COOLDOWNS.get(key_id(API_KEYS[index]), 0):
+                _mark_cooling(index, until)
+
+def set_cooldown(api_key: str, seconds: float):
+    """Pone la key en cooldown durante 'seconds' segundos (y lo publica en Redis si está configurado)"""
+    until = time.time() + seconds
+    with LOCK:
+        index = _KEY_INDEX.get(api_key)
+        if index is not None:
+            _mark_cooling(index, until)
+        else:
+            _store_cooldown(key_id(api_key), until)
+    if _redis is not None:
+        try:
+            _redis.set(_REDIS_PREFIX + key_id(api_key), until, px=max(1, int(seconds * 1000)))
+        except redis.RedisError as e:
+            log(f"⚠️ No se pudo publicar el cooldown en Redis: {e}", level="WARNING")
+
+# ✅ Backoff por key con jitter decorrelado: último delay de cada key (se resetea con un éxito)
+KEY_BACKOFF_CAP = 3600
+_KEY_BACKOFF: Dict[str, float] = {}
+
+def backoff_cooldown(api_key: str, base: float) -> float:
+    """Pone la key en cooldown con delay = min(cap, uniform(base, último_delay * 3)) y lo devuelve"""
+    identifier = key_id(api_key)
+    with LOCK:
+        previous = _KEY_BACKOFF.get(identifier, base)
+        delay = min(KEY_BACKOFF_CAP, random.uniform(base, max(base, previous) * 3))
+        _KEY_BACKOFF[identifier] = delay
+    set_cooldown(api_key, delay)
+    return delay
+
+def reset_backoff(api_key: str):
+    """Un request exitoso vuelve la key a su backoff base"""
+    with LOCK:
+        _KEY_BACKOFF.pop(key_id(api_key), None)
+
+def next_ready_key() -> Optional[int]:
+    """Índice (en API_KEYS) de la próxima key lista en round-robin; None si todas están en cooldown"""
+    _sync_shared_cooldowns()
+    now = time.time()
+    with LOCK:
+        # Devolver a la cola las keys cuyo cooldown ya venció
+        while _COOLDOWN_HEAP and _COOLDOWN_HEAP[0][0] <= now:
+            _, index = heapq.heappop(_COOLDOWN_HEAP)
+            identifier = key_id(API_KEYS[index])
+            if index not in _READY_SET and KEY_COOLDOWNS.get(identifier, 0) <= now:
+                # Cooldown vencido: la entrada ya no aporta nada
+                KEY_COOLDOWNS.pop(identifier, None)
+                _READY_SET.add(index)
+                _READY.append(index)
+        
+        while _READY:
+            index = _READY.popleft()
+            if index in _READY_SET:
+                _READY.append(index)
+                return index
+        return None
+
+def in_cooldown(api_key: str) -> bool:
+    """True si la key todavía está en cooldown"""
+    _sync_shared_cooldowns()
+    with LOCK:
+        return time.time() < KEY_COOLDOWNS.get(key_id(api_key), 0)
+
+def all_cooling_wait(api_keys) -> float:
+    """Segundos hasta que se libere la primera key si TODAS están en cooldown; 0 si alguna está activa"""
+    _sync_shared_cooldowns()
+    now = time.time()
+    with LOCK:
+        remaining = [KEY_COOLDOWNS.get(key_id(key), 0) - now for key in api_keys]
+    if not remaining or min(remaining) <= 0:
+        return 0
+    return min(remaining)
+
+
+class TokenBucket:
+    """Token bucket asíncrono: como mucho max_rate requests cada time_period segundos (se usa desde el event loop)"""
+    
+    def __init__(self, max_rate: int, time_period: float = 60.0):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._tokens = float(max_rate)
+        self._updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_rate, self._tokens + (now - self._updated) * self.max_rate / self.time_period)
+        self._updated = now
+    
+    def has_capacity(self) -> bool:
+        """True si hay un token disponible sin esperar"""
+        self._refill()
+        return self._tokens >= 1
+    
+    async def acquire(self):
+        """Consume un token, esperando lo justo si el bucket está vacío"""
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) * self.time_period / self.max_rate)
+
+# ✅ Un limitador por key, compartido por todos los agentes
+_LIMITERS: Dict[str, TokenBucket] = {}
+
+def limiter_for(api_key: str) -> TokenBucket:
+    """Devuelve el token bucket de la key (lo crea la primera vez)"""
+    identifier = key_id(api_key)
+    limiter = _LIMITERS.get(identifier)
+    if limiter is None:
+        limiter = _LIMITERS[identifier] = TokenBucket(GEMINI_RPM)
+    return limiter
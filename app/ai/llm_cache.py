@@ -0,0 +1,168 @@
+import hashlib
+import math
+import os
+import threading
+from collections import Counter, OrderedDict
+from itertools import count
+from typing import Dict, Hashable, Optional, Set, Tuple
+import orjson
+from cachetools import TTLCache
+
+# Por encima de esta temperatura la respuesta no es reproducible y no tiene sentido cachearla
+LLM_CACHE_MAX_TEMPERATURE = 0.2
+
+class LLMCache:
+    """
+    Caché exacta de respuestas LLM: clave SHA-256 del prompt, TTL + LRU en memoria del proceso.
+    Interfaz async (get/set/delete) para poder cambiar el backend sin tocar a los agentes.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 3600):
+        self._lock = threading.Lock()
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.stats = {"hits": 0, "misses": 0, "sets": 0, "skipped": 0}
+
+    @staticmethod
+    def key(*parts) -> str:
+        """SHA-256 de las partes serializadas (orden de claves estable)"""
+        payload = orjson.dumps(parts, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+        return hashlib.sha256(payload).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            self.stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    async def set(self, key: str, value: str, temperature: float = 0.0):
+        """Guarda la respuesta salvo que venga de una generación no determinista"""
+        with self._lock:
+            if temperature > LLM_CACHE_MAX_TEMPERATURE:
+                self.stats["skipped"] += 1
+                return
+            self._entries[key] = value
+            self.stats["sets"] += 1
+
+    async def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def metrics(self) -> Dict:
+        """Contadores y tasa de aciertos para /metrics"""
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "size": len(self._entries),
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+            }
+
+# Similitud coseno mínima entre trigramas de caracteres para reutilizar una respuesta
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+def _trigrams(text: str) -> Counter:
+    """Vector disperso de trigramas de caracteres del texto normalizado (con bordes marcados)"""
+    padded = f"  {' '.join(text.lower().split())} "
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+class SemanticCache:
+    """
+    Caché por similitud para paráfrasis ("remeras blancas talle L" / "quiero remeras blancas en talle L").
+    Vectores de trigramas de caracteres con coseno; un índice invertido trigrama → entradas limita la comparación
+    a los candidatos que comparten algún trigrama. El 'scope' separa lo que nunca debe mezclarse
+    (por ejemplo cantidades o entidades distintas): solo se compara dentro del mismo scope.
+    """
+
+    def __init__(self, maxsize: int = 2000, threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._ids = count()
+        self._entries: "OrderedDict[int, Tuple[Hashable, str, Counter, float, object]]" = OrderedDict()
+        self._index: Dict[Tuple[Hashable, str], Set[int]] = {}
+        self.stats = {"hits": 0, "misses": 0, "sets": 0}
+
+    def lookup(self, scope: Hashable, text: str) -> Optional[object]:
+        """Valor de la entrada más parecida del mismo scope si supera el umbral"""
+        vector = _trigrams(text)
+        norm = math.sqrt(sum(v * v for v in vector.values()))
+        with self._lock:
+            candidates = set()
+            for gram in vector:
+                candidates |= self._index.get((scope, gram), set())
+            
+            best_id, best_score = None, 0.0
+            for entry_id in candidates:
+                _, _, other, other_norm, _ = self._entries[entry_id]
+                dot = sum(weight * other.get(gram, 0) for gram, weight in vector.items())
+                score = dot / (norm * other_norm) if norm and other_norm else 0.0
+                if score > best_score:
+                    best_id, best_score = entry_id, score
+            
+            if best_id is None or best_score < self.threshold:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][4]
+
+    def add(self, scope: Hashable, text: str, value: object):
+        vector = _trigrams(text)
+        norm = math.sqrt(sum(v * v for v in vector.values()))
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (scope, text, vector, norm, value)
+            for gram in vector:
+                self._index.setdefault((scope, gram), set()).add(entry_id)
+            self.stats["sets"] += 1
+            
+            while len(self._entries) > self.maxsize:
+                old_id, (old_scope, _, old_vector, _, _) = self._entries.popitem(last=False)
+                for gram in old_vector:
+                    bucket = self._index.get((old_scope, gram))
+                    if bucket is not None:
+                        bucket.discard(old_id)
+                        if not bucket:
+                            del self._index[(old_scope, gram)]
+
+    def save(self, path: str) -> int:
+        """Vuelca (scope, texto, valor) a JSON en orden LRU; los vectores se recalculan al cargar"""
+        with self._lock:
+            rows = [[scope, text, value] for scope, text, _, _, value in self._entries.values()]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(rows))
+        os.replace(tmp_path, path)
+        return len(rows)
+
+    def load(self, path: str) -> int:
+        """Carga un volcado de save(); sin archivo no hace nada"""
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            rows = orjson.loads(f.read())
+        for scope, text, value in rows:
+            self.add(_as_tuple(scope), text, value)
+        # La carga no cuenta como escrituras en las métricas
+        self.stats["sets"] -= len(rows)
+        return len(rows)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "size": len(self._entries),
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+            }
+
+def _as_tuple(value):
+    """Listas de JSON → tuplas (los scopes tienen que ser hashables)"""
+    return tuple(_as_tuple(item) for item in value) if isinstance(value, list) else value
+
+# Archivo donde se persiste la caché semántica entre reinicios (vacío = sin persistencia)
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "")
+
+# Instancias globales (compartidas por todos los agentes del proceso)
+llm_cache = LLMCache()
+semantic_intent_cache = SemanticCache()
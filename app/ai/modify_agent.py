@@ -1,41 +1,420 @@
-from typing import Dict, List, Optional
-from datetime import datetime, timedelta
+import asyncio
+import re
+import sys
+import time
+from functools import cache, lru_cache
+from typing import Callable, Dict, List, NamedTuple, Optional
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models, crud, schemas
-import json
 import os
+import orjson
 from fastapi import HTTPException
-from ..utils.logger import log
+from ..utils.logger import log, log_enabled
 from .base_agent import BaseAgent
-import pytz
+from ..product_index import product_price_cache
+from ..utils.pricing import price_tuple, unit_price
+
+UTC = timezone.utc
+
+# ✅ Fast path: "cancelar #123", "cambiar #123 a 200"
+_ORDER_ID_RE = re.compile(r'#(\d+)')
+_MODIFY_VERB_RE = re.compile(r'\b(cancel\w*|anul\w*|cambi\w*|modific\w*|agreg\w*|sum\w*|reduc\w*|quit\w*)\b')
+
+# Clasificación por palabras clave (sin LLM)
+_NUM_RE = re.compile(r'\d+')
+_WORD_RE = re.compile(r'\w+')
+_CANCEL_WORDS = frozenset(("cancelar", "cancela", "cancelá", "cancelo"))
+_ADD_WORDS = frozenset(("más", "mas", "agregar", "agregá", "sumar", "sumá", "añadir"))
+_SUB_WORDS = frozenset(("menos", "reducir", "reducí", "quitar", "quitá", "restar"))
+
+_MODIFICATION_EXAMPLES = """EJEMPLOS:
+- "cambiar a 100 unidades" → {"modification_type": "change_quantity", "new_quantity": 100, "is_clear": true}
+- "quiero 30 más" → {"modification_type": "add_more", "quantity_change": 30, "is_clear": true}
+- "reducir 20" → {"modification_type": "reduce_quantity", "quantity_change": -20, "is_clear": true}
+- "cancelar pedido" → {"modification_type": "cancel_order", "is_clear": true}
+- "cambiar cantidad" → {"modification_type": "unclear", "confirmation_needed": true}"""
+
+# Las llaves literales de los ejemplos se escapan una sola vez para format_map
+_EXAMPLES_ESCAPED = _MODIFICATION_EXAMPLES.replace("{", "{{").replace("}", "}}")
+
+# ✅ Salida estructurada: el schema de ModIntent restringe la decodificación, el prompt solo explica los valores
+_MOD_INTENT_SCHEMA = schemas.ModIntent.model_json_schema()
+
+_ANALYZE_SYSTEM = """Clasificas mensajes que modifican un pedido B2B textil.
+modification_type:
+- change_quantity: fija una cantidad total nueva (new_quantity)
+- add_more: suma unidades (quantity_change positivo)
+- reduce_quantity: resta unidades (quantity_change negativo)
+- cancel_order: cancela el pedido
+- unclear: no se entiende el cambio (confirmation_needed = true)
+is_clear = true solo si la instrucción no es ambigua."""
+
+# ✅ Plantilla constante: por request solo se arma el dict de sustituciones
+_ANALYZE_TMPL = """PEDIDO ACTUAL: #{order_id}, {product_name}, {quantity} unidades, estado {status}
+MENSAJE DEL USUARIO: "{message}"
+"""
+
+_IDENTIFY_TMPL = """Identifica qué pedido quiere modificar el usuario y qué cambio pide:
+
+MENSAJE DEL USUARIO: "{message}"
+
+PEDIDOS DISPONIBLES:
+{orders_json}
+
+REGLAS:
+- Solo se pueden modificar pedidos "pending" de los últimos 5 minutos
+- Si menciona un ID específico (#123), usar ese
+- Si dice "último pedido" o "pedido reciente", usar el más reciente modificable
+- Si no especifica, sugerir opciones
+
+Responde SOLO con JSON válido:
+{{
+    "target_found": true_si_identificas_pedido_específico,
+    "target_order_id": numero_o_null,
+    "requires_clarification": true_si_necesita_aclaración,
+    "suggested_orders": [lista_de_ids_sugeridos],
+    "reasoning": "explicación_breve",
+    "modification_type": "change_quantity" | "cancel_order" | "add_more" | "reduce_quantity" | "unclear",
+    "new_quantity": numero_específico_o_null,
+    "quantity_change": numero_para_sumar_o_restar_o_null,
+    "is_clear": true_si_la_instrucción_es_clara,
+    "confirmation_needed": true_si_necesita_confirmación
+}}
+
+""" + _EXAMPLES_ESCAPED
+
+class _ErrorType:
+    """Tipos de error internados: las comparaciones y lookups resuelven por identidad"""
+    STOCK = sys.intern("stock_insufficient")
+    HTTP = sys.intern("http_error")
+    GENERAL = sys.intern("general")
+
+# ✅ Respuestas de error precalculadas: cabecera y cola constantes, solo {error} varía
+_STOCK_HEAD = "❌ **No se pudo modificar el pedido**\n\n"
+_STOCK_TAIL = "\n\n¿Te interesa una cantidad menor o cancelar este pedido?"
+
+_HTTP_HEAD = "❌ **No se pudo modificar el pedido**\n\n"
+_HTTP_TAIL = "\n\n¿Querés revisar el pedido e intentar de nuevo?"
+
+_GENERIC_HEAD = "❌ **Error modificando pedido**\n\n"
+_GENERIC_TAIL = "\n\n¿Querés intentar de nuevo?"
+
+def _fmt_stock(error: str) -> str:
+    return _STOCK_HEAD + error + _STOCK_TAIL
+
+def _fmt_http(error: str) -> str:
+    return _HTTP_HEAD + error + _HTTP_TAIL
+
+def _fmt_generic(error: str) -> str:
+    return _GENERIC_HEAD + error + _GENERIC_TAIL
+
+# Tabla error_type → formateador; un tipo nuevo se registra acá sin tocar el agente
+_HANDLERS: Dict[str, Callable[[str], str]] = {
+    _ErrorType.STOCK: _fmt_stock,
+    _ErrorType.HTTP: _fmt_http,
+}
+
+@lru_cache(maxsize=256)
+def _render_modify_error(error_type: str, error: str) -> str:
+    """Respuesta de error memoizada: los mismos fallos del backend se repiten entre requests"""
+    return _HANDLERS.get(error_type, _fmt_generic)(error)
+
+class ModifyError(NamedTuple):
+    """Fallo de modificación estructurado; el markdown para el usuario se arma recién en __str__"""
+    error_type: str
+    error: str
+    
+    @classmethod
+    def from_result(cls, result: Dict) -> "ModifyError":
+        get = result.get
+        return cls(sys.intern(get("error_type", _ErrorType.GENERAL)), str(get("error", "Error desconocido")))
+    
+    def __str__(self) -> str:
+        return _render_modify_error(self.error_type, self.error)
+
+# Ventana para juntar los fallos de una misma ráfaga en un único mensaje
+ERROR_BATCH_MAX_WAIT_MS = 50
+
+_BATCH_HEADERS = {
+    _ErrorType.STOCK: "❌ **Stock insuficiente**",
+    _ErrorType.HTTP: "❌ **No se pudieron aplicar algunos cambios**",
+}
+
+def _render_error_batch(items: List[ModifyError]) -> str:
+    """Agrupa los fallos por tipo: un encabezado por grupo y un bullet por error"""
+    if not items:
+        return ""
+    if len(items) == 1:
+        return str(items[0])
+    
+    groups: Dict[str, List[str]] = {}
+    for error_type, error in items:
+        groups.setdefault(error_type, []).append(error)
+    
+    parts = []
+    for error_type, errors in groups.items():
+        parts.append(_BATCH_HEADERS.get(error_type, "❌ **Error modificando pedidos**"))
+        parts.extend(f"• {error}" for error in errors)
+        parts.append("")
+    parts.append("¿Querés revisar los pedidos e intentar de nuevo?")
+    return "\n".join(parts)
+
+_MODIFICATION_KEYS = ("modification_type", "new_quantity", "quantity_change", "is_clear", "confirmation_needed")
+
+def _modification_fields(analysis: Dict) -> Optional[Dict]:
+    """Separa la parte de modificación de la respuesta combinada (None si no la trae)"""
+    if not analysis.get("modification_type"):
+        return None
+    return {key: analysis.get(key) for key in _MODIFICATION_KEYS}
+
+def _apply_final_quantity(analysis: Dict, current_qty: int) -> Dict:
+    """Calcula final_quantity a partir del tipo de modificación y la cantidad actual"""
+    if analysis.get("modification_type") == "change_quantity":
+        analysis["final_quantity"] = analysis.get("new_quantity")
+        
+    elif analysis.get("modification_type") == "add_more":
+        if analysis.get("quantity_change"):
+            analysis["final_quantity"] = current_qty + analysis["quantity_change"]
+        elif analysis.get("new_quantity"):
+            analysis["final_quantity"] = current_qty + analysis["new_quantity"]
+            
+    elif analysis.get("modification_type") == "reduce_quantity":
+        if analysis.get("quantity_change"):
+            analysis["final_quantity"] = current_qty + analysis["quantity_change"]  # quantity_change ya es negativo
+        elif analysis.get("new_quantity"):
+            analysis["final_quantity"] = current_qty - analysis["new_quantity"]
+    
+    return analysis
+
+# ✅ Caché de intenciones por plantilla: "cambiar a 100" y "cambiar a 250" comparten la misma interpretación
+_QTY_PLACEHOLDER = "#"
+_QTY_FIELDS = ("new_quantity", "quantity_change")
+_SPACES_RE = re.compile(r'\s+')
+
+def _intent_template(message: str):
+    """(plantilla del mensaje con la cantidad reemplazada, cantidad | None si no hay exactamente un número)"""
+    text = _SPACES_RE.sub(" ", _ORDER_ID_RE.sub(" ", message.lower())).strip()
+    numbers = _NUM_RE.findall(text)
+    if len(numbers) != 1:
+        return text, None
+    return _NUM_RE.sub(_QTY_PLACEHOLDER, text), int(numbers[0])
+
+def _generalize_intent(analysis: Dict, qty: Optional[int]) -> Optional[Dict]:
+    """Versión cacheable del análisis: la cantidad del mensaje pasa a ser un placeholder (None si no encaja)"""
+    intent = {key: analysis.get(key) for key in _MODIFICATION_KEYS}
+    for field in _QTY_FIELDS:
+        value = intent.get(field)
+        if value is None:
+            continue
+        if qty is None or not isinstance(value, int) or abs(value) != qty:
+            return None
+        intent[field] = -1 if value < 0 else 1  # signo; la magnitud sale del mensaje
+    return intent
+
+def _specialize_intent(intent: Dict, qty: Optional[int]) -> Dict:
+    """Análisis concreto a partir de la plantilla cacheada y la cantidad de este mensaje"""
+    analysis = dict(intent)
+    for field in _QTY_FIELDS:
+        if analysis.get(field) is not None:
+            analysis[field] *= qty
+    return analysis
+
+def _epoch(created_at: datetime) -> float:
+    """Timestamp POSIX de created_at; si no trae timezone se asume UTC"""
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=UTC)
+    return created_at.timestamp()
+
+# ✅ Columnas del producto que viajan con el pedido: la validación no vuelve a leer el producto
+_SNAPSHOT_COLUMNS = (
+    models.Product.name, models.Product.stock,
+    models.Product.precio_50_u, models.Product.precio_100_u, models.Product.precio_200_u
+)
+
+def _product_snapshot(product_id: int, stock, p50, p100, p200) -> Optional[Dict]:
+    """Snapshot de stock y precios leído junto al pedido (None si el producto no existe)"""
+    if stock is None:
+        return None
+    product_price_cache.put(product_id, (p50, p100, p200))
+    return {"stock": stock, "precio_50_u": p50, "precio_100_u": p100, "precio_200_u": p200}
+
+def _order_to_info(order: models.Order, product_name: str, now_ts: Optional[float] = None,
+                   product_snapshot: Optional[Dict] = None) -> Dict:
+    """Arma el dict de un pedido con los minutos transcurridos y si todavía se puede modificar"""
+    # ✅ Resta de floats contra un 'ahora' tomado una vez por request (sin timedelta por pedido)
+    if now_ts is None:
+        now_ts = time.time()
+    minutes_passed = (now_ts - _epoch(order.created_at)) / 60.0
+    can_modify = minutes_passed <= 5 and order.status == "pending"
+    
+    return {
+        "id": order.id,
+        "product_name": product_name,
+        "quantity": order.qty,
+        "status": order.status,
+        "created_at": order.created_at,
+        "minutes_ago": int(minutes_passed),
+        "can_modify": can_modify,
+        "product_id": order.product_id,
+        "buyer": order.buyer,
+        "product_snapshot": product_snapshot
+    }
+
+def _fetch_user_orders(phone: str) -> List[Dict]:
+    """Carga los pedidos de los últimos 30 días del usuario con su estado de modificación"""
+    db = SessionLocal()
+    try:
+        # ✅ ARREGLAR TIMEZONE - usar timezone-aware datetime
+        recent_time = datetime.now(UTC) - timedelta(days=30)
+        
+        # ✅ Pedidos y snapshot de su producto (nombre, stock, precios) en una sola query con JOIN
+        rows = db.query(models.Order, *_SNAPSHOT_COLUMNS).outerjoin(
+            models.Product, models.Order.product_id == models.Product.id
+        ).filter(
+            models.Order.user_phone == phone,
+            models.Order.created_at >= recent_time
+        ).order_by(models.Order.created_at.desc()).limit(10).all()
+        
+        # Extraer información de pedidos para análisis
+        now_ts = time.time()
+        orders_info = [
+            _order_to_info(order, name or "Producto", now_ts, _product_snapshot(order.product_id, *snapshot))
+            for order, name, *snapshot in rows
+        ]
+        
+        return orders_info
+    finally:
+        db.close()
+
+def _fetch_user_order(order_id: int, phone: str) -> Optional[Dict]:
+    """Busca un pedido puntual del usuario (el filtro por teléfono evita tocar pedidos ajenos)"""
+    db = SessionLocal()
+    try:
+        row = db.query(models.Order, *_SNAPSHOT_COLUMNS).outerjoin(
+            models.Product, models.Order.product_id == models.Product.id
+        ).filter(
+            models.Order.id == order_id,
+            models.Order.user_phone == phone
+        ).first()
+        if not row:
+            return None
+        
+        order, name, *snapshot = row
+        return _order_to_info(order, name or "Producto", product_snapshot=_product_snapshot(order.product_id, *snapshot))
+    finally:
+        db.close()
+
+def _fetch_product(product_id: int) -> Optional[Dict]:
+    """Lee stock y precios del producto de un pedido (los precios salen de la caché si están)"""
+    db = SessionLocal()
+    try:
+        prices = product_price_cache.get(product_id)
+        if prices is not None:
+            # ✅ Solo el stock se lee fresco: una columna por PK
+            stock = db.query(models.Product.stock).filter(models.Product.id == product_id).scalar()
+            if stock is None:
+                return None
+        else:
+            row = db.query(
+                models.Product.stock, models.Product.precio_50_u, models.Product.precio_100_u, models.Product.precio_200_u
+            ).filter(models.Product.id == product_id).first()
+            if not row:
+                return None
+            stock, prices = row[0], tuple(row[1:])
+            product_price_cache.put(product_id, prices)
+        
+        return {
+            "stock": stock,
+            "precio_50_u": prices[0],
+            "precio_100_u": prices[1],
+            "precio_200_u": prices[2]
+        }
+    finally:
+        db.close()
+
+def _apply_cancel(order_id: int) -> Optional[int]:
+    """Cancela el pedido pendiente y devuelve su stock; retorna la cantidad restaurada"""
+    db = SessionLocal()
+    try:
+        return crud.cancel_order(db, order_id)
+    finally:
+        db.close()
+
+def _apply_qty_change(order_id: int, new_quantity: int) -> int:
+    """Cambia la cantidad del pedido en una transacción con bloqueo; retorna el stock resultante"""
+    db = SessionLocal()
+    try:
+        _, product = crud.change_order_quantity(db, order_id, new_quantity)
+        return product.stock
+    finally:
+        db.close()
 
 class ModifyAgent(BaseAgent):
     """Agente especializado en modificación y gestión de pedidos existentes"""
     
     def __init__(self):
         super().__init__(agent_name="ModifyAgent")
+        # ✅ Fallos pendientes por teléfono: una ráfaga de errores sale en un solo mensaje
+        self._error_buffer: Dict[str, List[ModifyError]] = {}
+        self._error_lock = asyncio.Lock()
         log(f"✏️ ModifyAgent inicializado para Ollama")
 
+    async def push_error(self, phone: str, failure: ModifyError):
+        """Encola un fallo de modificación para el próximo flush de ese usuario"""
+        async with self._error_lock:
+            self._error_buffer.setdefault(phone, []).append(failure)
+
+    async def flush_errors(self, phone: str, max_wait_ms: int = ERROR_BATCH_MAX_WAIT_MS) -> str:
+        """Espera max_wait_ms a que llegue el resto de la ráfaga y devuelve un único mensaje consolidado"""
+        await asyncio.sleep(max_wait_ms / 1000)
+        async with self._error_lock:
+            items = self._error_buffer.pop(phone, [])
+        return _render_error_batch(items)
+
     async def handle_order_modification(self, message: str, conversation: Dict) -> str:
         """Maneja modificaciones de pedidos con análisis inteligente"""
         
+        product_task = None
+        # ✅ Un solo evento estructurado por request con los tiempos de cada fase
+        phases = {}
+        outcome = "error"
+        started = mark = time.perf_counter()
         try:
-            log(f"✏️ ModifyAgent procesando: {message}")
+            # ✅ FAST PATH: "#id" + verbo claro resuelve todo sin Ollama
+            order_identification, modification_analysis = await self._explicit_order_fast_path(message, conversation)
             
             # 1. Identificar qué pedido quiere modificar
-            order_identification = await self._identify_target_order(message, conversation)
+            if order_identification is None:
+                order_identification = await self._identify_target_order(message, conversation)
+            phases["identify"], mark = time.perf_counter() - mark, time.perf_counter()
             
             if not order_identification['found']:
+                outcome = "not_found"
                 return order_identification['response']
             
+            # ✅ El producto ya vino con el pedido; si no, se precarga mientras Ollama analiza la modificación
+            snapshot = order_identification['order'].get('product_snapshot')
+            if snapshot is not None:
+                product_task = asyncio.get_running_loop().create_future()
+                product_task.set_result(snapshot)
+            else:
+                product_task = asyncio.create_task(
+                    asyncio.to_thread(_fetch_product, order_identification['order']['product_id'])
+                )
+            
             # 2. Analizar qué tipo de modificación quiere hacer
-            modification_analysis = await self._analyze_modification_type(message, order_identification)
+            if modification_analysis is None:
+                modification_analysis = await self._analyze_modification_type(message, order_identification)
+            phases["analyze"], mark = time.perf_counter() - mark, time.perf_counter()
             
             # 3. Validar que la modificación sea posible
-            validation = await self._validate_modification(modification_analysis, order_identification)
+            validation = await self._validate_modification(modification_analysis, order_identification, product_task)
+            phases["validate"], mark = time.perf_counter() - mark, time.perf_counter()
             
             if not validation['is_valid']:
+                outcome = "invalid"
                 return validation['response']
             
             # 4. Ejecutar la modificación con gestión de stock
@@ -43,307 +422,243 @@ class ModifyAgent(BaseAgent):
                 validation['modification_data'], 
                 order_identification['order']
             )
+            phases["execute"] = time.perf_counter() - mark
+            _get = execution_result.get
+            outcome = _get("action") or _get("error_type", "failed")
+            
+            # 5. Los fallos se consolidan por usuario; si otra request ya los reportó, se responde el propio
+            if not _get("success"):
+                failure = ModifyError.from_result(execution_result)
+                await self.push_error(conversation['phone'], failure)
+                return await self.flush_errors(conversation['phone']) or str(failure)
             
-            # 5. Generar respuesta natural
+            # 6. Generar respuesta natural
             response = await self._generate_modification_response(execution_result, modification_analysis)
             
             return response
             
         except Exception as e:
-            log(f"✏️❌ Error en ModifyAgent: {e}")
+            log(f"✏️❌ Error en ModifyAgent: {e}", level="ERROR")
             return "Disculpa, tuve un problema modificando tu pedido. ¿Podrías especificar qué pedido querés cambiar y cómo?"
+        finally:
+            if product_task is not None and not product_task.done():
+                product_task.cancel()
+            if log_enabled("INFO"):
+                phases["total"] = time.perf_counter() - started
+                log("✏️ modify.done", message=message, outcome=outcome,
+                    phases_ms={name: round(seconds * 1000, 1) for name, seconds in phases.items()})
+    
+    async def _explicit_order_fast_path(self, message: str, conversation: Dict):
+        """Resuelve pedido y modificación por reglas cuando el mensaje trae '#id' y un verbo claro"""
+        
+        message_lower = message.lower()
+        id_match = _ORDER_ID_RE.search(message_lower)
+        if not id_match or not _MODIFY_VERB_RE.search(message_lower):
+            return None, None
+        
+        order_id = int(id_match.group(1))
+        order_info = await asyncio.to_thread(_fetch_user_order, order_id, conversation['phone'])
+        
+        if not order_info:
+            return {
+                "found": False,
+                "response": f"No encontré el pedido #{order_id} entre tus pedidos.\n\n¿Podrías revisar el número?"
+            }, None
+        
+        if not order_info["can_modify"]:
+            return {
+                "found": False,
+                "response": f"""❌ **El pedido #{order_id} no se puede modificar**
+
+📅 Fue creado hace {order_info['minutes_ago']} minutos
+⏰ Solo se puede modificar durante los primeros 5 minutos
+
+¿Querés hacer un nuevo pedido en su lugar?"""
+            }, None
+        
+        order_identification = {
+            "found": True,
+            "order": order_info,
+            "response": f"Pedido #{order_id} identificado para modificar"
+        }
+        
+        modification_analysis = self._local_classify(message, order_info)
+        
+        log("✏️⚡ modify.fast_path", level="DEBUG", order_id=order_id, analysis=modification_analysis)
+        return order_identification, modification_analysis
     
     async def _identify_target_order(self, message: str, conversation: Dict) -> Dict:
         """Identifica qué pedido específico quiere modificar"""
         
-        # Buscar pedidos recientes del usuario
-        db = SessionLocal()
         try:
-            # ✅ ARREGLAR TIMEZONE - usar timezone-aware datetime
-            utc = pytz.UTC
-            recent_time = datetime.now(utc) - timedelta(days=30)
+            # Buscar pedidos recientes del usuario (fuera del event loop)
+            orders_info = await asyncio.to_thread(_fetch_user_orders, conversation['phone'])
             
-            user_orders = db.query(models.Order).filter(
-                models.Order.user_phone == conversation['phone'],
-                models.Order.created_at >= recent_time
-            ).order_by(models.Order.created_at.desc()).limit(10).all()
-            
-            if not user_orders:
+            if not orders_info:
                 return {
                     "found": False,
                     "response": "No encontré pedidos tuyos para modificar.\n\n¿Querés hacer un nuevo pedido?"
                 }
             
-            # Extraer información de pedidos para análisis
-            orders_info = []
-            for order in user_orders:
-                product = db.query(models.Product).filter(models.Product.id == order.product_id).first()
-                
-                # ✅ ARREGLAR CÁLCULO DE TIEMPO - manejar timezone correctly
-                if order.created_at.tzinfo is None:
-                    # Si created_at no tiene timezone, asumimos UTC
-                    order_time = utc.localize(order.created_at)
-                else:
-                    order_time = order.created_at
-                
-                now = datetime.now(utc)
-                time_passed = now - order_time
-                minutes_passed = time_passed.total_seconds() / 60
-                can_modify = minutes_passed <= 5 and order.status == "pending"
-                
-                orders_info.append({
-                    "id": order.id,
-                    "product_name": product.name if product else "Producto",
-                    "quantity": order.qty,
-                    "status": order.status,
-                    "created_at": order.created_at.isoformat(),
-                    "minutes_ago": int(minutes_passed),
-                    "can_modify": can_modify,
-                    "product_id": order.product_id,
-                    "buyer": order.buyer
-                })
-            
-            # ✅ USAR OLLAMA EN LUGAR DE GEMINI
-            prompt = f"""Identifica qué pedido quiere modificar el usuario:
-
-MENSAJE DEL USUARIO: "{message}"
-
-PEDIDOS DISPONIBLES:
-{json.dumps(orders_info, indent=2)}
-
-REGLAS:
-- Solo se pueden modificar pedidos "pending" de los últimos 5 minutos
-- Si menciona un ID específico (#123), usar ese
-- Si dice "último pedido" o "pedido reciente", usar el más reciente modificable
-- Si no especifica, sugerir opciones
-
-Responde SOLO con JSON válido:
-{{
-    "target_found": true_si_identificas_pedido_específico,
-    "target_order_id": numero_o_null,
-    "requires_clarification": true_si_necesita_aclaración,
-    "suggested_orders": [lista_de_ids_sugeridos],
-    "reasoning": "explicación_breve"
-}}"""
-
+            analysis = None
             try:
-                response = self.call_ollama([
-                    {"role": "system", "content": "Eres un asistente para modificación de pedidos textiles B2B."},
-                    {"role": "user", "content": prompt}
-                ])
-                                
-                # ✅ MEJORAR PARSING JSON
-                json_content = self._extract_json_from_response(response)
-                if json_content:
-                    analysis = json.loads(json_content)
-                    log(f"✏️🎯 Identificación de pedido: {analysis}")
-                    
-                    # Procesar resultado
-                    if analysis.get("target_found") and analysis.get("target_order_id"):
-                        target_order_id = analysis["target_order_id"]
-                        target_order = next((o for o in orders_info if o["id"] == target_order_id), None)
-                        
-                        if target_order:
-                            if not target_order["can_modify"]:
-                                return {
-                                    "found": False,
-                                    "response": f"❌ **El pedido #{target_order_id} no se puede modificar**\n\n" \
-                                              f"📅 Fue creado hace {target_order['minutes_ago']} minutos\n" \
-                                              f"⏰ Solo se puede modificar durante los primeros 5 minutos\n\n" \
-                                              f"¿Querés hacer un nuevo pedido en su lugar?"
-                                }
-                            
-                            return {
-                                "found": True,
-                                "order": target_order,
-                                "response": f"Pedido #{target_order_id} identificado para modificar"
-                            }
+                # ✅ Una sola llamada: identificación + tipo de modificación
+                analysis = await self._identify_and_analyze(message, orders_info)
+                log("✏️🎯 modify.identify", level="DEBUG", analysis=analysis)
+                
+                # Procesar resultado
+                if analysis.get("target_found") and analysis.get("target_order_id"):
+                    target_order_id = analysis["target_order_id"]
+                    target_order = next((o for o in orders_info if o["id"] == target_order_id), None)
                     
-                    elif analysis.get("requires_clarification"):
-                        # Mostrar pedidos disponibles para modificar
-                        modifiable_orders = [o for o in orders_info if o["can_modify"]]
-                        
-                        if not modifiable_orders:
+                    if target_order:
+                        if not target_order["can_modify"]:
                             return {
                                 "found": False,
-                                "response": "❌ **No tenés pedidos que se puedan modificar actualmente**\n\n" \
-                                          "Solo se pueden modificar pedidos dentro de los primeros 5 minutos.\n\n" \
-                                          "¿Querés hacer un nuevo pedido?"
+                                "response": f"""❌ **El pedido #{target_order_id} no se puede modificar**
+
+📅 Fue creado hace {target_order['minutes_ago']} minutos
+⏰ Solo se puede modificar durante los primeros 5 minutos
+
+¿Querés hacer un nuevo pedido en su lugar?"""
                             }
                         
-                        response_text = "¿Cuál de estos pedidos querés modificar?\n\n"
-                        
-                        for order in modifiable_orders:
-                            response_text += f"**#{order['id']}** - {order['product_name']}\n"
-                            response_text += f"    📦 Cantidad: {order['quantity']} unidades\n"
-                            response_text += f"    ⏰ Creado hace {order['minutes_ago']} minutos\n\n"
-                        
-                        response_text += "Decí el número de pedido que querés cambiar."
-                        
                         return {
-                            "found": False,
-                            "response": response_text,
-                            "available_orders": modifiable_orders
+                            "found": True,
+                            "order": target_order,
+                            "response": f"Pedido #{target_order_id} identificado para modificar",
+                            "modification": _modification_fields(analysis)
                         }
                 
-            except Exception as e:
-                log(f"✏️❌ Error en análisis Ollama: {e}")
-                # Fallback: usar el pedido más reciente modificable
-                modifiable_orders = [o for o in orders_info if o["can_modify"]]
-                
-                if modifiable_orders:
-                    most_recent = modifiable_orders[0]  # Ya están ordenados por fecha desc
-                    return {
-                        "found": True,
-                        "order": most_recent,
-                        "response": f"Usando tu pedido más reciente #{most_recent['id']}"
-                    }
-                else:
+                elif analysis.get("requires_clarification"):
+                    # Mostrar pedidos disponibles para modificar
+                    modifiable_orders = [o for o in orders_info if o["can_modify"]]
+                    
+                    if not modifiable_orders:
+                        return {
+                            "found": False,
+                            "response": """❌ **No tenés pedidos que se puedan modificar actualmente**
+
+Solo se pueden modificar pedidos dentro de los primeros 5 minutos.
+
+¿Querés hacer un nuevo pedido?"""
+                        }
+                    
+                    response_text = "¿Cuál de estos pedidos querés modificar?\n\n"
+                    
+                    for order in modifiable_orders:
+                        response_text += f"**#{order['id']}** - {order['product_name']}\n"
+                        response_text += f"    📦 Cantidad: {order['quantity']} unidades\n"
+                        response_text += f"    ⏰ Creado hace {order['minutes_ago']} minutos\n\n"
+                    
+                    response_text += "Decí el número de pedido que querés cambiar."
+                    
                     return {
                         "found": False,
-                        "response": "No tenés pedidos que se puedan modificar en este momento.\n\n¿Querés hacer un nuevo pedido?"
+                        "response": response_text,
+                        "available_orders": modifiable_orders
                     }
+            
+            except Exception as e:
+                log(f"✏️❌ Error en análisis Ollama: {e}", level="ERROR")
+            
+            # Fallback (error o respuesta sin decisión): usar el pedido más reciente modificable
+            modifiable_orders = [o for o in orders_info if o["can_modify"]]
+            
+            if modifiable_orders:
+                most_recent = modifiable_orders[0]  # Ya están ordenados por fecha desc
+                return {
+                    "found": True,
+                    "order": most_recent,
+                    "response": f"Usando tu pedido más reciente #{most_recent['id']}",
+                    "modification": _modification_fields(analysis) if analysis else None
+                }
+            else:
+                return {
+                    "found": False,
+                    "response": "No tenés pedidos que se puedan modificar en este momento.\n\n¿Querés hacer un nuevo pedido?"
+                }
                     
         except Exception as e:
-            log(f"✏️❌ Error identificando pedido: {e}")
+            log(f"✏️❌ Error identificando pedido: {e}", level="ERROR")
             return {
                 "found": False,
                 "response": "Tuve un problema accediendo a tus pedidos. ¿Podrías intentar de nuevo?"
             }
-        finally:
-            db.close()
 
-    def _extract_json_from_response(self, response_text: str) -> str:
-        """Extrae JSON de la respuesta de Ollama"""
-        
-        # CASO 1: Respuesta directa es JSON
-        if response_text.strip().startswith('{') and response_text.strip().endswith('}'):
-            return response_text.strip()
-        
-        # CASO 2: JSON dentro de markdown
-        if "```json" in response_text:
-            start = response_text.find("```json") + 7
-            end = response_text.find("```", start)
-            if end != -1:
-                return response_text[start:end].strip()
+    async def _identify_and_analyze(self, message: str, orders_info: List[Dict]) -> Dict:
+        """Identifica el pedido y clasifica la modificación en un único prompt"""
         
-        # CASO 3: JSON después de texto explicativo
-        first_brace = response_text.find('{')
-        last_brace = response_text.rfind('}')
-        
-        if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-            json_candidate = response_text[first_brace:last_brace + 1]
-            
-            # Verificar que sea JSON válido básico
-            if json_candidate.count('{') == json_candidate.count('}'):
-                return json_candidate
+        prompt = _IDENTIFY_TMPL.format_map({
+            "message": message,
+            "orders_json": orjson.dumps(
+                [{k: v for k, v in o.items() if k != "product_snapshot"} for o in orders_info],
+                option=orjson.OPT_INDENT_2 | orjson.OPT_NAIVE_UTC
+            ).decode(),
+        })
+
+        # La clave usa mensaje + ids (no timestamps): can_modify se revalida después
+        cache_key = self._cache_key("identify", message, *(o["id"] for o in orders_info))
+        response = await self._cached_ollama_json(cache_key, [
+            {"role": "system", "content": "Eres un asistente para modificación de pedidos textiles B2B."},
+            {"role": "user", "content": prompt}
+        ])
         
-        return None
-    
+        # ✅ format="json": la respuesta ya es JSON, parseo directo
+        return orjson.loads(response)
+
     async def _analyze_modification_type(self, message: str, order_identification: Dict) -> Dict:
         """Analiza qué tipo de modificación quiere hacer"""
         
         order_info = order_identification["order"]
         
-        prompt = f"""Analiza qué modificación quiere hacer el usuario:
-
-PEDIDO ACTUAL:
-- ID: #{order_info['id']}
-- Producto: {order_info['product_name']}
-- Cantidad actual: {order_info['quantity']} unidades
-- Estado: {order_info['status']}
-
-MENSAJE DEL USUARIO: "{message}"
-
-Responde SOLO con JSON válido:
-{{
-    "modification_type": "change_quantity" | "cancel_order" | "add_more" | "reduce_quantity" | "unclear",
-    "new_quantity": numero_específico_o_null,
-    "quantity_change": numero_para_sumar_o_restar_o_null,
-    "is_clear": true_si_la_instrucción_es_clara,
-    "confirmation_needed": true_si_necesita_confirmación,
-    "extracted_keywords": ["palabras_clave_importantes"]
-}}
+        # ✅ Si el prompt combinado ya clasificó la modificación, no hay segunda llamada
+        merged = order_identification.get("modification")
+        if merged:
+            return _apply_final_quantity(dict(merged), order_info["quantity"])
+        
+        # ✅ Mensajes obvios ("cancelar", "cambiar a 100") se resuelven sin LLM
+        local = self._local_classify(message, order_info)
+        if local:
+            log("✏️⚡ modify.local_classify", level="DEBUG", analysis=local)
+            return local
+        
+        prompt = _ANALYZE_TMPL.format_map({
+            "order_id": order_info["id"],
+            "product_name": order_info["product_name"],
+            "quantity": order_info["quantity"],
+            "status": order_info["status"],
+            "message": message,
+        })
 
-EJEMPLOS:
-- "cambiar a 100 unidades" → {{"modification_type": "change_quantity", "new_quantity": 100, "is_clear": true}}
-- "quiero 30 más" → {{"modification_type": "add_more", "quantity_change": 30, "is_clear": true}}
-- "reducir 20" → {{"modification_type": "reduce_quantity", "quantity_change": -20, "is_clear": true}}
-- "cancelar pedido" → {{"modification_type": "cancel_order", "is_clear": true}}
-- "cambiar cantidad" → {{"modification_type": "unclear", "confirmation_needed": true}}"""
+        # ✅ Mensajes con la misma forma y otra cantidad reutilizan la interpretación ya obtenida
+        template, qty = _intent_template(message)
+        intent_key = self._cache_key("analyze_intent", template)
+        intent = self._response_cache.get(intent_key)
+        if intent is not None:
+            log("✏️♻️ modify.intent_cache_hit", level="DEBUG", template=template)
+            return _apply_final_quantity(_specialize_intent(intent, qty), order_info["quantity"])
 
         try:
-            response = self.call_ollama([
-                {"role": "system", "content": "Eres un dispatcher inteligente para un sistema de ventasB2B textil."},
+            # La respuesta solo depende del mensaje: final_quantity se calcula localmente
+            cache_key = self._cache_key("analyze", message.strip().lower())
+            response = await self._cached_ollama_json(cache_key, [
+                {"role": "system", "content": _ANALYZE_SYSTEM},
                 {"role": "user", "content": prompt}
-            ])
+            ], format=_MOD_INTENT_SCHEMA)
             
-            # Limpiar y parsear respuesta
-            response_clean = self._extract_json_from_response(response)
-            if response_clean.startswith("```json"):
-                response_clean = response_clean[7:-3]
-            elif response_clean.startswith("```"):
-                response_clean = response_clean[3:-3]
+            # ✅ La respuesta viene restringida al schema: se valida directo contra ModIntent
+            analysis = schemas.ModIntent.model_validate_json(response).model_dump()
+            log("✏️🎯 modify.analyze", level="DEBUG", analysis=analysis)
             
-            analysis = json.loads(response_clean)
-            log(f"✏️🎯 Análisis de modificación: {analysis}")
+            intent = _generalize_intent(analysis, qty)
+            if intent is not None and intent.get("modification_type") not in (None, "unclear"):
+                self._response_cache[intent_key] = intent
             
-            # Calcular cantidad final
-            current_qty = order_info["quantity"]
-            
-            if analysis.get("modification_type") == "change_quantity":
-                analysis["final_quantity"] = analysis.get("new_quantity")
-                
-            elif analysis.get("modification_type") == "add_more":
-                if analysis.get("quantity_change"):
-                    analysis["final_quantity"] = current_qty + analysis["quantity_change"]
-                elif analysis.get("new_quantity"):
-                    analysis["final_quantity"] = current_qty + analysis["new_quantity"]
-                    
-            elif analysis.get("modification_type") == "reduce_quantity":
-                if analysis.get("quantity_change"):
-                    analysis["final_quantity"] = current_qty + analysis["quantity_change"]  # quantity_change ya es negativo
-                elif analysis.get("new_quantity"):
-                    analysis["final_quantity"] = current_qty - analysis["new_quantity"]
-                    
-            return analysis
+            return _apply_final_quantity(analysis, order_info["quantity"])
             
         except Exception as e:
-            log(f"✏️❌ Error analizando modificación: {e}")
-            
-            # Fallback basado en palabras clave
-            import re
-            message_lower = message.lower()
-            
-            if "cancelar" in message_lower:
-                return {"modification_type": "cancel_order", "is_clear": True}
-            
-            # Buscar números
-            numbers = re.findall(r'\d+', message)
-            if numbers:
-                new_qty = int(numbers[0])
-                
-                if "más" in message_lower or "agregar" in message_lower:
-                    return {
-                        "modification_type": "add_more",
-                        "quantity_change": new_qty,
-                        "final_quantity": order_info["quantity"] + new_qty,
-                        "is_clear": True
-                    }
-                elif "menos" in message_lower or "reducir" in message_lower:
-                    return {
-                        "modification_type": "reduce_quantity",
-                        "quantity_change": -new_qty,
-                        "final_quantity": order_info["quantity"] - new_qty,
-                        "is_clear": True
-                    }
-                else:
-                    return {
-                        "modification_type": "change_quantity",
-                        "new_quantity": new_qty,
-                        "final_quantity": new_qty,
-                        "is_clear": True
-                    }
+            log(f"✏️❌ Error analizando modificación: {e}", level="ERROR")
             
             return {
                 "modification_type": "unclear",
@@ -351,7 +666,47 @@ EJEMPLOS:
                 "confirmation_needed": True
             }
     
-    async def _validate_modification(self, modification: Dict, order_identification: Dict) -> Dict:
+    def _local_classify(self, message: str, order_info: Dict) -> Optional[Dict]:
+        """Clasifica la modificación por palabras clave y números (sin LLM); None si es ambigua"""
+        
+        # El número del pedido (#123) no debe confundirse con la cantidad
+        text = _ORDER_ID_RE.sub(" ", message.lower())
+        words = set(_WORD_RE.findall(text))
+        
+        if words & _CANCEL_WORDS:
+            return {"modification_type": "cancel_order", "is_clear": True}
+        
+        # Solo es claro si hay exactamente un número y una única dirección
+        numbers = _NUM_RE.findall(text)
+        if len(numbers) != 1:
+            return None
+        qty = int(numbers[0])
+        adds, subs = bool(words & _ADD_WORDS), bool(words & _SUB_WORDS)
+        
+        if adds and subs:
+            return None
+        if adds:
+            return {
+                "modification_type": "add_more",
+                "quantity_change": qty,
+                "final_quantity": order_info["quantity"] + qty,
+                "is_clear": True
+            }
+        if subs:
+            return {
+                "modification_type": "reduce_quantity",
+                "quantity_change": -qty,
+                "final_quantity": order_info["quantity"] - qty,
+                "is_clear": True
+            }
+        return {
+            "modification_type": "change_quantity",
+            "new_quantity": qty,
+            "final_quantity": qty,
+            "is_clear": True
+        }
+    
+    async def _validate_modification(self, modification: Dict, order_identification: Dict, product_task: asyncio.Task) -> Dict:
         """Valida que la modificación sea posible"""
         
         order_info = order_identification["order"]
@@ -361,14 +716,17 @@ EJEMPLOS:
         if not modification.get("is_clear") or modification_type == "unclear":
             return {
                 "is_valid": False,
-                "response": f"No entendí bien qué querés cambiar del pedido #{order_info['id']}.\n\n" \
-                          f"📦 **Pedido actual:** {order_info['product_name']} - {order_info['quantity']} unidades\n\n" \
-                          f"Podés decir:\n" \
-                          f"• *'Cambiar a 80 unidades'*\n" \
-                          f"• *'Agregar 20 más'*\n" \
-                          f"• *'Reducir 10 unidades'*\n" \
-                          f"• *'Cancelar pedido'*\n\n" \
-                          f"¿Qué querés hacer exactamente?"
+                "response": f"""No entendí bien qué querés cambiar del pedido #{order_info['id']}.
+
+📦 **Pedido actual:** {order_info['product_name']} - {order_info['quantity']} unidades
+
+Podés decir:
+• *'Cambiar a 80 unidades'*
+• *'Agregar 20 más'*
+• *'Reducir 10 unidades'*
+• *'Cancelar pedido'*
+
+¿Qué querés hacer exactamente?"""
             }
         
         # 2. Si es cancelación, está ok
@@ -387,26 +745,27 @@ EJEMPLOS:
         if not final_quantity or final_quantity <= 0:
             return {
                 "is_valid": False,
-                "response": f"❌ La cantidad debe ser mayor a 0.\n\n" \
-                          f"📦 **Cantidad actual:** {order_info['quantity']} unidades\n\n" \
-                          f"¿Cuántas unidades querés en total?"
+                "response": f"""❌ La cantidad debe ser mayor a 0.
+
+📦 **Cantidad actual:** {order_info['quantity']} unidades
+
+¿Cuántas unidades querés en total?"""
             }
         
         if final_quantity < 50:
             return {
                 "is_valid": False,
-                "response": f"❌ **Pedido mínimo: 50 unidades**\n\n" \
-                          f"📦 Cantidad solicitada: {final_quantity} unidades\n" \
-                          f"📦 Cantidad actual: {order_info['quantity']} unidades\n\n" \
-                          f"¿Querés ajustar a 50 unidades o cancelar el pedido?"
+                "response": f"""❌ **Pedido mínimo: 50 unidades**
+
+📦 Cantidad solicitada: {final_quantity} unidades
+📦 Cantidad actual: {order_info['quantity']} unidades
+
+¿Querés ajustar a 50 unidades o cancelar el pedido?"""
             }
         
         # 4. Validar stock disponible
-        db = SessionLocal()
         try:
-            product = db.query(models.Product).filter(
-                models.Product.id == order_info["product_id"]
-            ).first()
+            product = await product_task
             
             if not product:
                 return {
@@ -420,27 +779,25 @@ EJEMPLOS:
             
             # Si va a necesitar más stock del que actualmente reservó
             if quantity_difference > 0:
-                available_stock = product.stock
+                available_stock = product["stock"]
                 
                 if available_stock < quantity_difference:
                     return {
                         "is_valid": False,
-                        "response": f"❌ **Stock insuficiente**\n\n" \
-                                  f"📦 Cantidad actual del pedido: {current_qty} unidades\n" \
-                                  f"📦 Cantidad solicitada: {final_quantity} unidades\n" \
-                                  f"📦 Stock disponible adicional: {available_stock} unidades\n" \
-                                  f"📦 Necesitás: {quantity_difference} unidades más\n\n" \
-                                  f"**Máximo posible:** {current_qty + available_stock} unidades\n\n" \
-                                  f"¿Querés ajustar la cantidad?"
+                        "response": f"""❌ **Stock insuficiente**
+
+📦 Cantidad actual del pedido: {current_qty} unidades
+📦 Cantidad solicitada: {final_quantity} unidades
+📦 Stock disponible adicional: {available_stock} unidades
+📦 Necesitás: {quantity_difference} unidades más
+
+**Máximo posible:** {current_qty + available_stock} unidades
+
+¿Querés ajustar la cantidad?"""
                     }
             
             # Calcular precio según nueva cantidad
-            if final_quantity >= 200:
-                precio_unitario = product.precio_200_u
-            elif final_quantity >= 100:
-                precio_unitario = product.precio_100_u
-            else:
-                precio_unitario = product.precio_50_u
+            precio_unitario = unit_price(price_tuple(product), final_quantity)
             
             return {
                 "is_valid": True,
@@ -454,95 +811,113 @@ EJEMPLOS:
                     "product_name": order_info["product_name"],
                     "precio_unitario": precio_unitario,
                     "new_total": precio_unitario * final_quantity,
-                    "stock_after_change": product.stock - quantity_difference
+                    "stock_after_change": product["stock"] - quantity_difference
                 }
             }
             
         except Exception as e:
-            log(f"✏️❌ Error validando stock: {e}")
+            log(f"✏️❌ Error validando stock: {e}", level="ERROR")
             return {
                 "is_valid": False,
                 "response": "Tuve un problema verificando el stock. ¿Podrías intentar de nuevo?"
             }
-        finally:
-            db.close()
     
     async def _execute_modification_with_stock_management(self, modification_data: Dict, order_info: Dict) -> Dict:
         """Ejecuta la modificación usando el CRUD arreglado"""
         
         try:
-            if modification_data["type"] == "cancel":
-                # ✅ USAR CRUD PARA CANCELAR
-                order_update = schemas.OrderUpdate(status="cancelled")
+            match modification_data["type"]:
+                case "cancel":
+                    restored_quantity = await asyncio.to_thread(_apply_cancel, modification_data["order_id"])
                 
-                db = SessionLocal()
-                try:
-                    # Restaurar stock manualmente antes de cancelar
-                    order = db.query(models.Order).filter(models.Order.id == modification_data["order_id"]).first()
-                    product = db.query(models.Product).filter(models.Product.id == order.product_id).first()
-                    
-                    if order and product:
-                        product.stock += order.qty
-                        order.status = "cancelled"
-                        db.commit()
-                        
-                        log(f"✏️✅ Pedido #{modification_data['order_id']} cancelado")
+                    if restored_quantity is None:
                         return {
-                            "success": True,
-                            "action": "cancelled",
-                            "order_id": modification_data["order_id"],
-                            "restored_quantity": order.qty,
-                            "product_name": order_info["product_name"]
+                            "success": False,
+                            "error": f"No encontré el pedido #{modification_data['order_id']} pendiente",
+                            "error_type": _ErrorType.GENERAL
                         }
-                finally:
-                    db.close()
-                    
-            elif modification_data["type"] == "quantity_change":
-                # ✅ USAR CRUD PARA CAMBIAR CANTIDAD
-                order_update = schemas.OrderUpdate(qty=modification_data["new_quantity"])
                 
-                db = SessionLocal()
-                try:
-                    updated_order = crud.update_order(db, modification_data["order_id"], order_update)
-                    
-                    log(f"✏️✅ Pedido #{modification_data['order_id']} actualizado con CRUD")
-                    
+                    log("✏️✅ modify.cancelled", order_id=modification_data["order_id"])
                     return {
                         "success": True,
-                        "action": "quantity_changed",
+                        "action": "cancelled",
                         "order_id": modification_data["order_id"],
-                        "old_quantity": modification_data["current_quantity"],
-                        "new_quantity": modification_data["new_quantity"],
-                        "quantity_difference": modification_data["quantity_difference"],
-                        "product_name": modification_data["product_name"],
-                        "precio_unitario": modification_data["precio_unitario"],
-                        "new_total": modification_data["new_total"],
-                        "stock_after": modification_data["stock_after_change"]
+                        "restored_quantity": restored_quantity,
+                        "product_name": order_info["product_name"]
                     }
                     
-                except HTTPException as http_e:
-                    log(f"✏️❌ Error CRUD: {http_e.detail}")
+                case "quantity_change":
+                    # ✅ USAR CRUD PARA CAMBIAR CANTIDAD
+                    try:
+                        stock_after = await asyncio.to_thread(
+                            _apply_qty_change, modification_data["order_id"], modification_data["new_quantity"]
+                        )
+                    
+                        log("✏️✅ modify.quantity_changed", order_id=modification_data["order_id"], stock_after=stock_after)
+                    
+                        return {
+                            "success": True,
+                            "action": "quantity_changed",
+                            "order_id": modification_data["order_id"],
+                            "old_quantity": modification_data["current_quantity"],
+                            "new_quantity": modification_data["new_quantity"],
+                            "quantity_difference": modification_data["quantity_difference"],
+                            "product_name": modification_data["product_name"],
+                            "precio_unitario": modification_data["precio_unitario"],
+                            "new_total": modification_data["new_total"],
+                            "stock_after": stock_after
+                        }
+                    
+                    except HTTPException as http_e:
+                        log(f"✏️❌ Error CRUD: {http_e.detail}", level="ERROR")
+                        return {
+                            "success": False,
+                            "error": http_e.detail,
+                            "error_type": _ErrorType.STOCK if "stock insuficiente" in str(http_e.detail).lower() else _ErrorType.HTTP
+                        }
+            
+                case _:
                     return {
                         "success": False,
-                        "error": http_e.detail,
-                        "error_type": "crud_error"
+                        "error": f"Tipo de modificación no soportado: {modification_data['type']}"
                     }
-                finally:
-                    db.close()
-            
-            else:
-                return {
-                    "success": False,
-                    "error": f"Tipo de modificación no soportado: {modification_data['type']}"
-                }
                 
         except Exception as e:
-            log(f"✏️❌ Error ejecutando modificación: {e}")
+            log(f"✏️❌ Error ejecutando modificación: {e}", level="ERROR")
             return {
                 "success": False,
                 "error": str(e),
-                "error_type": "general"
+                "error_type": _ErrorType.GENERAL
             }
+    
+    async def _generate_modification_response(self, result: Dict, modification: Dict) -> str:
+        """Genera respuesta sobre el resultado de la modificación"""
+        
+        if not result.get("success"):
+            return str(ModifyError.from_result(result))
+        
+        if result["action"] == "cancelled":
+            return f"""✅ **Pedido #{result['order_id']} CANCELADO**
+
+♻️ Stock restaurado: **+{result['restored_quantity']:,} unidades**
+
+¿Querés hacer un nuevo pedido?"""
+        
+        # ✅ Partes en lista y un solo join (sin += encadenados)
+        difference = result["quantity_difference"]
+        parts = [
+            f"✅ **PEDIDO #{result['order_id']} MODIFICADO**\n\n",
+            f"👕 Producto: **{result['product_name']}**\n",
+            f"📦 Cantidad anterior: **{result['old_quantity']:,} unidades**\n",
+            f"📦 Nueva cantidad: **{result['new_quantity']:,} unidades** ({difference:+,})\n",
+            f"💰 Precio unitario: **${result['precio_unitario']:,.0f}**\n",
+            f"💸 **Nuevo total: ${result['new_total']:,.0f}**\n\n",
+            f"📊 Stock restante: **{result['stock_after']:,} unidades**\n\n",
+            "¡Cambio realizado exitosamente! 🎉",
+        ]
+        return "".join(parts)
 
-# Instancia global
-modify_agent = ModifyAgent()
\ No newline at end of file
+# ✅ Instancia global perezosa: se construye en el primer uso, no al importar
+@cache
+def get_modify_agent() -> ModifyAgent:
+    return ModifyAgent()
@@ -1,24 +1,492 @@
-from typing import Dict, List, Optional
+import asyncio
+from enum import IntEnum
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models, crud, schemas
-import json
+import orjson
 import os
 from dotenv import load_dotenv
 import time
 from fastapi import HTTPException
 import re
 from .base_agent import BaseAgent
+from ..utils.ollama_client import OLLAMA_CLASSIFIER_MODEL
+from ..product_index import product_index
+from ..utils.pricing import price_tuple, unit_price
 
 # Cargar variables de entorno
 load_dotenv()
 
+# ✅ Preámbulos fijos (taxonomía, esquema y ejemplos) como system prompt constante:
+# el prefijo es idéntico en cada request y Ollama reutiliza su KV cache en lugar de reprocesarlo
+_ORDER_ANALYZE_SYSTEM = """Eres un dispatcher inteligente para un sistema de ventasB2B textil.
+Analiza la solicitud de pedido del usuario y extrae la información del producto y cantidad.
+
+Tipos de producto disponibles: pantalón, camiseta, falda, sudadera, camisa
+Colores disponibles: blanco, negro, azul, verde, gris, rojo, amarillo
+Talles disponibles: S, M, L, XL, XXL
+
+Responde SOLO con JSON válido:
+{
+    "has_product_info": true_si_especifica_tipo_prenda,
+    "has_quantity": true_si_especifica_cantidad,
+    "needs_context": true_si_debe_usar_productos_del_contexto,
+    "product_filters": {
+        "tipo_prenda": "pantalón|camiseta|falda|sudadera|camisa|null",
+        "color": "blanco|negro|azul|verde|gris|rojo|amarillo|null",
+        "talla": "S|M|L|XL|XXL|null"
+    },
+    "quantity": numero_o_null,
+    "urgency": "normal|urgent|flexible",
+    "special_requirements": "texto_con_requisitos_especiales_o_null",
+    "context_completion": {
+        "use_last_shown_product": true_si_debe_usar_ultimo_producto_mostrado,
+        "use_conversation_context": true_si_necesita_contexto_general
+    }
+}
+
+EJEMPLOS:
+- "quiero 50 camisetas rojas talle M" → {"has_product_info": true, "has_quantity": true, "product_filters": {"tipo_prenda": "camiseta", "color": "rojo", "talla": "M"}, "quantity": 50}
+- "necesito 100 unidades" (contexto: viendo pantalones azules L) → {"has_quantity": true, "needs_context": true, "quantity": 100, "context_completion": {"use_conversation_context": true}}
+- "haceme el pedido" (contexto: viendo sudaderas negras XL) → {"needs_context": true, "context_completion": {"use_last_shown_product": true}}
+- "quiero comprar para construcción, 80 unidades de lo azul en L" → {"has_quantity": true, "product_filters": {"color": "azul", "talla": "L"}, "quantity": 80, "special_requirements": "para construcción"}"""
+
+_MODIFICATION_ANALYZE_SYSTEM = """Eres un dispatcher inteligente para un sistema de ventasB2B textil.
+Analiza la solicitud de modificación de pedido del usuario.
+
+Responde SOLO con JSON válido:
+{
+    "modification_type": "change_quantity" | "cancel_order" | "add_more" | "reduce_quantity",
+    "new_quantity": numero_o_null,
+    "is_clear": true_si_la_instruccion_es_clara,
+    "needs_confirmation": true_si_necesita_confirmacion_adicional
+}
+
+EJEMPLOS:
+- "cambiar a 80 unidades" → {"modification_type": "change_quantity", "new_quantity": 80, "is_clear": true}
+- "quiero 20 más" → {"modification_type": "add_more", "new_quantity": 20, "is_clear": true}
+- "reducir a la mitad" → {"modification_type": "reduce_quantity", "new_quantity": null, "needs_confirmation": true}
+- "cancelar pedido" → {"modification_type": "cancel_order", "is_clear": true}"""
+
+# Esquemas JSON para la salida estructurada de Ollama (format=schema)
+_NULLABLE_STRING = {"type": ["string", "null"]}
+ORDER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "has_product_info": {"type": "boolean"},
+        "has_quantity": {"type": "boolean"},
+        "needs_context": {"type": "boolean"},
+        "product_filters": {
+            "type": "object",
+            "properties": {
+                "tipo_prenda": {"type": ["string", "null"], "enum": ["pantalón", "camiseta", "falda", "sudadera", "camisa", None]},
+                "color": {"type": ["string", "null"], "enum": ["blanco", "negro", "azul", "verde", "gris", "rojo", "amarillo", None]},
+                "talla": {"type": ["string", "null"], "enum": ["S", "M", "L", "XL", "XXL", None]}
+            },
+            "required": ["tipo_prenda", "color", "talla"]
+        },
+        "quantity": {"type": ["integer", "null"]},
+        "urgency": {"type": "string", "enum": ["normal", "urgent", "flexible"]},
+        "special_requirements": _NULLABLE_STRING,
+        "context_completion": {
+            "type": "object",
+            "properties": {
+                "use_last_shown_product": {"type": "boolean"},
+                "use_conversation_context": {"type": "boolean"}
+            },
+            "required": ["use_last_shown_product", "use_conversation_context"]
+        }
+    },
+    "required": ["has_product_info", "has_quantity", "needs_context", "product_filters", "quantity"]
+}
+
+MODIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "modification_type": {"type": "string", "enum": ["change_quantity", "cancel_order", "add_more", "reduce_quantity"]},
+        "new_quantity": {"type": ["integer", "null"]},
+        "is_clear": {"type": "boolean"},
+        "needs_confirmation": {"type": "boolean"}
+    },
+    "required": ["modification_type", "new_quantity", "is_clear"]
+}
+
+# ✅ Micro-batching de análisis: los pedidos que llegan juntos comparten un solo request a Ollama
+ANALYSIS_BATCH_MAX = 8
+ANALYSIS_BATCH_WINDOW = 0.025
+
+ORDER_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": ORDER_SCHEMA}},
+    "required": ["results"]
+}
+
+class _AnalysisBatcher:
+    """Junta hasta ANALYSIS_BATCH_MAX prompts en una ventana de ANALYSIS_BATCH_WINDOW y los resuelve en una llamada"""
+    
+    def __init__(self, agent: "OrderAgent"):
+        self._agent = agent
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight = set()
+    
+    async def submit(self, prompt: str) -> str:
+        """Encola el prompt y espera su JSON (como string) cuando se despacha el lote"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + ANALYSIS_BATCH_WINDOW
+            while len(batch) < ANALYSIS_BATCH_MAX:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # El despacho corre aparte: el próximo lote puede juntarse mientras Ollama responde
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+    
+    async def _dispatch(self, batch):
+        prompts = [prompt for prompt, _ in batch]
+        try:
+            if len(batch) == 1:
+                results = [await self._agent._call_analysis(_ORDER_ANALYZE_SYSTEM, prompts[0], ORDER_SCHEMA)]
+            else:
+                results = await self._dispatch_many(prompts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    
+    async def _dispatch_many(self, prompts: List[str]) -> List[str]:
+        """Un solo request con todas las solicitudes; si el array no cuadra, se resuelve una por una"""
+        sections = "\n\n".join(f"### SOLICITUD {i}\n{prompt}" for i, prompt in enumerate(prompts, 1))
+        batch_prompt = (
+            f"Analiza CADA una de estas {len(prompts)} solicitudes de pedido por separado. "
+            f"Responde con {{\"results\": [...]}}: un análisis por solicitud, en el mismo orden.\n\n{sections}"
+        )
+        try:
+            response = await self._agent._call_analysis(_ORDER_ANALYZE_SYSTEM, batch_prompt, ORDER_BATCH_SCHEMA)
+            results = orjson.loads(response)["results"]
+            if len(results) == len(prompts):
+                print(f"🛒📦 Lote de {len(prompts)} análisis resuelto en un request")
+                return [orjson.dumps(result).decode() for result in results]
+        except Exception as e:
+            print(f"🛒❌ Error en análisis por lote: {e}")
+        
+        return await asyncio.gather(*(
+            self._agent._call_analysis(_ORDER_ANALYZE_SYSTEM, prompt, ORDER_SCHEMA) for prompt in prompts
+        ))
+
+class ErrorType(IntEnum):
+    """Tipo de error de un resultado de pedido: comparación entera en lugar de buscar texto en el detalle"""
+    GENERAL = 0
+    STOCK_INSUFFICIENT = 1
+
+def _http_error_type(detail) -> ErrorType:
+    """Clasifica una HTTPException del CRUD (camino frío: el stock se verifica antes)"""
+    return ErrorType.STOCK_INSUFFICIENT if "stock" in str(detail).lower() else ErrorType.GENERAL
+
+# ✅ Modificaciones concurrentes: una transacción por lote que toca cada producto una sola vez
+MODIFICATION_BATCH_MAX = 32
+MODIFICATION_BATCH_WINDOW = 0.005
+
+def _modification_order(item) -> tuple:
+    """Cancelaciones primero y luego de menor a mayor delta: lo que devuelve stock va antes de lo que consume"""
+    order_info, modification, _ = item
+    if modification.get("modification_type") == "cancel_order":
+        return (0, order_info["product_id"], 0)
+    delta = (modification.get("final_quantity") or order_info["current_qty"]) - order_info["current_qty"]
+    return (1, delta, order_info["product_id"])
+
+class _ModificationBatcher:
+    """Junta modificaciones en una ventana corta y las aplica en una transacción, con un savepoint por pedido"""
+    
+    def __init__(self, agent: "OrderAgent"):
+        self._agent = agent
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight = set()
+    
+    async def submit(self, order_info: Dict, modification: Dict) -> Dict:
+        """Encola la modificación y espera su resultado cuando se aplica el lote"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((order_info, modification, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + MODIFICATION_BATCH_WINDOW
+            while len(batch) < MODIFICATION_BATCH_MAX:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+    
+    async def _dispatch(self, batch):
+        batch = sorted(batch, key=_modification_order)
+        try:
+            results = await asyncio.to_thread(self._apply_batch, batch)
+        except Exception as e:
+            print(f"🛒✏️❌ Error aplicando lote de modificaciones: {e}")
+            results = [{"success": False, "error": str(e), "error_type": ErrorType.GENERAL}] * len(batch)
+        
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    
+    def _apply_batch(self, batch) -> List[Dict]:
+        db = SessionLocal()
+        try:
+            # Bloquear todos los productos del lote de una vez, en orden de id (sin deadlocks entre lotes);
+            # el stock leído bajo el lock se va actualizando a medida que se aplica el lote
+            product_ids = sorted({order_info["product_id"] for order_info, _, _ in batch})
+            stock = dict(db.execute(
+                select(models.Product.id, models.Product.stock).where(models.Product.id.in_(product_ids))
+                .order_by(models.Product.id).with_for_update()
+            ).all())
+            
+            results = []
+            for order_info, modification, _ in batch:
+                product_id = order_info["product_id"]
+                
+                # ✅ Pre-chequeo de stock: el caso común de falta de stock no llega a lanzar HTTPException
+                needed = (modification.get("final_quantity") or 0) - order_info["current_qty"]
+                if modification.get("modification_type") != "cancel_order" and needed > stock.get(product_id, 0):
+                    results.append({
+                        "success": False,
+                        "error": f"Stock insuficiente. Disponible: {stock.get(product_id, 0)}, necesario: {needed}",
+                        "error_type": ErrorType.STOCK_INSUFFICIENT
+                    })
+                    continue
+                
+                # Un fallo (fuera de tiempo, pedido no pendiente) solo deshace su propio savepoint
+                savepoint = db.begin_nested()
+                result = self._agent._execute_order_modification_sync(order_info, modification, db, commit=False)
+                if result.get("success"):
+                    savepoint.commit()
+                    if result["action"] == "modified":
+                        stock[product_id] = result["stock_after"]
+                    else:
+                        stock[product_id] = stock.get(product_id, 0) + result["restored_quantity"]
+                else:
+                    savepoint.rollback()
+                results.append(result)
+            
+            db.commit()
+            if len(batch) > 1:
+                print(f"🛒✏️📦 Lote de {len(batch)} modificaciones aplicado en una transacción")
+            return results
+        finally:
+            db.close()
+
+_PUNCT_RE = re.compile(r'[^\w\s]')
+_SPACES_RE = re.compile(r'\s+')
+
+def _normalize_message(message: str) -> str:
+    """Normaliza el mensaje para la caché: minúsculas, sin puntuación ni espacios repetidos"""
+    return _SPACES_RE.sub(" ", _PUNCT_RE.sub(" ", message.lower())).strip()
+
+# ✅ Extractor por regex precompilado: una pasada por patrón, grupos con nombre → valor canónico
+_TIPO_RE = re.compile(
+    r'\b(?:(?P<pantalon>pantal[oó]n(?:es)?)|(?P<camiseta>camisetas?)|(?P<sudadera>sudaderas?|buzos?)'
+    r'|(?P<camisa>camisas?)|(?P<falda>faldas?))\b',
+    re.IGNORECASE
+)
+_TIPO_CANONICAL = {"pantalon": "pantalón", "camiseta": "camiseta", "sudadera": "sudadera", "camisa": "camisa", "falda": "falda"}
+_COLOR_RE = re.compile(
+    r'\b(?:(?P<blanco>blanc[oa]s?)|(?P<negro>negr[oa]s?)|(?P<azul>azul(?:es)?)|(?P<verde>verdes?)'
+    r'|(?P<gris>gris(?:es)?)|(?P<rojo>roj[oa]s?)|(?P<amarillo>amarill[oa]s?))\b',
+    re.IGNORECASE
+)
+_TALLA_RE = re.compile(r'\btall[ae]\s+(XXL|XL|S|M|L)\b', re.IGNORECASE)
+_QTY_RE = re.compile(r'\b(\d+)\b')
+
+# Vocabulario para completar filtros desde el contexto: token → valor canónico
+_TOKEN_RE = re.compile(r'\w+')
+_STOCK_RE = re.compile(r'stock', re.IGNORECASE)
+_TIPO_MAP = {
+    "pantalón": "pantalón", "pantalon": "pantalón", "pantalones": "pantalón",
+    "camiseta": "camiseta", "camisetas": "camiseta",
+    "sudadera": "sudadera", "sudaderas": "sudadera", "buzo": "sudadera", "buzos": "sudadera",
+    "camisa": "camisa", "camisas": "camisa",
+    "falda": "falda", "faldas": "falda",
+}
+_COLORS = frozenset(("blanco", "negro", "azul", "verde", "gris", "rojo", "amarillo"))
+_COLOR_MAP = {color: color for color in _COLORS}
+_COLOR_MAP.update({
+    "blanca": "blanco", "blancos": "blanco", "blancas": "blanco",
+    "negra": "negro", "negros": "negro", "negras": "negro",
+    "azules": "azul", "verdes": "verde", "grises": "gris",
+    "roja": "rojo", "rojos": "rojo", "rojas": "rojo",
+    "amarilla": "amarillo", "amarillos": "amarillo", "amarillas": "amarillo",
+})
+
+_TALLAS = frozenset(("S", "M", "L", "XL", "XXL"))
+_TALLA_WORDS = frozenset(("talle", "talla"))
+
+@lru_cache(maxsize=256)
+def _scan_context(text: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Una sola pasada de tokens sobre el texto: primer (tipo_prenda, color, talla) mencionado.
+    Cacheado por contenido: los mismos mensajes del bot se re-escanean en cada turno de la conversación.
+    """
+    tipo = color = talla = None
+    previous = ""
+    for token in _TOKEN_RE.findall(text.lower()):
+        if tipo is None and token in _TIPO_MAP:
+            tipo = _TIPO_MAP[token]
+        elif color is None and token in _COLOR_MAP:
+            color = _COLOR_MAP[token]
+        elif talla is None and previous in _TALLA_WORDS and token.upper() in _TALLAS:
+            talla = token.upper()
+        previous = token
+    return tipo, color, talla
+
+def _regex_order_analysis(message: str) -> Dict:
+    """Extrae prenda, color, talle y cantidad por regex con el mismo formato que el análisis LLM"""
+    tipo_match = _TIPO_RE.search(message)
+    color_match = _COLOR_RE.search(message)
+    talla_match = _TALLA_RE.search(message)
+    quantity_match = _QTY_RE.search(message)
+    
+    tipo_prenda = _TIPO_CANONICAL[tipo_match.lastgroup] if tipo_match else None
+    quantity = int(quantity_match.group(1)) if quantity_match else None
+    
+    return {
+        "has_product_info": tipo_prenda is not None,
+        "has_quantity": quantity is not None,
+        "needs_context": tipo_prenda is None and quantity is not None,
+        "product_filters": {
+            "tipo_prenda": tipo_prenda,
+            "color": color_match.lastgroup if color_match else None,
+            "talla": talla_match.group(1).upper() if talla_match else None
+        },
+        "quantity": quantity,
+        "urgency": "normal",
+        "special_requirements": None,
+        "context_completion": {
+            "use_last_shown_product": not tipo_prenda,
+            "use_conversation_context": True
+        }
+    }
+
+# ✅ Fast path de modificaciones: palabras clave precompiladas, el LLM solo ve los mensajes ambiguos
+_MOD_CANCEL_RE = re.compile(r'\b(?:cancel|anul|borr)', re.IGNORECASE)
+_MOD_ADD_RE = re.compile(r'\b(?:sum[aá]|agreg|m[aá]s\b|añad)', re.IGNORECASE)
+_MOD_REDUCE_RE = re.compile(r'\b(?:reduc|menos\b|bajar|baj[aá]|quit)', re.IGNORECASE)
+_MOD_DOUBLE_RE = re.compile(r'\b(?:doble|duplic)', re.IGNORECASE)
+_MOD_HALF_RE = re.compile(r'\bmitad\b', re.IGNORECASE)
+
+def _regex_modification_analysis(message: str, current_qty: int) -> Optional[Dict]:
+    """Clasifica la modificación por palabras clave; None si el mensaje es ambiguo"""
+    if _MOD_CANCEL_RE.search(message):
+        return {"modification_type": "cancel_order", "is_clear": True}
+    if _MOD_DOUBLE_RE.search(message):
+        return {"modification_type": "change_quantity", "new_quantity": current_qty * 2,
+                "final_quantity": current_qty * 2, "is_clear": True}
+    if _MOD_HALF_RE.search(message):
+        return {"modification_type": "reduce_quantity", "final_quantity": current_qty // 2, "is_clear": True}
+    
+    # Con cantidades solo es claro si hay exactamente un número y una única dirección
+    numbers = _QTY_RE.findall(message)
+    if len(numbers) != 1:
+        return None
+    qty = int(numbers[0])
+    adds, reduces = bool(_MOD_ADD_RE.search(message)), bool(_MOD_REDUCE_RE.search(message))
+    if adds and reduces:
+        return None
+    if adds:
+        return {"modification_type": "add_more", "new_quantity": qty, "final_quantity": current_qty + qty, "is_clear": True}
+    if reduces:
+        return {"modification_type": "reduce_quantity", "new_quantity": qty, "final_quantity": current_qty - qty, "is_clear": True}
+    return {"modification_type": "change_quantity", "new_quantity": qty, "final_quantity": qty, "is_clear": True}
+
+_PRODUCT_FIELDS = ("id", "name", "stock", "precio_50_u", "precio_100_u", "precio_200_u")
+
+def _load_order_candidates(db, product_filters: Dict, quantity: int):
+    """
+    Resuelve los filtros con el ProductIndex y verifica stock con queries por PK.
+    El producto elegido queda bloqueado (FOR UPDATE) hasta que la transacción del pedido termine.
+    Devuelve (producto_con_stock | None, hasta 3 alternativas del mismo tipo).
+    """
+    ids = product_index.lookup(product_filters.get("tipo_prenda"), product_filters.get("color"), product_filters.get("talla"))
+    columns = [getattr(models.Product, field) for field in _PRODUCT_FIELDS]
+    
+    if ids:
+        row = db.query(*columns).filter(
+            models.Product.id.in_(ids), models.Product.stock >= quantity
+        ).order_by(models.Product.id).limit(1).with_for_update().first()
+        if row:
+            return dict(zip(_PRODUCT_FIELDS, row)), []
+    
+    similar_ids = product_index.lookup(product_filters.get("tipo_prenda"))
+    if not similar_ids:
+        return None, []
+    rows = db.query(*columns).filter(
+        models.Product.id.in_(similar_ids), models.Product.stock > 0
+    ).order_by(models.Product.id).limit(3).all()
+    return None, [dict(zip(_PRODUCT_FIELDS, row)) for row in rows]
+
+# ✅ Respuestas de modificación como plantillas constantes: una sola llamada a format_map por respuesta
+_TPL_CANCELLED = (
+    "✅ **Pedido #{order_id} CANCELADO**\n\n"
+    "♻️ Stock restaurado: **+{restored_quantity} unidades**\n\n"
+    "¿Querés hacer un nuevo pedido?"
+)
+_TPL_MODIFIED = (
+    "✅ **PEDIDO #{order_id} MODIFICADO**\n\n"
+    "📦 Cantidad anterior: **{old_quantity} unidades**\n"
+    "📦 Nueva cantidad: **{new_quantity} unidades**\n"
+    "💰 Precio unitario: **${precio_unitario:,.0f}**\n"
+    "💸 **Nuevo total: ${new_total:,.0f}**\n\n"
+    "📊 Stock restante: **{stock_after} unidades**\n\n"
+    "¡Cambio realizado exitosamente! 🎉"
+)
+_TPL_STOCK_ERR = "❌ **No se pudo modificar el pedido**\n\n{error}\n\n¿Te interesa una cantidad menor o cancelar este pedido?"
+_TPL_GENERIC_ERR = "❌ **Error modificando pedido**\n\n{error}\n\n¿Querés intentar de nuevo?"
+_TPL_BY_ACTION = {"cancelled": _TPL_CANCELLED, "modified": _TPL_MODIFIED}
+
 class OrderAgent(BaseAgent):
     """Agente especializado en creación y gestión de pedidos"""
     
     def __init__(self):
         super().__init__(agent_name="OrderAgent")
+        self._analysis_batcher = _AnalysisBatcher(self)
+        self._modification_batcher = _ModificationBatcher(self)
         print(f"🛒 OrderAgent inicializado")
 
     async def handle_order_creation(self, message: str, conversation: Dict) -> str:
@@ -28,16 +496,25 @@ class OrderAgent(BaseAgent):
             print(f"🛒 OrderAgent procesando: {message}")
             
             # 1. Analizar qué producto y cantidad quiere el usuario
-            order_analysis = await self._analyze_order_request(message, conversation)
-            
-            # 2. Validar que la información sea suficiente
-            validation = await self._validate_order_data(order_analysis, conversation)
-            
-            if not validation['is_valid']:
-                return validation['response']
+            #    ✅ mientras tanto se asegura el índice de productos (la carga queda oculta tras el LLM)
+            order_analysis, _ = await asyncio.gather(
+                self._analyze_order_request(message, conversation),
+                asyncio.to_thread(product_index.ensure_loaded)
+            )
             
-            # ✅ 3. Crear el pedido en la base de datos (PASAR VALIDATION, NO ANALYSIS)
-            order_result = await self._create_order_in_db(validation, conversation['phone'])
+            # ✅ Validación y alta comparten sesión y transacción: el stock verificado queda bloqueado hasta el commit
+            db = SessionLocal()
+            try:
+                # 2. Validar que la información sea suficiente
+                validation = await self._validate_order_data(order_analysis, conversation, db)
+                
+                if not validation['is_valid']:
+                    return validation['response']
+                
+                # ✅ 3. Crear el pedido en la base de datos (PASAR VALIDATION, NO ANALYSIS)
+                order_result = await self._create_order_in_db(validation, conversation['phone'], db)
+            finally:
+                db.close()
             
             # 4. Generar respuesta natural
             response = await self._generate_order_response(order_result, order_analysis)
@@ -51,71 +528,35 @@ class OrderAgent(BaseAgent):
     async def _analyze_order_request(self, message: str, conversation: Dict) -> Dict:
         """Analiza el mensaje para extraer información del pedido"""
         
-        # Extraer contexto de la conversación
-        recent_messages = ""
-        for msg in conversation.get('messages', [])[-5:]:  # Últimos 5 mensajes
-            role = "Usuario" if msg['role'] == 'user' else "Bot"
-            recent_messages += f"{role}: {msg['content']}\n"
+        # ✅ FAST PATH: prenda + una sola cantidad se extraen por regex, sin Ollama
+        analysis = _regex_order_analysis(message)
+        if analysis["has_product_info"] and analysis["has_quantity"] and len(_QTY_RE.findall(message)) == 1:
+            print(f"🛒⚡ Análisis por regex: {analysis}")
+            return analysis
+        
+        # Extraer contexto de la conversación (join en lugar de concatenar en el loop)
+        recent_messages = "".join(
+            f"{'Usuario' if msg['role'] == 'user' else 'Bot'}: {msg['content']}\n"
+            for msg in conversation.get('messages', [])[-5:]  # Últimos 5 mensajes
+        )
         
         # Productos vistos recientemente
         recent_products = ""
         if conversation.get('recent_searches'):
-            recent_products = "Productos mostrados recientemente:\n"
-            for search in conversation.get('recent_searches', [])[:3]:
-                recent_products += f"- {search['content'][:100]}...\n"
+            recent_products = "Productos mostrados recientemente:\n" + "".join(
+                f"- {search['content'][:100]}...\n" for search in conversation['recent_searches'][:3]
+            )
         
-        prompt = f"""Analiza esta solicitud de pedido y extrae la información del producto y cantidad:
-
-CONVERSACIÓN RECIENTE:
-{recent_messages}
-
-{recent_products}
-
-MENSAJE ACTUAL: "{message}"
-
-Tipos de producto disponibles: pantalón, camiseta, falda, sudadera, camisa
-Colores disponibles: blanco, negro, azul, verde, gris, rojo, amarillo
-Talles disponibles: S, M, L, XL, XXL
-
-Responde SOLO con JSON válido:
-{{
-    "has_product_info": true_si_especifica_tipo_prenda,
-    "has_quantity": true_si_especifica_cantidad,
-    "needs_context": true_si_debe_usar_productos_del_contexto,
-    "product_filters": {{
-        "tipo_prenda": "pantalón|camiseta|falda|sudadera|camisa|null",
-        "color": "blanco|negro|azul|verde|gris|rojo|amarillo|null",
-        "talla": "S|M|L|XL|XXL|null"
-    }},
-    "quantity": numero_o_null,
-    "urgency": "normal|urgent|flexible",
-    "special_requirements": "texto_con_requisitos_especiales_o_null",
-    "context_completion": {{
-        "use_last_shown_product": true_si_debe_usar_ultimo_producto_mostrado,
-        "use_conversation_context": true_si_necesita_contexto_general
-    }}
-}}
-
-EJEMPLOS:
-- "quiero 50 camisetas rojas talle M" → {{"has_product_info": true, "has_quantity": true, "product_filters": {{"tipo_prenda": "camiseta", "color": "rojo", "talla": "M"}}, "quantity": 50}}
-- "necesito 100 unidades" (contexto: viendo pantalones azules L) → {{"has_quantity": true, "needs_context": true, "quantity": 100, "context_completion": {{"use_conversation_context": true}}}}
-- "haceme el pedido" (contexto: viendo sudaderas negras XL) → {{"needs_context": true, "context_completion": {{"use_last_shown_product": true}}}}
-- "quiero comprar para construcción, 80 unidades de lo azul en L" → {{"has_quantity": true, "product_filters": {{"color": "azul", "talla": "L"}}, "quantity": 80, "special_requirements": "para construcción"}}"""
+        # ✅ Solo la parte variable se formatea por request: el preámbulo fijo es el system prompt constante.
+        # El mensaje va serializado como JSON para que sus comillas no rompan el prompt
+        prompt = f"CONVERSACIÓN RECIENTE:\n{recent_messages}\n\n{recent_products}\n\nMENSAJE ACTUAL: {orjson.dumps(message).decode()}\n"
 
         try:
-            response = self.call_ollama([
-                {"role": "system", "content": "Eres un dispatcher inteligente para un sistema de ventasB2B textil."},
-                {"role": "user", "content": prompt}
-            ])
-            
-            # Limpiar y parsear respuesta
-            response_clean = self._extract_json_from_response(response)
-            if response_clean.startswith("```json"):
-                response_clean = response_clean[7:-3]
-            elif response_clean.startswith("```"):
-                response_clean = response_clean[3:-3]
-            
-            parsed_analysis = json.loads(response_clean)
+            # ✅ Mensajes repetidos ("quiero 100 camisetas negras M") con el mismo contexto de productos no vuelven a Ollama
+            cache_key = self._cache_key("order_analysis", _normalize_message(message), recent_products)
+            response_clean = await self._cached_analysis(cache_key, _ORDER_ANALYZE_SYSTEM, prompt, ORDER_SCHEMA, batched=True)
+            
+            parsed_analysis = orjson.loads(response_clean)
             print(f"🛒🎯 Análisis de pedido: {parsed_analysis}")
             
             return parsed_analysis
@@ -124,60 +565,34 @@ EJEMPLOS:
             print(f"🛒❌ Error analizando pedido: {e}")
             
             # Fallback basado en palabras clave
-            message_lower = message.lower()
-            
-            # Detectar cantidad
-            quantity = None
-            import re
-            quantity_match = re.search(r'\b(\d+)\b', message)
-            if quantity_match:
-                quantity = int(quantity_match.group(1))
-            
-            # Detectar tipo de prenda
-            tipo_prenda = None
-            for tipo in ["pantalón", "pantalones", "camiseta", "camisetas", "sudadera", "buzos", "camisa", "camisas", "falda", "faldas"]:
-                if tipo in message_lower:
-                    if tipo in ["pantalones", "pantalón"]:
-                        tipo_prenda = "pantalón"
-                    elif tipo in ["buzos"]:
-                        tipo_prenda = "sudadera"
-                    else:
-                        tipo_prenda = tipo.rstrip('s')
-                    break
-            
-            # Detectar color
-            color = None
-            for c in ["azul", "negro", "blanco", "verde", "rojo", "amarillo", "gris"]:
-                if c in message_lower:
-                    color = c
-                    break
-            
-            # Detectar talla
-            talla = None
-            for t in ["S", "M", "L", "XL", "XXL"]:
-                if f"talle {t.lower()}" in message_lower or f"talla {t.lower()}" in message_lower:
-                    talla = t
-                    break
-            
-            return {
-                "has_product_info": tipo_prenda is not None,
-                "has_quantity": quantity is not None,
-                "needs_context": tipo_prenda is None and quantity is not None,
-                "product_filters": {
-                    "tipo_prenda": tipo_prenda,
-                    "color": color,
-                    "talla": talla
-                },
-                "quantity": quantity,
-                "urgency": "normal",
-                "special_requirements": None,
-                "context_completion": {
-                    "use_last_shown_product": not tipo_prenda,
-                    "use_conversation_context": True
-                }
-            }
+            return _regex_order_analysis(message)
+    
+    async def _call_analysis(self, system_prompt: str, prompt: str, schema: Dict) -> str:
+        """Llama a Ollama con salida restringida al esquema y valida que sea JSON"""
+        # ✅ Structured outputs: Ollama decodifica directamente contra el JSON schema (sin fences ni texto extra)
+        response = await self.call_ollama_async([
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ], model=OLLAMA_CLASSIFIER_MODEL, format=schema)
+        
+        orjson.loads(response)
+        return response
+    
+    async def _cached_analysis(self, cache_key: bytes, system_prompt: str, prompt: str, schema: Dict, batched: bool = False) -> str:
+        """Análisis con caché; solo se guardan respuestas que parsean"""
+        cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        if batched:
+            response = await self._analysis_batcher.submit(prompt)
+        else:
+            response = await self._call_analysis(system_prompt, prompt, schema)
+        
+        self._response_cache[cache_key] = response
+        return response
     
-    async def _validate_order_data(self, analysis: Dict, conversation: Dict) -> Dict:
+    async def _validate_order_data(self, analysis: Dict, conversation: Dict, db) -> Dict:
         """Valida que tengamos suficiente información para crear el pedido"""
         
         product_filters = analysis.get("product_filters", {})
@@ -190,33 +605,15 @@ EJEMPLOS:
             recent_messages = conversation.get('messages', [])[-10:]  # Últimos 10 mensajes
             
             for msg in reversed(recent_messages):  # Empezar por los más recientes
-                if msg['role'] == 'assistant' and 'stock' in msg['content'].lower():
-                    # Buscar productos en respuestas del bot
-                    content = msg['content'].lower()
+                if msg['role'] == 'assistant' and _STOCK_RE.search(msg['content']):
+                    # Buscar productos en respuestas del bot: una sola pasada extrae los tres campos
+                    found = dict(zip(("tipo_prenda", "color", "talla"), _scan_context(msg['content'])))
                     
-                    # Completar tipo_prenda si falta
-                    if not product_filters.get("tipo_prenda"):
-                        for tipo in ["pantalón", "camiseta", "sudadera", "camisa", "falda"]:
-                            if tipo in content:
-                                product_filters["tipo_prenda"] = tipo
-                                print(f"🛒🔄 Completado del contexto: tipo_prenda = {tipo}")
-                                break
-                    
-                    # Completar color si falta
-                    if not product_filters.get("color"):
-                        for color in ["azul", "negro", "blanco", "verde", "rojo", "amarillo", "gris"]:
-                            if color in content:
-                                product_filters["color"] = color
-                                print(f"🛒🔄 Completado del contexto: color = {color}")
-                                break
-                    
-                    # Completar talla si falta
-                    if not product_filters.get("talla"):
-                        for talla in ["S", "M", "L", "XL", "XXL"]:
-                            if f"talle {talla.lower()}" in content or f"talla {talla.lower()}" in content:
-                                product_filters["talla"] = talla
-                                print(f"🛒🔄 Completado del contexto: talla = {talla}")
-                                break
+                    # Completar solo los filtros que faltan
+                    for field, value in found.items():
+                        if value and not product_filters.get(field):
+                            product_filters[field] = value
+                            print(f"🛒🔄 Completado del contexto: {field} = {value}")
                     
                     # Si completamos información, salir del loop
                     if product_filters.get("tipo_prenda"):
@@ -253,35 +650,17 @@ EJEMPLOS:
                           "¿Cuál te preparamos?"
             }
         
-        # 3. Validar que el producto exista con stock suficiente
-        db = SessionLocal()
+        # 3. Validar que el producto exista con stock suficiente (índice en memoria + query por PK)
         try:
-            query = db.query(models.Product).filter(
-                models.Product.stock >= quantity
+            available_product, similar_products = await asyncio.to_thread(
+                _load_order_candidates, db, product_filters, quantity
             )
             
-            # Aplicar filtros
-            if product_filters.get("tipo_prenda"):
-                query = query.filter(models.Product.tipo_prenda.ilike(f"%{product_filters['tipo_prenda']}%"))
-            if product_filters.get("color"):
-                query = query.filter(models.Product.color.ilike(f"%{product_filters['color']}%"))
-            if product_filters.get("talla"):
-                query = query.filter(models.Product.talla.ilike(f"%{product_filters['talla']}%"))
-            
-            available_product = query.first()
-            
             if not available_product:
-                # Buscar productos similares para sugerir
-                similar_query = db.query(models.Product).filter(models.Product.stock > 0)
-                if product_filters.get("tipo_prenda"):
-                    similar_query = similar_query.filter(models.Product.tipo_prenda.ilike(f"%{product_filters['tipo_prenda']}%"))
-                
-                similar_products = similar_query.limit(3).all()
-                
                 if similar_products:
                     suggestion = "No tengo stock suficiente del producto exacto que buscás, pero tengo alternativas:\n\n"
                     for p in similar_products:
-                        suggestion += f"• **{p.name}** - Stock: {p.stock} unidades - ${p.precio_50_u:,.0f} c/u\n"
+                        suggestion += f"• **{p['name']}** - Stock: {p['stock']} unidades - ${p['precio_50_u']:,.0f} c/u\n"
                     suggestion += f"\n¿Te sirve alguna de estas opciones?"
                 else:
                     suggestion = f"No tengo stock suficiente de **{product_filters.get('tipo_prenda', 'ese producto')}** " \
@@ -300,8 +679,6 @@ EJEMPLOS:
                 "is_valid": False,
                 "response": "Tuve un problema verificando el stock. ¿Podrías intentar de nuevo?"
             }
-        finally:
-            db.close()
         
         # Si llegamos aquí, todo está válido
         return {
@@ -309,16 +686,12 @@ EJEMPLOS:
             "product_filters": product_filters,
             "quantity": quantity,
             "available_product": {
-                "id": available_product.id,
-                "name": available_product.name,
-                "precio_50_u": available_product.precio_50_u,
-                "precio_100_u": available_product.precio_100_u,
-                "precio_200_u": available_product.precio_200_u,
-                "stock": available_product.stock
+                key: available_product[key]
+                for key in ("id", "name", "precio_50_u", "precio_100_u", "precio_200_u", "stock")
             }
         }
     
-    async def _create_order_in_db(self, validation: Dict, user_phone: str) -> Dict:
+    async def _create_order_in_db(self, validation: Dict, user_phone: str, db) -> Dict:
         """Crea el pedido en la base de datos usando el CRUD existente"""
         
         try:
@@ -329,56 +702,42 @@ EJEMPLOS:
             order_data = schemas.OrderCreate(
                 product_id=product_info["id"],
                 qty=quantity,
-                buyer=f"Cliente WhatsApp {user_phone}"
+                buyer=f"Cliente WhatsApp {user_phone}",
+                user_phone=user_phone
             )
             
-            db = SessionLocal()
-            try:
-                # El CRUD se encarga de verificar stock y descontarlo
-                new_order = crud.create_order(db, order_data)
-                
-                # ✅ AGREGAR DATOS DE WHATSAPP
-                new_order.user_phone = user_phone
-                db.commit()
-                db.refresh(new_order)
-                
-                print(f"🛒✅ Pedido creado: ID {new_order.id}, {quantity} unidades")
-                
-                # Calcular precio según cantidad
-                if quantity >= 200:
-                    precio_unitario = product_info["precio_200_u"]
-                elif quantity >= 100:
-                    precio_unitario = product_info["precio_100_u"]
-                else:
-                    precio_unitario = product_info["precio_50_u"]
-                
-                return {
-                    "success": True,
-                    "order": {
-                        "id": new_order.id,
-                        "product": {
-                            "id": product_info["id"],
-                            "name": product_info["name"]
-                        },
-                        "quantity": quantity,
-                        "precio_unitario": precio_unitario,
-                        "total_price": precio_unitario * quantity,
-                        "stock_before": product_info["stock"],
-                        "stock_after": product_info["stock"] - quantity,
-                        "created_at": new_order.created_at
-                    }
+            # El CRUD verifica stock, lo descuenta y hace el único commit de la transacción (en un hilo, fuera del event loop)
+            new_order = await asyncio.to_thread(crud.create_order, db, order_data)
+            
+            print(f"🛒✅ Pedido creado: ID {new_order.id}, {quantity} unidades")
+            
+            # Calcular precio según cantidad
+            precio_unitario = unit_price(price_tuple(product_info), quantity)
+            
+            return {
+                "success": True,
+                "order": {
+                    "id": new_order.id,
+                    "product": {
+                        "id": product_info["id"],
+                        "name": product_info["name"]
+                    },
+                    "quantity": quantity,
+                    "precio_unitario": precio_unitario,
+                    "total_price": precio_unitario * quantity,
+                    "stock_before": product_info["stock"],
+                    "stock_after": product_info["stock"] - quantity,
+                    "created_at": new_order.created_at
                 }
-                
-            finally:
-                db.close()
-                
+            }
+            
         except HTTPException as http_e:
             # Error controlado del CRUD
             print(f"🛒❌ Error HTTP creando pedido: {http_e.detail}")
             return {
                 "success": False,
                 "error": http_e.detail,
-                "error_type": "stock_insufficient" if "stock insuficiente" in str(http_e.detail).lower() else "general"
+                "error_type": _http_error_type(http_e.detail)
             }
             
         except Exception as e:
@@ -386,7 +745,7 @@ EJEMPLOS:
             return {
                 "success": False,
                 "error": str(e),
-                "error_type": "general"
+                "error_type": ErrorType.GENERAL
             }
     
     async def _generate_order_response(self, order_result: Dict, analysis: Dict) -> str:
@@ -414,9 +773,9 @@ EJEMPLOS:
         
         else:
             error = order_result.get("error", "Error desconocido")
-            error_type = order_result.get("error_type", "general")
+            error_type = order_result.get("error_type", ErrorType.GENERAL)
             
-            if error_type == "stock_insufficient":
+            if error_type == ErrorType.STOCK_INSUFFICIENT:
                 return f"❌ **Stock insuficiente**\n\n{error}\n\n" \
                        f"¿Te interesa ajustar la cantidad o ver otros productos similares?"
             else:
@@ -430,7 +789,11 @@ EJEMPLOS:
             print(f"🛒✏️ OrderAgent procesando modificación: {message}")
             
             # 1. Buscar pedido reciente modificable
-            recent_order = await self._find_recent_modifiable_order(conversation['phone'])
+            db = SessionLocal()
+            try:
+                recent_order = await self._find_recent_modifiable_order(conversation['phone'], db)
+            finally:
+                db.close()
             
             if not recent_order['found']:
                 return recent_order['response']
@@ -438,7 +801,7 @@ EJEMPLOS:
             # 2. Analizar qué modificación quiere hacer
             modification = await self._analyze_modification_request(message, recent_order['order'])
             
-            # 3. Ejecutar la modificación
+            # 3. Ejecutar la modificación (se agrupa con las concurrentes en una sola transacción)
             result = await self._execute_order_modification(recent_order['order'], modification)
             
             # 4. Generar respuesta
@@ -450,19 +813,27 @@ EJEMPLOS:
             print(f"🛒✏️❌ Error en modificación de pedido: {e}")
             return "Disculpa, tuve un problema modificando tu pedido. ¿Podrías intentar de nuevo?"
     
-    async def _find_recent_modifiable_order(self, user_phone: str) -> Dict:
+    async def _find_recent_modifiable_order(self, user_phone: str, db: Session) -> Dict:
         """Busca el pedido más reciente que se pueda modificar (dentro de 5 minutos)"""
+        # ✅ SQLAlchemy es síncrono: la consulta corre en un hilo y no bloquea el event loop
+        return await asyncio.to_thread(self._find_recent_modifiable_order_sync, user_phone, db)
+    
+    def _find_recent_modifiable_order_sync(self, user_phone: str, db: Session) -> Dict:
+        """Versión síncrona de _find_recent_modifiable_order (se ejecuta fuera del event loop)"""
         
-        db = SessionLocal()
         try:
             # Buscar pedido más reciente del usuario
             recent_time = datetime.utcnow() - timedelta(minutes=10)  # Buscar en últimos 10 minutos
             
-            recent_order = db.query(models.Order).filter(
+            # ✅ Pedido y datos del producto en un solo round-trip (JOIN); mismo predicado que el índice parcial
+            row = db.query(models.Order, models.Product.name, models.Product.stock).outerjoin(
+                models.Product, models.Order.product_id == models.Product.id
+            ).filter(
                 models.Order.user_phone == user_phone,
-                models.Order.created_at >= recent_time,
-                models.Order.status == "pending"
-            ).order_by(models.Order.created_at.desc()).first()
+                models.Order.status == "pending",
+                models.Order.created_at >= recent_time
+            ).order_by(models.Order.created_at.desc()).limit(1).first()
+            recent_order, product_name, product_stock = row if row else (None, None, None)
             
             if not recent_order:
                 return {
@@ -482,9 +853,6 @@ EJEMPLOS:
                               f"¿Querés hacer un nuevo pedido en su lugar?"
                 }
             
-            # Obtener información del producto
-            product = db.query(models.Product).filter(models.Product.id == recent_order.product_id).first()
-            
             remaining_minutes = 5 - int(minutes_passed)
             
             return {
@@ -493,8 +861,8 @@ EJEMPLOS:
                     "id": recent_order.id,
                     "product_id": recent_order.product_id,
                     "current_qty": recent_order.qty,
-                    "product_name": product.name if product else "Producto",
-                    "product_stock": product.stock if product else 0,
+                    "product_name": product_name or "Producto",
+                    "product_stock": product_stock or 0,
                     "created_at": recent_order.created_at,
                     "minutes_remaining": remaining_minutes
                 },
@@ -507,51 +875,32 @@ EJEMPLOS:
                 "found": False,
                 "response": "Tuve un problema buscando tu pedido reciente. ¿Podrías intentar de nuevo?"
             }
-        finally:
-            db.close()
     
     async def _analyze_modification_request(self, message: str, order_info: Dict) -> Dict:
         """Analiza qué modificación quiere hacer el usuario"""
         
-        prompt = f"""Analiza esta solicitud de modificación de pedido:
-
-PEDIDO ACTUAL:
+        # ✅ FAST PATH: "cancelar", "poné 50", "sumá 20", "el doble" se resuelven sin Ollama
+        fast = _regex_modification_analysis(message, order_info["current_qty"])
+        if fast:
+            print(f"🛒✏️⚡ Análisis de modificación por regex: {fast}")
+            return fast
+        
+        prompt = f"""PEDIDO ACTUAL:
 - ID: {order_info['id']}
 - Producto: {order_info['product_name']}
 - Cantidad actual: {order_info['current_qty']} unidades
 - Stock disponible del producto: {order_info['product_stock']} unidades
 - Tiempo restante para modificar: {order_info['minutes_remaining']} minutos
 
-MENSAJE DEL USUARIO: "{message}"
-
-Responde SOLO con JSON válido:
-{{
-    "modification_type": "change_quantity" | "cancel_order" | "add_more" | "reduce_quantity",
-    "new_quantity": numero_o_null,
-    "is_clear": true_si_la_instruccion_es_clara,
-    "needs_confirmation": true_si_necesita_confirmacion_adicional
-}}
-
-EJEMPLOS:
-- "cambiar a 80 unidades" → {{"modification_type": "change_quantity", "new_quantity": 80, "is_clear": true}}
-- "quiero 20 más" → {{"modification_type": "add_more", "new_quantity": 20, "is_clear": true}}
-- "reducir a la mitad" → {{"modification_type": "reduce_quantity", "new_quantity": null, "needs_confirmation": true}}
-- "cancelar pedido" → {{"modification_type": "cancel_order", "is_clear": true}}"""
+MENSAJE DEL USUARIO: {orjson.dumps(message).decode()}
+"""
 
         try:
-            response = self.call_ollama([
-                {"role": "system", "content": "Eres un dispatcher inteligente para un sistema de ventasB2B textil."},
-                {"role": "user", "content": prompt}
-            ])
-            
-            # Limpiar y parsear respuesta
-            response_clean = self._extract_json_from_response(response)
-            if response_clean.startswith("```json"):
-                response_clean = response_clean[7:-3]
-            elif response_clean.startswith("```"):
-                response_clean = response_clean[3:-3]
-            
-            parsed = json.loads(response_clean)
+            # La clasificación solo depende del mensaje: final_quantity se calcula abajo con el pedido actual
+            cache_key = self._cache_key("order_modification", _normalize_message(message))
+            response_clean = await self._cached_analysis(cache_key, _MODIFICATION_ANALYZE_SYSTEM, prompt, MODIFICATION_SCHEMA)
+            
+            parsed = orjson.loads(response_clean)
             print(f"🛒✏️🎯 Análisis de modificación: {parsed}")
             
             # Calcular cantidad final
@@ -566,24 +915,7 @@ EJEMPLOS:
             
         except Exception as e:
             print(f"🛒✏️❌ Error analizando modificación: {e}")
-            
-            # Fallback simple
-            import re
-            message_lower = message.lower()
-            
-            if "cancelar" in message_lower:
-                return {"modification_type": "cancel_order", "is_clear": True}
-            
-            # Buscar números en el mensaje
-            numbers = re.findall(r'\d+', message)
-            if numbers:
-                new_qty = int(numbers[0])
-                return {
-                    "modification_type": "change_quantity",
-                    "new_quantity": new_qty,
-                    "final_quantity": new_qty,
-                    "is_clear": True
-                }
+            # Los casos claros ya los resolvió el fast path: lo que llega acá es ambiguo
             
             return {
                 "modification_type": "unclear",
@@ -593,57 +925,43 @@ EJEMPLOS:
     
     async def _execute_order_modification(self, order_info: Dict, modification: Dict) -> Dict:
         """Ejecuta la modificación del pedido usando el CRUD existente"""
+        # ✅ El lote corre en un hilo (sin bloquear el event loop) y toca cada producto una sola vez
+        return await self._modification_batcher.submit(order_info, modification)
+    
+    def _execute_order_modification_sync(self, order_info: Dict, modification: Dict, db: Session, commit: bool = True) -> Dict:
+        """Versión síncrona de _execute_order_modification; con commit=False el llamador cierra la transacción"""
         
         try:
             if modification.get("modification_type") == "cancel_order":
                 # Cancelar pedido y restaurar stock
-                db = SessionLocal()
-                try:
-                    # ✅ FIX: Usar order_info en lugar de modification_data
-                    result = crud.restore_stock_on_order_cancellation(db, order_info["id"])
-                    
-                    return {
-                        "success": True,
-                        "action": "cancelled", 
-                        "order_id": order_info["id"],
-                        "restored_quantity": order_info["current_qty"],
-                        "product_name": order_info["product_name"]
-                    }
-                finally:
-                    db.close()
+                # ✅ FIX: Usar order_info en lugar de modification_data
+                crud.restore_stock_on_order_cancellation(db, order_info["id"], commit=commit)
+                
+                return {
+                    "success": True,
+                    "action": "cancelled", 
+                    "order_id": order_info["id"],
+                    "restored_quantity": order_info["current_qty"],
+                    "product_name": order_info["product_name"]
+                }
             
             elif modification.get("final_quantity"):
                 new_quantity = modification["final_quantity"]
                 
-                # ✅ USAR EL CRUD EXISTENTE QUE MANEJA STOCK
-                db = SessionLocal()
-                try:
-                    updated_order = crud.update_order(db, order_info["id"], new_quantity)
-                    
-                    # Obtener producto para precio
-                    product = db.query(models.Product).filter(models.Product.id == updated_order.product_id).first()
-                    
-                    # Calcular precio según nueva cantidad
-                    if new_quantity >= 200:
-                        precio_unitario = product.precio_200_u
-                    elif new_quantity >= 100:
-                        precio_unitario = product.precio_100_u
-                    else:
-                        precio_unitario = product.precio_50_u
-                    
-                    return {
-                        "success": True,
-                        "action": "modified",
-                        "order_id": order_info["id"],
-                        "old_quantity": order_info["current_qty"],
-                        "new_quantity": new_quantity,
-                        "precio_unitario": precio_unitario,
-                        "new_total": precio_unitario * new_quantity,
-                        "stock_after": product.stock
-                    }
-                    
-                finally:
-                    db.close()
+                # ✅ Un solo UPDATE ... RETURNING ajusta el stock y trae los precios (sin segunda query al producto)
+                _, product = crud.change_order_quantity(db, order_info["id"], new_quantity, commit=commit)
+                precio_unitario = unit_price(price_tuple(product), new_quantity)
+                
+                return {
+                    "success": True,
+                    "action": "modified",
+                    "order_id": order_info["id"],
+                    "old_quantity": order_info["current_qty"],
+                    "new_quantity": new_quantity,
+                    "precio_unitario": precio_unitario,
+                    "new_total": precio_unitario * new_quantity,
+                    "stock_after": product.stock
+                }
             
             else:
                 return {
@@ -656,7 +974,7 @@ EJEMPLOS:
             return {
                 "success": False,
                 "error": http_e.detail,
-                "error_type": "stock_insufficient" if "stock" in str(http_e.detail).lower() else "general"
+                "error_type": _http_error_type(http_e.detail)
             }
             
         except Exception as e:
@@ -664,39 +982,18 @@ EJEMPLOS:
             return {
                 "success": False,
                 "error": str(e),
-                "error_type": "general"
+                "error_type": ErrorType.GENERAL
             }
     
     async def _generate_modification_response(self, result: Dict, modification: Dict) -> str:
         """Genera respuesta sobre el resultado de la modificación"""
         
         if result.get("success"):
-            
-            if result.get("action") == "cancelled":
-                return f"✅ **Pedido #{result['order_id']} CANCELADO**\n\n" \
-                       f"♻️ Stock restaurado: **+{result['restored_quantity']} unidades**\n\n" \
-                       f"¿Querés hacer un nuevo pedido?"
-            
-            elif result.get("action") == "modified":
-                response = f"✅ **PEDIDO #{result['order_id']} MODIFICADO**\n\n"
-                response += f"📦 Cantidad anterior: **{result['old_quantity']} unidades**\n"
-                response += f"📦 Nueva cantidad: **{result['new_quantity']} unidades**\n"
-                response += f"💰 Precio unitario: **${result['precio_unitario']:,.0f}**\n"
-                response += f"💸 **Nuevo total: ${result['new_total']:,.0f}**\n\n"
-                response += f"📊 Stock restante: **{result['stock_after']} unidades**\n\n"
-                response += f"¡Cambio realizado exitosamente! 🎉"
-                return response
+            template = _TPL_BY_ACTION.get(result.get("action"))
+            return template.format_map(result) if template else None
         
-        else:
-            error = result.get("error", "Error desconocido")
-            error_type = result.get("error_type", "general")
-            
-            if error_type == "stock_insufficient":
-                return f"❌ **No se pudo modificar el pedido**\n\n{error}\n\n" \
-                       f"¿Te interesa una cantidad menor o cancelar este pedido?"
-            else:
-                return f"❌ **Error modificando pedido**\n\n{error}\n\n" \
-                       f"¿Querés intentar de nuevo?"
+        template = _TPL_STOCK_ERR if result.get("error_type") == ErrorType.STOCK_INSUFFICIENT else _TPL_GENERIC_ERR
+        return template.format(error=result.get("error", "Error desconocido"))
 
 # Instancia global
 order_agent = OrderAgent()
\ No newline at end of file
@@ -1,27 +1,192 @@
 import os
-import json
-import google.generativeai as genai
+import copy
+import asyncio
+import threading
+from functools import lru_cache
+import re
 from typing import Dict, List, Optional
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models, crud, schemas
 from datetime import datetime, timedelta
-from sqlalchemy import or_
-from ..utils.logger import log
+from sqlalchemy import func, event
+from cachetools import TTLCache
+from pydantic import TypeAdapter, ValidationError
+from ..utils.logger import log, log_enabled
 from dotenv import load_dotenv
 from .base_agent import BaseAgent
+from .llm_cache import llm_cache, semantic_intent_cache
+from ..product_index import product_index
 
 load_dotenv()
 
+# Color y talla explícitos en el mensaje (formas flexionadas → valor de la BD)
+_COLOR_STEMS = {
+    "blanc": "blanco", "negr": "negro", "roj": "rojo", "amarill": "amarillo",
+    "azul": "azul", "verde": "verde", "gris": "gris"
+}
+_COLOR_RE = re.compile(r'\b(blanc|negr|roj|amarill|azul|verde|gris)(?:[oa]s?|es|s)?\b')
+_TALLA_RE = re.compile(r'\b(?:tall[ae]\s+)?(xxl|xl|s|m|l)\b')
+
+# Keywords del fallback por reglas (se comparan contra los tokens del mensaje, incluye formas frecuentes)
+_WORD_RE = re.compile(r'\w+')
+_QUANTITY_WORDS = frozenset({"unidades", "unidad", "cantidad"})
+_QUANTITY_NUMBERS = frozenset({"50", "80", "100", "200"})
+_ORDER_WORDS = frozenset({
+    "pedido", "pedidos", "encargar", "encargarte", "encargo", "quiero", "necesito", "generame", "haceme",
+    "confirmar", "confirmo", "solicitar", "solicito", "pedir", "pedirte"
+})
+
+# Mensajes que piden algo más que buscar/pedir (cambios, stock, preguntas) no toman el fast path por reglas
+_DEFER_TO_LLM_RE = re.compile(r'cambi|modific|cancel|agreg|quit|stock|dispon|\?')
+
+# ✅ Lo que distingue dos mensajes parecidos (cantidades, prendas, colores, talles) define el scope de la caché
+# semántica: "remeras blancas L" nunca reutiliza la intención de "remeras negras L"
+_DIGITS_RE = re.compile(r'\d+')
+_ENTITY_RE = re.compile(
+    r'\b(pantal\w*|camis\w*|fald\w*|sudader\w*|blanc\w*|negr\w*|azul\w*|verde\w*|gris\w*|roj\w*|amarill\w*'
+    r'|xxl|xl|s|m|l)\b'
+)
+
+# ✅ Términos de prenda → (tipo_prenda real en la BD, confianza del fallback)
+# Los sinónimos que el cliente usa pero no existen en la BD mapean con menor confianza
+_TERM_TABLE = {
+    **{term: ("sudadera", 0.8) for term in (
+        "chaquetas", "chaqueta", "camperas", "campera", "abrigos", "abrigo", "jackets", "jacket", "buzos", "buzo"
+    )},
+    **{term: ("camiseta", 0.8) for term in ("remeras", "remera", "playeras", "playera", "polos", "polo", "poleras", "polera")},
+    **{term: ("camisa", 0.8) for term in ("shirts", "shirt")},
+    **{term: ("pantalón", 0.8) for term in ("jeans", "jean")},
+    **{term: ("falda", 0.8) for term in ("polleras", "pollera")},
+    **{term: ("camiseta", 0.9) for term in ("camisetas", "camiseta")},
+    **{term: ("pantalón", 0.9) for term in ("pantalones", "pantalón")},
+    **{term: ("camisa", 0.9) for term in ("camisas", "camisa")},
+    **{term: ("falda", 0.9) for term in ("faldas", "falda")},
+    **{term: ("sudadera", 0.9) for term in ("sudaderas", "sudadera")},
+}
+
+# Fila precalculada por término para la intención de búsqueda del fallback: (action_keywords, mapeo)
+# Los sinónimos (confianza < 0.9) llevan original_term/mapped_term; los tipos existentes no
+_TERM_INTENT = {
+    term: ((term, "mapped"), {"original_term": term, "mapped_term": tipo}) if confidence < 0.9 else ((tipo,), {})
+    for term, (tipo, confidence) in _TERM_TABLE.items()
+}
+
+# Una sola pasada del motor de regex (en C) encuentra el primer término; los más largos van primero
+# en la alternancia para que "remeras" gane sobre "remera"
+_TERM_RE = re.compile("|".join(re.escape(term) for term in sorted(_TERM_TABLE, key=len, reverse=True)))
+
+# ✅ Búsqueda: solo las columnas del schema del AI (defaults resueltos en SQL) y validación de la lista en una pasada
+_AI_PRODUCT_COLUMNS = (
+    models.Product.id, models.Product.name, models.Product.tipo_prenda, models.Product.color, models.Product.talla,
+    models.Product.precio_50_u, models.Product.precio_100_u, models.Product.precio_200_u, models.Product.stock,
+    func.coalesce(models.Product.descripcion, 'Material de calidad premium').label("descripcion"),
+    func.coalesce(models.Product.categoria, 'General').label("categoria"),
+)
+_PRODUCT_LIST_ADAPTER = TypeAdapter(list[schemas.ProductAIResponse])
+
+# Consulta de stock: filas para mostrar (acotadas) + suma y conteo totales en el mismo SELECT
+STOCK_LIST_LIMIT = 50
+_STOCK_FIELDS = ("id", "name", "stock", "precio_50_u", "tipo_prenda", "color", "talla", "descripcion", "categoria")
+_STOCK_COLUMNS = tuple(column for column in _AI_PRODUCT_COLUMNS if column.key in _STOCK_FIELDS)
+
+# ✅ Resultados de búsqueda/stock por (operación, tipo, color, talla): el catálogo casi no cambia y los
+# mensajes repiten filtros. TTL corto porque el stock también se descuenta desde otros agentes
+SEARCH_CACHE_TTL = 60
+_search_cache = TTLCache(maxsize=1024, ttl=SEARCH_CACHE_TTL)
+_search_cache_lock = threading.Lock()
+
+def _cached_search(key: tuple) -> Optional[Dict]:
+    with _search_cache_lock:
+        cached = _search_cache.get(key)
+    # Copia: los llamadores pueden mutar el resultado (filtros, listas de productos)
+    return copy.deepcopy(cached) if cached is not None else None
+
+def _store_search(key: tuple, result: Dict):
+    with _search_cache_lock:
+        _search_cache[key] = copy.deepcopy(result)
+
+def invalidate_search_cache(*args):
+    """Vacía la caché de búsquedas (pedido creado/editado o producto modificado por ORM)"""
+    with _search_cache_lock:
+        _search_cache.clear()
+
+for _event in ("after_insert", "after_update", "after_delete"):
+    event.listen(models.Product, _event, invalidate_search_cache)
+
+def _map_term(match: "re.Match", hits: list) -> str:
+    """Callback de _TERM_RE.sub: registra (término, tipo_prenda, confianza) y devuelve el reemplazo"""
+    term = match.group()
+    tipo_prenda, confidence = _TERM_TABLE[term]
+    hits.append((term, tipo_prenda, confidence))
+    return tipo_prenda
+
+def _make_intent(intent_type: str, confidence: float, user_message: str, filters: Dict,
+                 quantity: Optional[int] = None, action_keywords: Optional[List[str]] = None,
+                 is_continuation: bool = False, **mapping) -> Dict:
+    """Intención del fallback por reglas con la misma forma que la del LLM (mapping: original_term/mapped_term)"""
+    return {
+        "intent_type": intent_type,
+        "confidence": confidence,
+        "extracted_data": {
+            "product_filters": filters,
+            "quantity": quantity,
+            "action_keywords": action_keywords or [],
+            "is_continuation": is_continuation,
+            "specific_request": user_message,
+            **mapping
+        }
+    }
+
+def _filter_by_attributes(query, tipo: Optional[str], color: Optional[str], talla: Optional[str]):
+    """
+    Igualdad sobre (tipo_prenda, color, talla) normalizados vía ProductIndex → filtro por PK.
+    Reemplaza los ILIKE '%valor%' (scan secuencial); sin filtros devuelve la query intacta.
+    """
+    if not (tipo or color or talla):
+        return query
+    return query.filter(models.Product.id.in_(product_index.lookup(tipo, color, talla)))
+
+def _intent_scope(message_mapped: str, has_context: bool) -> tuple:
+    """Scope de la caché semántica: contexto sí/no + números + entidades del mensaje"""
+    return (
+        has_context,
+        tuple(_DIGITS_RE.findall(message_mapped)),
+        tuple(sorted(set(_ENTITY_RE.findall(message_mapped)))),
+    )
+
+# ✅ Salida restringida al schema: los enums de prenda/color/talla e intenciones viajan en el schema, no en el prompt
+_INTENT_SCHEMA = schemas.StructuredIntent.model_json_schema()
+
+# Parte invariante del prompt de extracción, al principio y byte a byte idéntica entre llamadas:
+# Ollama (con el modelo residente, ver OLLAMA_KEEP_ALIVE) reutiliza el KV cache de este prefijo
+_EXTRACTION_SYSTEM = """Extraes la intención de mensajes de clientes B2B de ropa de trabajo.
+intent_type:
+- search_products: busca/pregunta por prendas
+- confirm_order: pide N unidades (pedido, encargar, quiero, necesito, generame, haceme)
+- edit_order: cambia la cantidad de un pedido ("cambiar a 150")
+- ask_stock: pregunta por disponibilidad
+- general_question: otra cosa
+Sinónimos: chaqueta/campera/abrigo/buzo→sudadera, remera/playera/polo→camiseta, jean→pantalón, pollera→falda.
+is_continuation=true si el mensaje es corto, no nombra prenda y completa la búsqueda previa del contexto ("talle L", "qué colores tenés?").
+Filtros no mencionados: null."""
+
+# Parte dinámica del prompt (contexto y mensaje del turno), va al final
+_EXTRACTION_PROMPT_TMPL = """CONTEXTO DE LA CONVERSACIÓN:
+- Productos mencionados anteriormente: {last_products}
+- Última consulta: "{last_query}"
+- Historial: {history}
+
+MENSAJE ORIGINAL DEL CLIENTE: "{user_message}"
+MENSAJE PROCESADO: "{user_message_mapped}"
+MAPEO APLICADO: {mapping}
+"""
+
 class QueryAgent(BaseAgent):
     """Agente especializado en consultas y operaciones de base de datos"""
     
     def __init__(self):
         super().__init__(agent_name="QueryAgent")
-        self.api_keys = self._load_api_keys()
-        self.current_key_index = 0
-        self.model = None
-        self._setup_current_key()
 
     async def extract_structured_intent(self, user_message: str, conversation_context: Dict) -> Dict:
         """Extrae intención estructurada del mensaje usando prompt específico"""
@@ -29,166 +194,73 @@ class QueryAgent(BaseAgent):
         # ✅ MAPEO ACTUALIZADO CON PRODUCTOS REALES DE LA BD
         user_message_mapped = user_message.lower()
         
-        # Mapear términos que el cliente usa vs lo que hay REALMENTE en la DB
-        mappings = {
-            # CHAQUETAS Y ABRIGOS → SUDADERA (más similar)
-            "chaquetas": "sudadera",
-            "chaqueta": "sudadera", 
-            "camperas": "sudadera",
-            "campera": "sudadera",
-            "abrigos": "sudadera",
-            "abrigo": "sudadera",
-            "jackets": "sudadera",
-            "jacket": "sudadera",
-            "buzos": "sudadera",
-            "buzo": "sudadera",
-            
-            # REMERAS Y PLAYERAS → CAMISETA
-            "remeras": "camiseta",
-            "remera": "camiseta",
-            "playeras": "camiseta",
-            "playera": "camiseta",
-            "polos": "camiseta",
-            "polo": "camiseta",
-            "poleras": "camiseta",
-            
-            # CAMISAS (ya existe, pero por si hay variaciones)
-            "shirts": "camisa",
-            "shirt": "camisa",
-            
-            # PANTALONES (ya existe, pero por si hay variaciones)
-            "pantalones": "pantalón",
-            "jeans": "pantalón",
-            "jean": "pantalón",
-            
-            # FALDAS (ya existe, pero por si hay variaciones)
-            "faldas": "falda",
-            "polleras": "falda",
-            "pollera": "falda"
-        }
+        # Mapear términos que el cliente usa vs lo que hay REALMENTE en la DB: una sola pasada encuentra
+        # todos los términos y reescribe cada sinónimo; el primero define la prenda de la intención
+        hits = []
+        user_message_mapped = _TERM_RE.sub(lambda match: _map_term(match, hits), user_message_mapped)
+        term_hit = hits[0] if hits else None
         
         original_term = None
         mapped_term = None
         
-        for original, mapped in mappings.items():
-            if original in user_message_mapped:
-                original_term = original
-                mapped_term = mapped
-                user_message_mapped = user_message_mapped.replace(original, mapped)
-                log(f"🔄 Mapeo aplicado: '{original}' → '{mapped}'")
-                break
+        if term_hit and term_hit[0] != term_hit[1]:
+            original_term, mapped_term = term_hit[0], term_hit[1]
+            log("🔄 Mapeo aplicado", level="DEBUG", original=original_term, mapped=mapped_term, terms=len(hits))
         
-        extraction_prompt = f"""
-Eres un asistente especializado en extraer intenciones de mensajes de clientes B2B de textiles.
-
-CONTEXTO DE LA CONVERSACIÓN:
-- Productos mencionados anteriormente: {conversation_context.get('last_searched_products', [])}
-- Última consulta: "{conversation_context.get('last_search_query', '')}"
-- Historial: {conversation_context.get('conversation_history', [])}
-
-MENSAJE ORIGINAL DEL CLIENTE: "{user_message}"
-MENSAJE PROCESADO: "{user_message_mapped}"
+        # ✅ FAST PATH: reglas con confianza alta y la prenda identificada → sin LLM.
+        # Modificaciones, stock y preguntas quedan para el LLM aunque nombren una prenda
+        rule_intent = self._rule_based_intent(user_message, term_hit)
+        if (rule_intent["confidence"] >= 0.9
+                and rule_intent["extracted_data"]["product_filters"]["tipo_prenda"]
+                and not _DEFER_TO_LLM_RE.search(user_message_mapped)):
+            if original_term and mapped_term:
+                rule_intent["extracted_data"]["original_term"] = original_term
+                rule_intent["extracted_data"]["mapped_term"] = mapped_term
+            log("⚡ Intención resuelta por reglas", level="DEBUG", intent_type=rule_intent["intent_type"])
+            return rule_intent
+        
+        # Parte dinámica (al final): contexto y mensaje del turno
+        extraction_prompt = _EXTRACTION_PROMPT_TMPL.format_map({
+            "last_products": conversation_context.get('last_searched_products', []),
+            "last_query": conversation_context.get('last_search_query', ''),
+            "history": conversation_context.get('conversation_history', []),
+            "user_message": user_message,
+            "user_message_mapped": user_message_mapped,
+            "mapping": f'"{original_term}" → "{mapped_term}"' if original_term else "ninguno",
+        })
 
-IMPORTANTE: Los productos disponibles son EXACTAMENTE:
-- TIPO_PRENDA: "pantalón", "camiseta", "falda", "sudadera", "camisa"
-- COLOR: "blanco", "negro", "azul", "verde", "gris", "rojo", "amarillo"
-- TALLA: "S", "M", "L", "XL", "XXL"
-
-MAPEOS AUTOMÁTICOS APLICADOS:
-- chaquetas/camperas/abrigos → sudadera
-- remeras/playeras/polos → camiseta  
-- jeans → pantalón
-- polleras → falda
-
-Analiza el mensaje y responde SOLAMENTE con JSON válido:
-
-{{
-    "intent_type": "search_products" | "confirm_order" | "edit_order" | "ask_stock" | "general_question",
-    "confidence": 0.0-1.0,
-    "extracted_data": {{
-        "product_filters": {{
-            "tipo_prenda": "pantalón|camiseta|falda|sudadera|camisa|null",
-            "color": "blanco|negro|azul|verde|gris|rojo|amarillo|null", 
-            "talla": "S|M|L|XL|XXL|null"
-        }},
-        "quantity": number_or_null,
-        "action_keywords": ["palabras", "clave"],
-        "is_continuation": true_si_continua_conversacion_previa,
-        "specific_request": "descripción_específica",
-        "original_term": "{original_term}",
-        "mapped_term": "{mapped_term}"
-    }}
-}}
-
-EJEMPLOS ESPECÍFICOS POR TIPO DE PRENDA:
-
-1. PANTALONES:
-- "necesito pantalones negros talle L" → {{"tipo_prenda": "pantalón", "color": "negro", "talla": "L"}}
-- "jeans azules para trabajo" → {{"tipo_prenda": "pantalón", "color": "azul"}}
-- "pantalones de trabajo, que colores tenes?" → {{"tipo_prenda": "pantalón"}}
-
-2. CAMISETAS:
-- "camisetas blancas talle M para el equipo" → {{"tipo_prenda": "camiseta", "color": "blanco", "talla": "M"}}
-- "remeras rojas" → {{"tipo_prenda": "camiseta", "color": "rojo"}}
-- "playeras para construcción" → {{"tipo_prenda": "camiseta"}}
-
-3. SUDADERAS:
-- "chaquetas negras para construcción" → {{"tipo_prenda": "sudadera", "color": "negro"}}
-- "buzos grises talle XL" → {{"tipo_prenda": "sudadera", "color": "gris", "talla": "XL"}}
-- "camperas para trabajo pesado" → {{"tipo_prenda": "sudadera"}}
-
-4. CAMISAS:
-- "camisas azules para oficina talle L" → {{"tipo_prenda": "camisa", "color": "azul", "talla": "L"}}
-- "shirts blancos" → {{"tipo_prenda": "camisa", "color": "blanco"}}
-- "camisas formales" → {{"tipo_prenda": "camisa"}}
-
-5. FALDAS:
-- "faldas negras talle S" → {{"tipo_prenda": "falda", "color": "negro", "talla": "S"}}
-- "polleras azules" → {{"tipo_prenda": "falda", "color": "azul"}}
-- "faldas para uniformes" → {{"tipo_prenda": "falda"}}
-
-CASOS ESPECIALES:
-- "para hombre, que colores tenes" (contexto: buscaba chaquetas) → {{"is_continuation": true, "specific_request": "colores disponibles"}}
-- "talle L" (contexto: viendo productos) → {{"is_continuation": true, "product_filters": {{"talla": "L"}}}}
-- "200 unidades" → {{"quantity": 200, "intent_type": "confirm_order"}}
-- "cambiar a 150" → {{"quantity": 150, "intent_type": "edit_order"}}
-
-PATRONES DE CONTINUACIÓN:
-Si el mensaje es corto y NO menciona tipo de prenda, pero el contexto indica una búsqueda previa:
-- "que colores tenes?" → buscar en historial el tipo de prenda y marcar is_continuation: true
-- "talle M" → agregar talla al filtro existente
-- "para construcción" → mantener tipo de prenda del contexto
-
-# En extract_structured_intent, ACTUALIZAR examples:
-
-EJEMPLOS DE CONFIRM_ORDER:
-- "haceme el pedido por 50 unidades de buzos azules en talla L" → {{"intent_type": "confirm_order", "quantity": 50, "product_filters": {{"tipo_prenda": "sudadera", "color": "azul", "talla": "L"}}}}
-- "quiero encargarte 80 en talle L color verde" → {{"intent_type": "confirm_order", "quantity": 80, "product_filters": {{"color": "verde", "talla": "L"}}}}
-- "necesito 100 unidades" (después de ver productos) → {{"intent_type": "confirm_order", "quantity": 100, "is_continuation": true}}
-- "generame el pedido" (después de especificar producto) → {{"intent_type": "confirm_order", "is_continuation": true}}
-
-PALABRAS CLAVE CONFIRM_ORDER: pedido, encargar, quiero, necesito, generame, haceme, confirmar, solicitar
-PALABRAS CLAVE CANTIDAD: unidades, 50, 80, 100, 200, cantidad
-
-Responde SOLO con el JSON, sin explicaciones adicionales.
-"""
+        # ✅ Paráfrasis de un mensaje ya interpretado (mismo scope) reutilizan la intención sin LLM
+        scope = _intent_scope(user_message_mapped, bool(conversation_context.get('last_search_query')))
+        similar = semantic_intent_cache.lookup(scope, user_message_mapped)
+        if similar is not None:
+            parsed_intent = copy.deepcopy(similar)
+            parsed_intent.setdefault("extracted_data", {})["specific_request"] = user_message
+            if original_term and mapped_term:
+                parsed_intent["extracted_data"]["original_term"] = original_term
+                parsed_intent["extracted_data"]["mapped_term"] = mapped_term
+            log("🧠 Intención reutilizada por similitud", level="DEBUG", scope=scope)
+            return parsed_intent
 
         try:
-            response = self.call_ollama([
-                    {"role": "system", "content": "Eres un dispatcher inteligente para un sistema de ventas B2B textil."},
-                    {"role": "user", "content": extraction_prompt}
-                ])
+            # ✅ El prompt determina la respuesta: mismos mensaje + contexto → respuesta cacheada, sin LLM
+            cache_key = llm_cache.key("structured_intent", extraction_prompt)
+            response = await llm_cache.get(cache_key)
+            cached = response is not None
+            if not cached:
+                response = await self.call_ollama_async([
+                        {"role": "system", "content": _EXTRACTION_SYSTEM},
+                        {"role": "user", "content": extraction_prompt}
+                    ], format=_INTENT_SCHEMA)
             
-            response_clean = self._extract_json_from_response(response)
             if response:
-                # Limpiar respuesta y extraer JSON
-                response_clean = response.strip()
-                if response_clean.startswith("```json"):
-                    response_clean = response_clean[7:-3]
-                elif response_clean.startswith("```"):
-                    response_clean = response_clean[3:-3]
+                # ✅ La respuesta viene restringida al schema: se valida directo contra StructuredIntent
+                parsed_intent = schemas.StructuredIntent.model_validate_json(response).model_dump()
+                if not cached:
+                    await llm_cache.set(cache_key, response)
                 
-                parsed_intent = json.loads(response_clean)
+                # Solo intenciones autocontenidas: una continuación depende del contexto de esa conversación
+                if not parsed_intent.get("extracted_data", {}).get("is_continuation"):
+                    semantic_intent_cache.add(scope, user_message_mapped, copy.deepcopy(parsed_intent))
                 
                 # ✅ AGREGAR INFO DE MAPEO AL RESULTADO
                 if original_term and mapped_term:
@@ -200,210 +272,50 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
         except Exception as e:
             log(f"❌ Error extrayendo intención con Gemini: {e}")
         
-        # ✅ FALLBACK COMPLETADO
-        # ... (tu lógica de fallback parece extensa, la mantendré y completaré) ...
+        # ✅ FALLBACK POR REGLAS
+        return self._rule_based_intent(user_message, term_hit)
+    
+    def _rule_based_intent(self, user_message: str, term_hit: Optional[tuple]) -> Dict:
+        """Intención por reglas (sin LLM): prenda por término detectado, color/talla por regex, cantidad por dígitos"""
         user_lower = user_message.lower()
+        # ✅ Palabras del mensaje tokenizadas una vez: cada grupo de keywords es una intersección de sets
+        tokens = frozenset(_WORD_RE.findall(user_lower))
         
         # Detección de cantidad primero
         quantity = None
-        quantity_keywords = ["unidades", "cantidad"]
-        has_quantity_keyword = any(word in user_lower for word in quantity_keywords)
+        has_quantity_keyword = bool(_QUANTITY_WORDS & tokens)
         
         numbers = [int(s) for s in user_lower.split() if s.isdigit()]
         if numbers:
             quantity = numbers[0]
-
-        # Detección de intención de pedido
-        order_keywords = ["pedido", "encargar", "quiero", "necesito", "generame", "haceme", "confirmar", "solicitar", "pedir"]
-        if any(word in user_lower for word in order_keywords) and (quantity or has_quantity_keyword):
-            filters = {"tipo_prenda": None, "color": None, "talla": None}
-            for tipo, term in mappings.items():
-                if tipo in user_lower:
-                    filters["tipo_prenda"] = term
-                    break
-            # ... (completar extracción de color y talla) ...
-            return {"intent_type": "confirm_order", "confidence": 0.95, "extracted_data": {"product_filters": filters, "quantity": quantity}}
-
-        # Chaquetas/camperas/abrigos → sudadera
-        if any(word in user_lower for word in ["chaqueta", "campera", "abrigo", "jacket", "buzo"]):
-            return {
-                "intent_type": "search_products",
-                "confidence": 0.8,
-                "extracted_data": {
-                    "product_filters": {"tipo_prenda": "sudadera", "color": None, "talla": None},
-                    "quantity": None,
-                    "action_keywords": ["chaqueta", "mapped"],
-                    "is_continuation": False,
-                    "specific_request": user_message,
-                    "original_term": "chaquetas",
-                    "mapped_term": "sudadera"
-                }
-            }
-        
-        # Remeras/playeras → camiseta
-        if any(word in user_lower for word in ["remera", "playera", "polo", "polera"]):
-            return {
-                "intent_type": "search_products",
-                "confidence": 0.8,
-                "extracted_data": {
-                    "product_filters": {"tipo_prenda": "camiseta", "color": None, "talla": None},
-                    "quantity": None,
-                    "action_keywords": ["remera", "mapped"],
-                    "is_continuation": False,
-                    "specific_request": user_message,
-                    "original_term": "remeras",
-                    "mapped_term": "camiseta"
-                }
-            }
-        
-        # Jeans → pantalón
-        if any(word in user_lower for word in ["jean", "jeans"]):
-            return {
-                "intent_type": "search_products",
-                "confidence": 0.8,
-                "extracted_data": {
-                    "product_filters": {"tipo_prenda": "pantalón", "color": None, "talla": None},
-                    "quantity": None,
-                    "action_keywords": ["jean", "mapped"],
-                    "is_continuation": False,
-                    "specific_request": user_message,
-                    "original_term": "jeans",
-                    "mapped_term": "pantalón"
-                }
-            }
         
-        # Búsquedas directas de productos existentes
-        if any(word in user_lower for word in ["camiseta", "camisetas"]):
-            return {
-                "intent_type": "search_products",
-                "confidence": 0.9,
-                "extracted_data": {
-                    "product_filters": {"tipo_prenda": "camiseta", "color": None, "talla": None},
-                    "quantity": None,
-                    "action_keywords": ["camiseta"],
-                    "is_continuation": False,
-                    "specific_request": user_message
-                }
-            }
-        
-        if any(word in user_lower for word in ["pantalón", "pantalones"]):
-            return {
-                "intent_type": "search_products",
-                "confidence": 0.9,
-                "extracted_data": {
-                    "product_filters": {"tipo_prenda": "pantalón", "color": None, "talla": None},
-                    "quantity": None,
-                    "action_keywords": ["pantalón"],
-                    "is_continuation": False,
-                    "specific_request": user_message
-                }
-            }
-        
-        if any(word in user_lower for word in ["camisa", "camisas"]):
-            return {
-                "intent_type": "search_products",
-                "confidence": 0.9,
-                "extracted_data": {
-                    "product_filters": {"tipo_prenda": "camisa", "color": None, "talla": None},
-                    "quantity": None,
-                    "action_keywords": ["camisa"],
-                    "is_continuation": False,
-                    "specific_request": user_message
-                }
-            }
+        color_match = _COLOR_RE.search(user_lower)
+        talla_match = _TALLA_RE.search(user_lower)
+        filters = {
+            "tipo_prenda": term_hit[1] if term_hit else None,
+            "color": _COLOR_STEMS[color_match.group(1)] if color_match else None,
+            "talla": talla_match.group(1).upper() if talla_match else None
+        }
         
-        if any(word in user_lower for word in ["falda", "faldas", "pollera", "polleras"]):
-            return {
-                "intent_type": "search_products",
-                "confidence": 0.9,
-                "extracted_data": {
-                    "product_filters": {"tipo_prenda": "falda", "color": None, "talla": None},
-                    "quantity": None,
-                    "action_keywords": ["falda"],
-                    "is_continuation": False,
-                    "specific_request": user_message
-                }
-            }
+        has_order_keyword = bool(_ORDER_WORDS & tokens)
         
-        if any(word in user_lower for word in ["sudadera", "sudaderas"]):
-            return {
-                "intent_type": "search_products",
-                "confidence": 0.9,
-                "extracted_data": {
-                    "product_filters": {"tipo_prenda": "sudadera", "color": None, "talla": None},
-                    "quantity": None,
-                    "action_keywords": ["sudadera"],
-                    "is_continuation": False,
-                    "specific_request": user_message
-                }
-            }
+        # Detección de intención de pedido (sin prenda en el mensaje → se completa con el contexto)
+        if has_order_keyword and (quantity or has_quantity_keyword or _QUANTITY_NUMBERS & tokens):
+            log("🎯 CONFIRM_ORDER detectado", level="DEBUG", quantity=quantity, filters=filters)
+            return _make_intent(
+                "confirm_order", 0.95, user_message, filters, quantity=quantity,
+                action_keywords=["pedido", "confirmar"], is_continuation=filters["tipo_prenda"] is None
+            )
         
-        # ✅ DETECCIÓN MEJORADA DE CONFIRM_ORDER
-        if any(word in user_lower for word in [
-            "pedido", "encargar", "quiero", "necesito", "generame", 
-            "haceme", "confirmar", "solicitar", "pedir"
-        ]) and any(word in user_lower for word in [
-            "unidades", "50", "80", "100", "200", "cantidad"
-        ]):
-            
-            # Extraer cantidad
-            quantity = None
-            for word in user_message.split():
-                if word.isdigit():
-                    quantity = int(word)
-                    break
-            
-            # Usar contexto si no especifica producto
-            filters = {"tipo_prenda": None, "color": None, "talla": None}
-            
-            # Detectar producto específico en el mensaje
-            for tipo in ["pantalón", "pantalones", "camiseta", "camisetas", "sudadera", "buzos", "camisa", "camisas", "falda", "faldas"]:
-                if tipo in user_lower:
-                    if tipo in ["pantalones", "pantalón"]:
-                        filters["tipo_prenda"] = "pantalón"
-                    elif tipo in ["buzos"]:
-                        filters["tipo_prenda"] = "sudadera"
-                    else:
-                        filters["tipo_prenda"] = tipo.rstrip('s')  # remover plural
-                    break
-            
-            # Detectar color
-            for color in ["verde", "azul", "negro", "blanco", "rojo", "amarillo", "gris"]:
-                if color in user_lower:
-                    filters["color"] = color
-                    break
-            
-            # Detectar talla
-            for talla in ["S", "M", "L", "XL", "XXL"]:
-                if f"talle {talla.lower()}" in user_lower or f"talla {talla.lower()}" in user_lower:
-                    filters["talla"] = talla
-                    break
-            
-            log(f"🎯 CONFIRM_ORDER detectado: quantity={quantity}, filters={filters}")
-            
-            return {
-                "intent_type": "confirm_order",
-                "confidence": 0.95,
-                "extracted_data": {
-                    "product_filters": filters,
-                    "quantity": quantity,
-                    "action_keywords": ["pedido", "confirmar"],
-                    "is_continuation": True,  # Usar contexto
-                    "specific_request": user_message
-                }
-            }
+        # Búsqueda de producto por el término detectado (sinónimo mapeado o tipo existente)
+        if term_hit:
+            keyword, _, confidence = term_hit
+            action_keywords, mapping = _TERM_INTENT[keyword]
+            return _make_intent(
+                "search_products", confidence, user_message, filters, action_keywords=list(action_keywords), **mapping
+            )
         
-        return {
-            "intent_type": "general_question",
-            "confidence": 0.3,
-            "extracted_data": {
-                "product_filters": {"tipo_prenda": None, "color": None, "talla": None},
-                "quantity": None,
-                "action_keywords": [],
-                "is_continuation": False,
-                "specific_request": user_message
-            }
-        }
+        return _make_intent("general_question", 0.3, user_message, {"tipo_prenda": None, "color": None, "talla": None})
     
     async def execute_database_operation(self, intent: Dict, user_phone: str, conversation_id: int = None) -> Dict:
         """Ejecuta operación en base de datos según la intención"""
@@ -428,6 +340,10 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
     
     async def _search_products(self, filters: Dict) -> Dict:
         """Busca productos con filtros específicos (mejorada con fallback y búsqueda flexible)"""
+        return await asyncio.to_thread(self._search_products_sync, filters)
+    
+    def _search_products_sync(self, filters: Dict) -> Dict:
+        """Versión sincrónica (sesión bloqueante), se ejecuta en un hilo del pool"""
         
         db = SessionLocal()
         try:
@@ -440,86 +356,65 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
                     val_clean = val.strip().lower()
                     if val_clean in ["null", "none", ""]:
                         product_filters[key] = None
-                        log(f"🔄 Filtro normalizado: {key} = '{val}' → None")
+                        log("🔄 Filtro normalizado a None", level="DEBUG", key=key, value=val)
+            
+            log("🔍 Filtros después de normalización", level="DEBUG", filters=product_filters)
             
-            log(f"🔍 Filtros después de normalización: {product_filters}")
+            cache_key = ("search", product_filters.get("tipo_prenda"), product_filters.get("color"), product_filters.get("talla"))
+            cached = _cached_search(cache_key)
+            if cached is not None:
+                log("🔍 Búsqueda servida desde caché", level="DEBUG", total_found=cached['data']['total_found'])
+                return cached
             
             # Base query: solo productos con stock
-            query = db.query(models.Product).filter(models.Product.stock > 0)
+            query = db.query(*_AI_PRODUCT_COLUMNS).filter(models.Product.stock > 0)
             
             tipo = product_filters.get("tipo_prenda")
             color = product_filters.get("color")
             talla = product_filters.get("talla")
 
-            # ✅ APLICAR FILTROS SOLO SI NO SON None
-            if tipo:
-                tipo_lower = tipo.lower()
-                query = query.filter(
-                    models.Product.tipo_prenda.ilike(f"%{tipo_lower}%")
-                )
-                log(f"🔍 Filtro aplicado: tipo_prenda ILIKE '%{tipo_lower}%'")
-            
-            if color:
-                query = query.filter(models.Product.color.ilike(f"%{color}%"))
-                log(f"🔍 Filtro aplicado: color ILIKE '%{color}%'")
-            
-            if talla:
-                query = query.filter(models.Product.talla.ilike(f"%{talla}%"))
-                log(f"🔍 Filtro aplicado: talla ILIKE '%{talla}%'")
+            # ✅ APLICAR FILTROS SOLO SI NO SON None (igualdad exacta sobre valores normalizados)
+            query = _filter_by_attributes(query, tipo, color, talla)
             
             # Primer intento
             products = query.limit(10).all()
-            log(f"🔍 Productos encontrados en primer intento: {len(products)}")
+            log("🔍 Productos encontrados en primer intento", level="DEBUG", found=len(products))
 
             # 🔄 Fallback si no hay resultados
             if not products and tipo:
-                log(f"⚠️ Sin resultados exactos para '{tipo}', buscando relacionados...")
-                fallback_query = db.query(models.Product).filter(models.Product.stock > 0)
+                log("⚠️ Sin resultados exactos, buscando relacionados", level="DEBUG", tipo=tipo)
+                fallback_query = db.query(*_AI_PRODUCT_COLUMNS).filter(models.Product.stock > 0)
                 
-                if color:
-                    fallback_query = fallback_query.filter(models.Product.color.ilike(f"%{color}%"))
-                if talla:
-                    fallback_query = fallback_query.filter(models.Product.talla.ilike(f"%{talla}%"))
+                fallback_query = _filter_by_attributes(fallback_query, None, color, talla)
 
                 # Buscar por nombre o categoría, ignorando tipo_prenda
                 fallback_query = fallback_query.filter(
                     models.Product.name.ilike(f"%{tipo}%")
                 )
                 products = fallback_query.limit(10).all()
-                log(f"🔄 Productos encontrados en fallback: {len(products)}")
+                log("🔄 Productos encontrados en fallback", level="DEBUG", found=len(products))
             
             # ✅ DEBUG ADICIONAL: Si sigue sin encontrar nada, mostrar qué hay disponible
-            if not products:
-                log("❌ No se encontraron productos. Verificando qué hay disponible...")
+            # (dos queries extra: solo con DEBUG habilitado)
+            if not products and log_enabled("DEBUG"):
                 total_products = db.query(models.Product).filter(models.Product.stock > 0).count()
-                log(f"📊 Total productos con stock: {total_products}")
-                
-                # Mostrar algunos ejemplos
-                sample_products = db.query(models.Product).filter(models.Product.stock > 0).limit(3).all()
-                for sp in sample_products:
-                    log(f"  📋 Ejemplo: {sp.name} | Tipo: '{sp.tipo_prenda}' | Color: '{sp.color}' | Talla: '{sp.talla}'")
-            
-            # Formateo de productos
-            formatted_products = []
-            for product in products:
-                product_data = {
-                    "id": product.id,
-                    "name": product.name,
-                    "tipo_prenda": product.tipo_prenda,
-                    "color": product.color,
-                    "talla": product.talla,
-                    "precio_50_u": product.precio_50_u,
-                    "precio_100_u": product.precio_100_u,
-                    "precio_200_u": product.precio_200_u,
-                    "stock": product.stock,
-                    "descripcion": product.descripcion or 'Material de calidad premium',
-                    "categoria": product.categoria or 'General'
-                }
-                formatted_products.append(product_data)
+                sample_products = db.query(
+                    models.Product.name, models.Product.tipo_prenda, models.Product.color, models.Product.talla
+                ).filter(models.Product.stock > 0).limit(3).all()
+                log("❌ No se encontraron productos", level="DEBUG", total_with_stock=total_products,
+                    samples=[tuple(sp) for sp in sample_products])
+            
+            # Formateo de productos: una sola validación para toda la lista
+            raw_products = [row._asdict() for row in products]
+            try:
+                formatted_products = _PRODUCT_LIST_ADAPTER.dump_python(_PRODUCT_LIST_ADAPTER.validate_python(raw_products))
+            except ValidationError as e:
+                log(f"⚠️ Productos con datos fuera de schema, se devuelven sin validar: {e.error_count()} errores")
+                formatted_products = raw_products
 
-            log(f"🔍 Búsqueda ejecutada (final): {len(formatted_products)} productos encontrados")
+            log("🔍 Búsqueda ejecutada", level="DEBUG", found=len(formatted_products))
             
-            return {
+            result = {
                 "operation": "search_products",
                 "success": True,
                 "data": {
@@ -528,6 +423,8 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
                     "total_found": len(formatted_products)
                 }
             }
+            _store_search(cache_key, result)
+            return result
             
         except Exception as e:
             log(f"❌ Error en búsqueda: {e}")
@@ -541,13 +438,17 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
     
     async def _create_order(self, data: Dict, user_phone: str, conversation_id: int = None) -> Dict:
         """Crea pedido con descuento automático de stock"""
+        return await asyncio.to_thread(self._create_order_sync, data, user_phone, conversation_id)
+    
+    def _create_order_sync(self, data: Dict, user_phone: str, conversation_id: int = None) -> Dict:
+        """Versión sincrónica (sesión bloqueante), se ejecuta en un hilo del pool"""
         
         db = SessionLocal()
         try:
             quantity = data.get("quantity", 50)
             product_filters = data.get("product_filters", {})
             
-            log(f"🛒 Creando pedido: quantity={quantity}, filters={product_filters}")
+            log("🛒 Creando pedido", level="DEBUG", quantity=quantity, filters=product_filters)
             
             # ✅ NORMALIZAR FILTROS IGUAL QUE EN _search_products
             for key in ["tipo_prenda", "color", "talla"]:
@@ -556,26 +457,25 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
                     val_clean = val.strip().lower()
                     if val_clean in ["null", "none", ""]:
                         product_filters[key] = None
-                        log(f"🔄 Filtro normalizado en create_order: {key} = '{val}' → None")
+                        log("🔄 Filtro normalizado a None en create_order", level="DEBUG", key=key, value=val)
         
-            # ✅ BASE QUERY: solo productos con stock suficiente
-            query = db.query(models.Product).filter(models.Product.stock >= quantity)
+            # ✅ BASE QUERY: solo productos con stock suficiente (basta el id)
+            query = db.query(models.Product.id).filter(models.Product.stock >= quantity)
             
             # ✅ APLICAR FILTROS SOLO SI NO SON None
-            if product_filters.get("tipo_prenda"):
-                query = query.filter(models.Product.tipo_prenda.ilike(f"%{product_filters['tipo_prenda']}%"))
-                log(f"🔍 Filtro pedido: tipo_prenda ILIKE '%{product_filters['tipo_prenda']}%'")
-            
-            if product_filters.get("color"):
-                query = query.filter(models.Product.color.ilike(f"%{product_filters['color']}%"))
-                log(f"🔍 Filtro pedido: color ILIKE '%{product_filters['color']}%'")
+            query = _filter_by_attributes(
+                query, product_filters.get("tipo_prenda"), product_filters.get("color"), product_filters.get("talla")
+            )
             
-            if product_filters.get("talla"):
-                query = query.filter(models.Product.talla.ilike(f"%{product_filters['talla']}%"))
-                log(f"🔍 Filtro pedido: talla ILIKE '%{product_filters['talla']}%'")
+            # ✅ Primer producto que coincida, bloqueado hasta el commit del pedido. SKIP LOCKED: si otro pedido
+            # concurrente ya tiene esa fila, se toma el siguiente producto que cumpla en lugar de esperar
+            product_id = query.order_by(models.Product.id).with_for_update(skip_locked=True).limit(1).scalar()
             
-            # Buscar primer producto que coincida
-            product = query.first()
+            # Descuento de stock + alta del pedido (con teléfono y conversación) en un solo statement y commit
+            product = crud.create_order_atomic(
+                db, product_id, quantity, f"Cliente WhatsApp {user_phone}",
+                user_phone=user_phone, conversation_id=conversation_id
+            ) if product_id is not None else None
             
             if not product:
                 log("❌ No se encontró producto para el pedido")
@@ -584,43 +484,26 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
                     "success": False,
                     "error": "No hay producto disponible que coincida con los filtros y tenga stock suficiente"
                 }
+            invalidate_search_cache()
             
-            log(f"✅ Producto encontrado para pedido: {product.name} (Stock: {product.stock})")
-            
-            # Crear pedido usando el CRUD existente
-            order_data = schemas.OrderCreate(
-                product_id=product.id,
-                qty=quantity,
-                buyer=f"Cliente WhatsApp {user_phone}"
-            )
-            
-            new_order = crud.create_order(db, order_data)
-            
-            # ✅ AGREGAR DATOS DE WHATSAPP
-            new_order.user_phone = user_phone
-            if conversation_id:
-                new_order.conversation_id = conversation_id
-            db.commit()
-            db.refresh(new_order)
-            
-            log(f"🛒 Pedido creado: ID {new_order.id}, {quantity} unidades")
+            log(f"🛒 Pedido creado: ID {product['order_id']}, {quantity} unidades")
             
             return {
                 "operation": "create_order",
                 "success": True,
                 "data": {
-                    "order_id": new_order.id,
+                    "order_id": product["order_id"],
                     "product": {
-                        "id": product.id,
-                        "name": product.name,
-                        "tipo_prenda": product.tipo_prenda,
-                        "color": product.color,
-                        "talla": product.talla,
-                        "precio_unitario": product.precio_50_u
+                        "id": product["id"],
+                        "name": product["name"],
+                        "tipo_prenda": product["tipo_prenda"],
+                        "color": product["color"],
+                        "talla": product["talla"],
+                        "precio_unitario": product["precio_50_u"]
                     },
                     "quantity": quantity,
-                    "total_price": product.precio_50_u * quantity,
-                    "stock_remaining": product.stock - quantity
+                    "total_price": product["precio_50_u"] * quantity,
+                    "stock_remaining": product["stock"]
                 }
             }
             
@@ -637,6 +520,10 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
     
     async def _edit_recent_order(self, data: Dict, user_phone: str) -> Dict:
         """Edita pedido reciente si está dentro de los 5 minutos"""
+        return await asyncio.to_thread(self._edit_recent_order_sync, data, user_phone)
+    
+    def _edit_recent_order_sync(self, data: Dict, user_phone: str) -> Dict:
+        """Versión sincrónica (sesión bloqueante), se ejecuta en un hilo del pool"""
         
         db = SessionLocal()
         try:
@@ -675,6 +562,7 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
             # Usar CRUD existente que maneja stock
             old_quantity = recent_order.qty
             updated_order = crud.update_order(db, recent_order.id, new_quantity)
+            invalidate_search_cache()
             
             # Obtener producto para calcular nuevo precio
             product = db.query(models.Product).filter(models.Product.id == recent_order.product_id).first()
@@ -705,6 +593,10 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
     
     async def _check_stock(self, data: Dict) -> Dict:
         """Verifica stock disponible"""
+        return await asyncio.to_thread(self._check_stock_sync, data)
+    
+    def _check_stock_sync(self, data: Dict) -> Dict:
+        """Versión sincrónica (sesión bloqueante), se ejecuta en un hilo del pool"""
         
         db = SessionLocal()
         try:
@@ -717,46 +609,40 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
                     val_clean = val.strip().lower()
                     if val_clean in ["null", "none", ""]:
                         product_filters[key] = None
+            
+            cache_key = ("stock", product_filters.get("tipo_prenda"), product_filters.get("color"), product_filters.get("talla"))
+            cached = _cached_search(cache_key)
+            if cached is not None:
+                return cached
         
-            # ✅ BASE QUERY
-            query = db.query(models.Product).filter(models.Product.stock > 0)
+            # ✅ BASE QUERY: columnas de la respuesta + totales como funciones ventana (se calculan antes del LIMIT)
+            query = db.query(
+                *_STOCK_COLUMNS,
+                func.sum(models.Product.stock).over().label("total_stock"),
+                func.count().over().label("total_count")
+            ).filter(models.Product.stock > 0)
             
             # ✅ APLICAR FILTROS SOLO SI NO SON None
-            if product_filters.get("tipo_prenda"):
-                query = query.filter(models.Product.tipo_prenda.ilike(f"%{product_filters['tipo_prenda']}%"))
-            if product_filters.get("color"):
-                query = query.filter(models.Product.color.ilike(f"%{product_filters['color']}%"))
-            if product_filters.get("talla"):
-                query = query.filter(models.Product.talla.ilike(f"%{product_filters['talla']}%"))
-            
-            products = query.all()
-            
-            stock_info = []
-            total_stock = 0
-            
-            for product in products:
-                stock_info.append({
-                    "id": product.id,
-                    "name": product.name,
-                    "stock": product.stock,
-                    "precio_50_u": product.precio_50_u,
-                    "tipo_prenda": product.tipo_prenda,  
-                    "color": product.color,              
-                    "talla": product.talla,
-                    "descripcion": product.descripcion or 'Material de calidad premium',
-                    "categoria": product.categoria or 'General'
-                })
-                total_stock += product.stock
+            query = _filter_by_attributes(
+                query, product_filters.get("tipo_prenda"), product_filters.get("color"), product_filters.get("talla")
+            )
             
-            return {
+            rows = query.order_by(models.Product.id).limit(STOCK_LIST_LIMIT).all()
+            
+            stock_info = [{field: getattr(row, field) for field in _STOCK_FIELDS} for row in rows]
+            total_stock = rows[0].total_stock if rows else 0
+            
+            result = {
                 "operation": "check_stock",
                 "success": True,
                 "data": {
                     "products": stock_info,
                     "total_stock": total_stock,
-                    "products_available": len(stock_info)
+                    "products_available": rows[0].total_count if rows else 0
                 }
             }
+            _store_search(cache_key, result)
+            return result
             
         except Exception as e:
             return {
@@ -767,5 +653,8 @@ Responde SOLO con el JSON, sin explicaciones adicionales.
         finally:
             db.close()
 
-# Instancia global
-query_agent = QueryAgent()
\ No newline at end of file
+# ✅ Instancia global perezosa: importar el módulo no arma modelos ni clientes de Gemini;
+# se crea en el primer uso (rutas sin LLM nunca la construyen)
+@lru_cache(maxsize=1)
+def get_query_agent() -> QueryAgent:
+    return QueryAgent()
\ No newline at end of file
@@ -4,7 +4,7 @@ from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models
-import json
+import orjson
 import os
 from dotenv import load_dotenv
 import time
@@ -132,19 +132,16 @@ EJEMPLOS:
 - "qué tela dura más?" → {{"advice_type": "material_advice"}}"""
 
         try:
-            response = self.call_ollama([
+            response = await self.call_ollama_async([
                 {"role": "system", "content": "Eres un dispatcher inteligente para un sistema de ventas B2B textil."},
                 {"role": "user", "content": prompt}
             ])
             
             # Limpiar y parsear respuesta
             response_clean = self._extract_json_from_response(response)
-            if response_clean.startswith("```json"):
-                response_clean = response_clean[7:-3]
-            elif response_clean.startswith("```"):
-                response_clean = response_clean[3:-3]
+            response_clean = self._strip_fences(response_clean)
             
-            parsed_advice = json.loads(response_clean)
+            parsed_advice = orjson.loads(response_clean)
             log(f"💡🎯 Análisis de asesoramiento: {parsed_advice}")
             
             return parsed_advice
@@ -313,7 +310,7 @@ FORMATO DE RESPUESTA:
 TONO: Profesional, consultivo, orientado a soluciones empresariales"""
 
         try:
-            response_text = self.call_ollama([
+            response_text = await self.call_ollama_async([
                 {"role": "system", "content": "Eres un dispatcher inteligente para un sistema de ventas B2B textil."},
                 {"role": "user", "content": prompt}
             ])
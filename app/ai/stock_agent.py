@@ -3,7 +3,7 @@ from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models
-import json
+import orjson
 import os
 from ..utils.logger import log
 from .base_agent import BaseAgent
@@ -73,14 +73,14 @@ Responde SOLO con JSON:
 }}"""
 
         try:
-            response = self.call_ollama([
+            response = await self.call_ollama_async([
                 {"role": "system", "content": "Analizas consultas de stock usando contexto conversacional."},
                 {"role": "user", "content": prompt}
             ])
             
             json_content = self._extract_json_from_response(response)
             if json_content:
-                parsed_query = json.loads(json_content)
+                parsed_query = orjson.loads(json_content)
                 
                 # ✅ APLICAR MEJORAS CONTEXTUALES
                 parsed_query = self._apply_contextual_improvements(parsed_query, conversation, message)
@@ -187,7 +187,7 @@ Responde SOLO con JSON:
 
 CONSULTA: "{original_message}"
 PRODUCTOS ENCONTRADOS (mostrar TODOS los {stats['showing']} productos):
-{json.dumps(products_summary, indent=1, ensure_ascii=False)}
+{orjson.dumps(products_summary, default=str).decode()}
 
 INSTRUCCIONES CRÍTICAS:
 - MOSTRAR TODOS LOS PRODUCTOS de la lista
@@ -214,7 +214,7 @@ FORMATO OBLIGATORIO:
 MOSTRAR TODOS LOS PRODUCTOS ENCONTRADOS:"""
 
         try:
-            response = self.call_ollama([
+            response = await self.call_ollama_async([
                 {"role": "system", "content": "Respondes DIRECTAMENTE sobre inventario textil B2B mostrando TODOS los productos encontrados. NO uses tags <think> ni metadata. Máximo 3200 caracteres."},
                 {"role": "user", "content": prompt}
             ])
@@ -365,33 +365,6 @@ MOSTRAR TODOS LOS PRODUCTOS ENCONTRADOS:"""
                f"¿Te interesa ver {' o '.join(suggestions)}?\n\n" \
                f"💬 Escribí *'todo el catálogo'* para ver todas las opciones."
 
-    def _extract_json_from_response(self, response_text: str) -> str:
-        """Extrae JSON de la respuesta de Ollama"""
-        
-        # CASO 1: Respuesta directa es JSON
-        if response_text.strip().startswith('{') and response_text.strip().endswith('}'):
-            return response_text.strip()
-        
-        # CASO 2: JSON dentro de markdown
-        if "```json" in response_text:
-            start = response_text.find("```json") + 7
-            end = response_text.find("```", start)
-            if end != -1:
-                return response_text[start:end].strip()
-        
-        # CASO 3: JSON después de texto explicativo
-        first_brace = response_text.find('{')
-        last_brace = response_text.rfind('}')
-        
-        if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-            json_candidate = response_text[first_brace:last_brace + 1]
-            
-            # Verificar que sea JSON válido básico
-            if json_candidate.count('{') == json_candidate.count('}'):
-                return json_candidate
-        
-        return None
-
     async def _get_stock_data(self, query: Dict) -> Dict:
         """Obtiene datos de stock de la base de datos según los filtros"""
         
@@ -4,5 +4,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
 N8N_WEBHOOK_URL = os.getenv("N8N_WEBHOOK_URL", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
@@ -1,6 +1,6 @@
+from sqlalchemy import select, update, insert, literal, Integer, String
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta, timezone
-import pytz
 from fastapi import HTTPException
 from . import models, schemas
 #from .utils.notifications import notify_new_order_sync
@@ -11,8 +11,8 @@ def get_products(db: Session):
 def create_order(db: Session, order: schemas.OrderCreate):
     """Crear pedido con descuento automático de stock"""
     
-    # 1. Verificar que el producto existe
-    product = db.query(models.Product).filter(models.Product.id == order.product_id).first()
+    # 1. Verificar que el producto existe (FOR UPDATE: el descuento de stock se serializa por fila)
+    product = db.query(models.Product).filter(models.Product.id == order.product_id).with_for_update().first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
@@ -41,6 +41,55 @@ def create_order(db: Session, order: schemas.OrderCreate):
     
     return db_order
 
+def create_order_atomic(db: Session, product_id: int, qty: int, buyer: str,
+                        user_phone: str = None, conversation_id: int = None):
+    """
+    Descuenta stock e inserta el pedido en un solo statement (Postgres: CTE UPDATE ... RETURNING → INSERT).
+    El UPDATE es condicional (stock >= qty): sin stock no se toca nada y devuelve None.
+    Devuelve un mapping con order_id y la fila del producto (stock ya descontado) y hace commit.
+    """
+    decrement = (
+        update(models.Product)
+        .where(models.Product.id == product_id, models.Product.stock >= qty)
+        .values(stock=models.Product.stock - qty)
+        .returning(
+            models.Product.id, models.Product.name, models.Product.tipo_prenda, models.Product.color,
+            models.Product.talla, models.Product.precio_50_u, models.Product.stock
+        )
+    )
+    order_values = {
+        "qty": literal(qty, Integer), "buyer": literal(buyer, String), "status": literal("pending", String),
+        "user_phone": literal(user_phone, String), "conversation_id": literal(conversation_id, Integer)
+    }
+    
+    if db.bind.dialect.name == "postgresql":
+        upd = decrement.cte("upd")
+        ins = (
+            insert(models.Order)
+            .from_select(["product_id", *order_values], select(upd.c.id, *order_values.values()))
+            .returning(models.Order.id)
+            .cte("ins")
+        )
+        row = db.execute(select(ins.c.id.label("order_id"), *upd.c)).mappings().first()
+    else:
+        # Otros motores (SQLite) no admiten DML dentro de un CTE: dos statements en la misma transacción
+        product = db.execute(decrement).mappings().first()
+        row = None
+        if product is not None:
+            order_id = db.execute(
+                insert(models.Order).values(
+                    product_id=product_id, qty=qty, buyer=buyer, status="pending",
+                    user_phone=user_phone, conversation_id=conversation_id
+                ).returning(models.Order.id)
+            ).scalar()
+            row = {"order_id": order_id, **product}
+    
+    if row is None:
+        db.rollback()
+        return None
+    db.commit()
+    return row
+
 def get_orders(db: Session):
     return db.query(models.Order).all()
 
@@ -54,16 +103,14 @@ def update_order(db: Session, order_id: int, order_update: schemas.OrderUpdate):
         raise HTTPException(status_code=404, detail="Pedido no encontrado")
     
     # ✅ VERIFICAR TIEMPO LÍMITE PARA MODIFICAR (5 minutos) - ARREGLAR TIMEZONE
-    utc = pytz.UTC
-    
     # Manejar timezone del created_at
     if db_order.created_at.tzinfo is None:
         # Si created_at no tiene timezone, asumimos UTC
-        order_time = utc.localize(db_order.created_at)
+        order_time = db_order.created_at.replace(tzinfo=timezone.utc)
     else:
         order_time = db_order.created_at
     
-    now = datetime.now(utc)
+    now = datetime.now(timezone.utc)
     time_passed = now - order_time  # ✅ AHORA AMBAS SON TIMEZONE-AWARE
     
     if time_passed.total_seconds() > 300:  # 5 minutos
@@ -103,13 +150,100 @@ def update_order(db: Session, order_id: int, order_update: schemas.OrderUpdate):
         setattr(db_order, field, value)
     
     # ✅ ACTUALIZAR TIMESTAMP
-    db_order.updated_at = datetime.now(utc)
+    db_order.updated_at = datetime.now(timezone.utc)
     
     db.commit()
     db.refresh(db_order)
     
     return db_order
 
+def change_order_quantity(db: Session, order_id: int, new_qty: int, commit: bool = True):
+    """
+    Cambia la cantidad de un pedido en una sola transacción con el producto bloqueado.
+    Devuelve (pedido, fila del producto con stock resultante y precios).
+    Con commit=False solo hace flush: la transacción (o savepoint) la cierra quien llama.
+    """
+    
+    # ✅ BLOQUEAR PEDIDO (SELECT ... FOR UPDATE)
+    db_order = db.query(models.Order).filter(models.Order.id == order_id).with_for_update().first()
+    if not db_order:
+        raise HTTPException(status_code=404, detail="Pedido no encontrado")
+    
+    if db_order.status != "pending":
+        raise HTTPException(status_code=400, detail=f"El pedido está {db_order.status} y no se puede modificar")
+    
+    # ✅ VERIFICAR TIEMPO LÍMITE PARA MODIFICAR (5 minutos)
+    if db_order.created_at.tzinfo is None:
+        order_time = db_order.created_at.replace(tzinfo=timezone.utc)
+    else:
+        order_time = db_order.created_at
+    
+    time_passed = datetime.now(timezone.utc) - order_time
+    if time_passed.total_seconds() > 300:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"No se puede modificar. Han pasado {int(time_passed.total_seconds() / 60)} minutos desde la creación"
+        )
+    
+    qty_difference = new_qty - db_order.qty
+    
+    # ✅ BLOQUEAR PRODUCTO mientras se ajusta el stock
+    current_stock = db.execute(
+        select(models.Product.stock).where(models.Product.id == db_order.product_id).with_for_update()
+    ).scalar()
+    if current_stock is None:
+        raise HTTPException(status_code=404, detail="Producto no encontrado")
+    
+    # ✅ UPDATE condicional: si no alcanza el stock no se toca ninguna fila.
+    # RETURNING trae también los precios, así quien llama no necesita otra query al producto
+    product = db.execute(
+        update(models.Product)
+        .where(models.Product.id == db_order.product_id, models.Product.stock >= qty_difference)
+        .values(stock=models.Product.stock - qty_difference)
+        .returning(
+            models.Product.stock, models.Product.precio_50_u, models.Product.precio_100_u, models.Product.precio_200_u
+        )
+    ).first()
+    
+    if product is None:
+        if commit:
+            db.rollback()
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Stock insuficiente. Disponible: {current_stock}, necesario: {qty_difference}"
+        )
+    
+    db_order.qty = new_qty
+    if commit:
+        db.commit()
+    else:
+        db.flush()
+    
+    return db_order, product
+
+def cancel_order(db: Session, order_id: int):
+    """Cancela un pedido pendiente y devuelve su stock con dos UPDATE (sin cargar objetos ORM)"""
+    
+    cancelled = db.execute(
+        update(models.Order)
+        .where(models.Order.id == order_id, models.Order.status == "pending")
+        .values(status="cancelled")
+        .returning(models.Order.qty, models.Order.product_id)
+    ).first()
+    
+    if cancelled is None:
+        db.rollback()
+        return None
+    
+    db.execute(
+        update(models.Product)
+        .where(models.Product.id == cancelled.product_id)
+        .values(stock=models.Product.stock + cancelled.qty)
+    )
+    db.commit()
+    
+    return cancelled.qty
+
 def get_products_with_stock(db: Session):
     """Obtener solo productos con stock disponible"""
     return db.query(models.Product).filter(models.Product.stock > 0).all()
@@ -121,8 +255,8 @@ def check_low_stock_products(db: Session, threshold: int = 10):
         models.Product.stock > 0
     ).all()
 
-def restore_stock_on_order_cancellation(db: Session, order_id: int):
-    """Restaurar stock cuando se cancela un pedido"""
+def restore_stock_on_order_cancellation(db: Session, order_id: int, commit: bool = True):
+    """Restaurar stock cuando se cancela un pedido (con commit=False solo hace flush)"""
     
     order = db.query(models.Order).filter(models.Order.id == order_id).first()
     if not order:
@@ -138,7 +272,10 @@ def restore_stock_on_order_cancellation(db: Session, order_id: int):
     # Marcar pedido como cancelado
     order.status = "cancelled"
     
-    db.commit()
+    if commit:
+        db.commit()
+    else:
+        db.flush()
     
     print(f"♻️ Stock restaurado: +{order.qty} unidades para producto {product.name}")
     print(f"📊 Nuevo stock: {product.stock} unidades")
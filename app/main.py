@@ -3,11 +3,13 @@ import time
 from datetime import datetime
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, Request, Query, HTTPException
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import OperationalError
 from .database import Base, engine, SessionLocal
 from . import crud, schemas, models
 from .ai.conversation_manager import conversation_manager
+from .ai.llm_cache import llm_cache, semantic_intent_cache, SEMANTIC_CACHE_PATH
 from .utils.logger import log  # ✅ IMPORTAR
 from .utils.whatsapp_client import whatsapp_client  # ✅ IMPORTAR CLIENTE WHATSAPP
 import httpx
@@ -22,10 +24,20 @@ async def lifespan(app: FastAPI):
     log("🚀 Iniciando aplicación en Render...") # ✅ USAR LOG
     
     try:
+        # ✅ Los índices trigram de productos requieren la extensión pg_trgm (solo Postgres)
+        if engine.dialect.name == "postgresql":
+            with engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        
         # Crear tablas en Supabase
         Base.metadata.create_all(bind=engine)
         log("✅ Tablas verificadas en Supabase") # ✅ USAR LOG
         
+        # ✅ create_all no agrega índices nuevos a tablas existentes
+        for table in (models.Order.__table__, models.Product.__table__):
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+        
         # Verificar si necesita importar productos
         db = SessionLocal()
         product_count = db.query(models.Product).count()
@@ -43,8 +55,23 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         log(f"❌ Error en inicialización: {e}") # ✅ USAR LOG
     
+    # ✅ Caché semántica de intenciones persistida: un reinicio arranca con la caché caliente
+    if SEMANTIC_CACHE_PATH:
+        try:
+            loaded = semantic_intent_cache.load(SEMANTIC_CACHE_PATH)
+            log(f"🧠 Caché semántica cargada: {loaded} intenciones")
+        except Exception as e:
+            log(f"⚠️ No se pudo cargar la caché semántica: {e}", level="WARNING")
+    
     yield
     
+    if SEMANTIC_CACHE_PATH:
+        try:
+            saved = semantic_intent_cache.save(SEMANTIC_CACHE_PATH)
+            log(f"🧠 Caché semántica guardada: {saved} intenciones")
+        except Exception as e:
+            log(f"⚠️ No se pudo guardar la caché semántica: {e}", level="WARNING")
+    
     log("🛑 Aplicación cerrada") # ✅ USAR LOG
 
 app = FastAPI(title="B2B Sales Agent", lifespan=lifespan)
@@ -76,6 +103,11 @@ def update_order(order_id: int, update: schemas.OrderUpdate, db: Session = Depen
 def read_root():
     return {"message": "B2B Sales Agent API"}
 
+@app.get("/metrics")
+def metrics():
+    """Métricas de las cachés de respuestas LLM (aciertos, fallos, tamaño)"""
+    return {"llm_cache": llm_cache.metrics(), "semantic_intent_cache": semantic_intent_cache.metrics()}
+
 @app.post("/api/chat")
 async def chat_with_agent(
     request: dict,  # {"user_id": "123", "message": "Hola"}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Boolean, Text
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Boolean, Text, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from .database import Base
@@ -19,6 +19,18 @@ class Product(Base):
     descripcion = Column(Text, nullable=True)
     categoria = Column(String, nullable=True)
 
+    # ✅ Índices trigram (pg_trgm) para los ILIKE '%...%' de los agentes: un btree no sirve con comodín inicial
+    __table_args__ = (
+        Index('ix_products_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+        Index('ix_products_tipo_prenda_trgm', 'tipo_prenda', postgresql_using='gin', postgresql_ops={'tipo_prenda': 'gin_trgm_ops'}),
+        Index('ix_products_color_trgm', 'color', postgresql_using='gin', postgresql_ops={'color': 'gin_trgm_ops'}),
+        # Búsquedas por igualdad de atributos: solo interesan productos con stock
+        Index(
+            'ix_products_tipo_color_talla_in_stock', 'tipo_prenda', 'color', 'talla',
+            postgresql_where=(stock > 0), sqlite_where=(stock > 0)
+        ),
+    )
+
 class Order(Base):
     __tablename__ = "orders"
     
@@ -37,6 +49,17 @@ class Order(Base):
     product = relationship("Product")
     conversation = relationship("Conversation", back_populates="orders")
 
+    # ✅ Índices compuestos para el filtro por teléfono + fecha (historial de pedidos del usuario)
+    __table_args__ = (
+        Index('ix_orders_phone_created', 'user_phone', created_at.desc()),
+        Index('ix_orders_phone_status_created', 'user_phone', 'status', 'created_at'),
+        # ✅ Parcial: solo pedidos pendientes (los únicos modificables), para la búsqueda del pedido a modificar
+        Index(
+            'ix_orders_pending_phone_created', 'user_phone', created_at.desc(),
+            postgresql_where=(status == 'pending'), sqlite_where=(status == 'pending')
+        ),
+    )
+
 class Conversation(Base):
     """Historial de conversaciones con el agente IA"""
     __tablename__ = "conversations"
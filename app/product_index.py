@@ -0,0 +1,106 @@
+import time
+import threading
+from itertools import product as combinations
+from typing import Dict, List, Optional, Tuple
+from cachetools import TTLCache
+from sqlalchemy import event
+from .database import SessionLocal
+from . import models
+from .utils.logger import log
+
+# Refresco periódico: cargas masivas externas (import_from_excel) no disparan eventos del ORM de este proceso
+PRODUCT_INDEX_TTL = 300
+
+FilterKey = Tuple[Optional[str], Optional[str], Optional[str]]
+Prices = Tuple[float, float, float]
+
+PRODUCT_PRICE_TTL = 60
+
+def _norm(value: Optional[str]) -> Optional[str]:
+    return value.strip().lower() if value else None
+
+class ProductIndex:
+    """
+    Índice en memoria (tipo_prenda, color, talla) → ids de producto.
+    Las tres columnas tienen muy baja cardinalidad, así que se indexan todas las combinaciones
+    con comodín (None): cualquier filtro parcial se resuelve con un solo lookup en el dict.
+    El stock NO se indexa (cambia con cada pedido); se verifica en la query por PK.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_key: Optional[Dict[FilterKey, List[int]]] = None
+        self._loaded_at = 0.0
+
+    def _load(self) -> Dict[FilterKey, List[int]]:
+        db = SessionLocal()
+        try:
+            rows = db.query(
+                models.Product.id, models.Product.tipo_prenda, models.Product.color, models.Product.talla
+            ).order_by(models.Product.id).all()
+        finally:
+            db.close()
+
+        by_key: Dict[FilterKey, List[int]] = {}
+        for product_id, tipo, color, talla in rows:
+            values = (_norm(tipo), _norm(color), _norm(talla))
+            for key in combinations(*((value, None) for value in values)):
+                by_key.setdefault(key, []).append(product_id)
+
+        log(f"📇 ProductIndex cargado: {len(rows)} productos, {len(by_key)} combinaciones")
+        return by_key
+
+    def ensure_loaded(self) -> Dict[FilterKey, List[int]]:
+        """Carga el índice si hace falta (una sola vez hasta la próxima invalidación)"""
+        by_key = self._by_key
+        if by_key is None or time.monotonic() - self._loaded_at > PRODUCT_INDEX_TTL:
+            with self._lock:
+                if self._by_key is None or time.monotonic() - self._loaded_at > PRODUCT_INDEX_TTL:
+                    self._by_key = self._load()
+                    self._loaded_at = time.monotonic()
+                by_key = self._by_key
+        return by_key
+
+    def invalidate(self, *args):
+        """Descarta el índice; se reconstruye en el próximo lookup"""
+        self._by_key = None
+
+    def lookup(self, tipo_prenda: Optional[str] = None, color: Optional[str] = None, talla: Optional[str] = None) -> List[int]:
+        """Ids de los productos que coinciden con los filtros dados (None = cualquiera)"""
+        return self.ensure_loaded().get((_norm(tipo_prenda), _norm(color), _norm(talla)), [])
+
+# Instancia global
+product_index = ProductIndex()
+
+# ✅ Altas, bajas y cambios de productos por ORM invalidan el índice
+for _event in ("after_insert", "after_update", "after_delete"):
+    event.listen(models.Product, _event, product_index.invalidate)
+
+class ProductPriceCache:
+    """
+    Precios por tramo (precio_50_u, precio_100_u, precio_200_u) por producto, con TTL.
+    Los precios casi no cambian; el stock sí, así que nunca se cachea.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = PRODUCT_PRICE_TTL):
+        self._lock = threading.Lock()
+        self._prices: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, product_id: int) -> Optional[Prices]:
+        with self._lock:
+            return self._prices.get(product_id)
+
+    def put(self, product_id: int, prices: Prices):
+        with self._lock:
+            self._prices[product_id] = prices
+
+    def invalidate(self, mapper, connection, target):
+        """Listener del ORM: un producto modificado o borrado sale de la caché"""
+        with self._lock:
+            self._prices.pop(target.id, None)
+
+# Instancia global
+product_price_cache = ProductPriceCache()
+
+for _event in ("after_update", "after_delete"):
+    event.listen(models.Product, _event, product_price_cache.invalidate)
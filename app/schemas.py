@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional
+from typing import Literal, Optional
 
 class ProductBase(BaseModel):
     name: str
@@ -57,11 +57,39 @@ class OrderCreate(BaseModel):
     product_id: int
     qty: int
     buyer: str
+    user_phone: Optional[str] = None
 
 class OrderUpdate(BaseModel):
     """Schema para actualizar pedidos"""
     qty: int
 
+class ModIntent(BaseModel):
+    """Intención de modificación de un pedido (salida estructurada del LLM)"""
+    modification_type: Literal["change_quantity", "cancel_order", "add_more", "reduce_quantity", "unclear"]
+    new_quantity: Optional[int] = None
+    quantity_change: Optional[int] = None
+    is_clear: bool = False
+    confirmation_needed: bool = False
+
+class IntentProductFilters(BaseModel):
+    """Filtros de producto con los valores exactos de la BD"""
+    tipo_prenda: Optional[Literal["pantalón", "camiseta", "falda", "sudadera", "camisa"]] = None
+    color: Optional[Literal["blanco", "negro", "azul", "verde", "gris", "rojo", "amarillo"]] = None
+    talla: Optional[Literal["S", "M", "L", "XL", "XXL"]] = None
+
+class IntentData(BaseModel):
+    product_filters: IntentProductFilters = IntentProductFilters()
+    quantity: Optional[int] = None
+    action_keywords: list[str] = []
+    is_continuation: bool = False
+    specific_request: str = ""
+
+class StructuredIntent(BaseModel):
+    """Intención de un mensaje de cliente (salida estructurada del LLM de QueryAgent)"""
+    intent_type: Literal["search_products", "confirm_order", "edit_order", "ask_stock", "general_question"]
+    confidence: float
+    extracted_data: IntentData
+
 class OrderBase(BaseModel):
     product_id: int
     qty: int
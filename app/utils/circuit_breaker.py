@@ -0,0 +1,54 @@
+import time
+import threading
+from .logger import log
+
+class CircuitOpenError(Exception):
+    """El circuito está abierto: el servicio se considera caído y no se intenta la llamada"""
+
+class CircuitBreaker:
+    """
+    Circuit breaker simple (closed → open → half-open).
+    Se abre tras 'failure_threshold' fallos consecutivos y deja pasar un único intento de prueba
+    después de 'reset_timeout' segundos; un éxito lo vuelve a cerrar.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """True si se puede intentar la llamada (cerrado, o half-open para el intento de prueba)"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                log(f"🔌 {self.name}: circuito half-open, probando un request")
+                return True
+            return False
+
+    def check(self):
+        """Lanza CircuitOpenError si el circuito no permite llamar"""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name}: circuito abierto, servicio no disponible")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                log(f"🔌 {self.name}: circuito cerrado")
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    log(f"🔌 {self.name}: circuito abierto tras {self.failures} fallos", level="WARNING")
+                self.state = "open"
+                self.opened_at = time.monotonic()
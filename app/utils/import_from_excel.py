@@ -62,9 +62,10 @@ def import_excel(path="DB.xlsx"):
             product = models.Product(
                 # Campos exactos del Excel - verificar que coincidan con el modelo
                 name=product_name,
-                tipo_prenda=row['TIPO_PRENDA'],
-                color=row['COLOR'],
-                talla=row['TALLA'],
+                # Normalizados al escribir: los agentes filtran por igualdad exacta
+                tipo_prenda=str(row['TIPO_PRENDA']).strip().lower(),
+                color=str(row['COLOR']).strip().lower(),
+                talla=str(row['TALLA']).strip().upper(),
                 precio_50_u=float(row['PRECIO_50_U']),
                 precio_100_u=float(row['PRECIO_100_U']),
                 precio_200_u=float(row['PRECIO_200_U']),
@@ -1,9 +1,25 @@
+import os
 import sys
 from datetime import datetime
+import orjson
 
-def log(message: str):
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = LOG_LEVELS.get(os.getenv("LOG_LEVEL", "INFO").upper(), 20)
+
+def log_enabled(level: str = "INFO") -> bool:
+    """True si un evento de este nivel se va a escribir (para evitar armar payloads caros)"""
+    return LOG_LEVELS.get(level, 20) >= LOG_LEVEL
+
+def log(message: str, level: str = "INFO", **fields):
     """
     Función de logging personalizada que fuerza el flush para ser visible en Render.
+    Los campos extra se serializan como JSON solo si el nivel está habilitado.
     """
+    if not log_enabled(level):
+        return
+
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print(f"[{timestamp}] {message}", flush=True)
\ No newline at end of file
+    if fields:
+        payload = orjson.dumps(fields, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        message = f"{message} {payload}"
+    print(f"[{timestamp}] {message}", flush=True)
@@ -1,17 +1,73 @@
 import ollama
 import os
+from .circuit_breaker import CircuitBreaker
 
-def ollama_chat(messages, model=os.getenv("OLLAMA_MODEL", "qwen3:8b")):
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen3:8b")
+# Modelo cuantizado (Q4_K_M / Q8_0) para las clasificaciones cortas en JSON
+OLLAMA_CLASSIFIER_MODEL = os.getenv("OLLAMA_CLASSIFIER_MODEL", OLLAMA_MODEL)
+# Timeout (segundos) por request: evita workers colgados si Ollama se traba
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "60"))
+# Requests simultáneos a Ollama por proceso (alinear con OLLAMA_NUM_PARALLEL del servidor)
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "8"))
+# Tiempo que Ollama mantiene el modelo cargado: con el modelo residente reutiliza el KV cache
+# del prefijo común (system prompt estático) entre requests en lugar de recalcularlo
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+_UNAVAILABLE = "Lo siento, el servicio de IA no está disponible en este momento."
+
+# ✅ Con Ollama caído se responde al instante y los agentes pasan directo a sus fallbacks por reglas
+OLLAMA_BREAKER = CircuitBreaker("Ollama")
+
+def _format_kwargs(format):
+    """keep_alive siempre; 'format' solo cuando se pide salida estructurada"""
+    kwargs = {"keep_alive": OLLAMA_KEEP_ALIVE}
+    if format:
+        kwargs["format"] = format
+    return kwargs
+
+def ollama_chat(messages, model=OLLAMA_MODEL, format=None):
     """
     Envía una conversación a Ollama y retorna la respuesta.
     messages: lista de dicts [{"role": "system"/"user"/"assistant", "content": "..."}]
+    format: "json" fuerza a Ollama a emitir solo JSON válido
     """
+    if not OLLAMA_BREAKER.allow():
+        return _UNAVAILABLE
+    
     # ✅ CONFIGURAR CLIENT PARA DOCKER
-    client = ollama.Client(host=os.getenv("OLLAMA_HOST", "http://localhost:11434"))
+    client = ollama.Client(host=os.getenv("OLLAMA_HOST", "http://localhost:11434"), timeout=OLLAMA_TIMEOUT)
     
     try:
-        response = client.chat(model=model, messages=messages)
+        response = client.chat(model=model, messages=messages, **_format_kwargs(format))
+        OLLAMA_BREAKER.record_success()
         return response['message']['content']
     except Exception as e:
+        OLLAMA_BREAKER.record_failure()
+        print(f"❌ Error connecting to Ollama: {e}")
+        return _UNAVAILABLE
+
+def ollama_chat_stream(messages, model=OLLAMA_CLASSIFIER_MODEL, format=None):
+    """
+    Igual que ollama_chat pero en streaming: genera los fragmentos de texto a medida que llegan.
+    Cerrar el generador corta la conexión y Ollama deja de generar.
+    """
+    if not OLLAMA_BREAKER.allow():
+        yield _UNAVAILABLE
+        return
+    
+    client = ollama.Client(host=os.getenv("OLLAMA_HOST", "http://localhost:11434"), timeout=OLLAMA_TIMEOUT)
+    
+    try:
+        stream = client.chat(model=model, messages=messages, stream=True, **_format_kwargs(format))
+        try:
+            for index, chunk in enumerate(stream):
+                if index == 0:
+                    # El primer fragmento ya prueba que Ollama responde (el consumidor puede cortar antes del final)
+                    OLLAMA_BREAKER.record_success()
+                yield chunk['message']['content']
+        finally:
+            stream.close()
+    except Exception as e:
+        OLLAMA_BREAKER.record_failure()
         print(f"❌ Error connecting to Ollama: {e}")
-        return "Lo siento, el servicio de IA no está disponible en este momento."
\ No newline at end of file
+        yield _UNAVAILABLE
\ No newline at end of file
@@ -0,0 +1,16 @@
+from bisect import bisect_right
+from typing import Mapping, Sequence
+
+# Tramos de precio por cantidad: desde 0 (precio_50_u), desde 100 (precio_100_u), desde 200 (precio_200_u)
+QTY_BREAKS = (0, 100, 200)
+PRICE_FIELDS = ("precio_50_u", "precio_100_u", "precio_200_u")
+
+def price_tuple(product) -> Sequence[float]:
+    """(precio_50_u, precio_100_u, precio_200_u) de un dict, fila o modelo de producto"""
+    if isinstance(product, Mapping):
+        return tuple(product[field] for field in PRICE_FIELDS)
+    return tuple(getattr(product, field) for field in PRICE_FIELDS)
+
+def unit_price(prices: Sequence[float], qty: int) -> float:
+    """Precio unitario del tramo que corresponde a qty (lookup por bisect sobre QTY_BREAKS)"""
+    return prices[max(bisect_right(QTY_BREAKS, qty) - 1, 0)]